@@ -0,0 +1,1022 @@
+"""
+Benchmarks and parity checks for the data pipeline, runnable on a CPU-only box with synthetic data.
+
+python -m opensora.dataset.benchmark frame_index --num_samples 1000000
+python -m opensora.dataset.benchmark sampler --world_size 2 --token_budget 4096
+python -m opensora.dataset.benchmark frame_index_memory --num_samples 1000000 --num_workers 8
+python -m opensora.dataset.benchmark cap_list_memory --num_samples 1000000 --num_workers 8
+python -m opensora.dataset.benchmark opencv_read --num_videos 8 --num_frames 93
+python -m opensora.dataset.benchmark transform --height 1080 --width 1920 --num_frames 93
+python -m opensora.dataset.benchmark loader --num_workers 4 --step_time 0.5 --text_encoder_name_1 /path/to/mt5-xxl
+python -m opensora.dataset.benchmark loader --config scripts/text_condition/gpu/train_t2v_v1_3.sh --synthetic --num_steps 200
+"""
+import os
+import gc
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import threading
+import multiprocessing as mp
+from types import SimpleNamespace
+from collections import defaultdict
+
+import numpy as np
+
+
+def make_synthetic_annotations(root, num_samples, seed=0, video_ratio=0.7):
+    """
+    Write a `--data` txt plus one json annotation with `num_samples` records, covering missing captions,
+    missing resolutions, odd aspect ratios, high fps and short clips. Returns the path of the txt.
+    """
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    resolutions = np.array([
+        [720, 1280], [1080, 1920], [480, 640], [1280, 720], [512, 512], [360, 640], [2160, 3840], [100, 3000], [0, 640]
+        ])
+    fps_choices = np.array([24, 25, 30, 50, 60, 23.976, 29.97])
+    is_video = rng.random(num_samples) < video_ratio
+    res = resolutions[rng.integers(len(resolutions), size=num_samples)]
+    fps = fps_choices[rng.integers(len(fps_choices), size=num_samples)]
+    num_frames = rng.integers(8, 1200, size=num_samples)
+    cut_start = rng.integers(0, 30, size=num_samples)
+    aes = np.round(rng.uniform(3.0, 7.0, size=num_samples), 3)
+    missing = rng.random((num_samples, 4)) < np.array([0.01, 0.01, 0.05, 0.3])
+
+    records = []
+    for i in range(num_samples):
+        record = dict(path=f'{i:08d}.mp4' if is_video[i] else f'{i:08d}.jpg')
+        if not missing[i, 0]:
+            record['cap'] = [f'synthetic caption {i}'] if i % 3 == 0 else f'synthetic caption {i}'
+        if not missing[i, 1]:
+            record['resolution'] = dict(height=int(res[i, 0]), width=int(res[i, 1]))
+        if is_video[i]:
+            record.update(num_frames=int(num_frames[i]), cut=[int(cut_start[i]), int(cut_start[i] + num_frames[i])])
+            if not missing[i, 2]:
+                record['fps'] = float(fps[i])
+        if not missing[i, 3]:
+            record['aesthetic'] = record['aes'] = float(aes[i])
+        records.append(record)
+
+    anno = os.path.join(root, 'anno.json')
+    with open(anno, 'w') as f:
+        json.dump(records, f)
+    data = os.path.join(root, 'data.txt')
+    with open(data, 'w') as f:
+        f.write(f'{root},{anno}\n')
+    return data
+
+
+def dataset_args(data, **kwargs):
+    args = dict(
+        data=data, num_frames=93, train_fps=16, model_max_length=512, cfg=0.1, speed_factor=1.0,
+        max_height=480, max_width=640, drop_short_ratio=0.5, hw_stride=32, force_resolution=False,
+        max_hxw=384*384, min_hxw=384*384 // 4, sp_size=1, use_decord=True, ae_stride_t=4, ae_stride=8,
+        patch_size=2, patch_size_t=1, total_batch_size=8, text_encoder_name_1='google/mt5-xxl',
+        text_encoder_name_2=None, dataloader_num_workers=0, meta_index_dir=None,
+    )
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def define_frame_index_legacy(dataset, data):
+    """
+    The per-record loop `T2V_dataset.define_frame_index` replaced, as the reference of the `frame_index` parity
+    check. Returns `(cap_list, sample_size, shape_idx_dict, counters)`; the kept records get their derived fields.
+    """
+    import pickle
+    from collections import Counter
+    import torch
+    from tqdm import tqdm
+    from opensora.dataset.transform import get_params, maxhwresize, calculate_statistics
+    from opensora.dataset.t2v_datasets import filter_resolution, find_closest_y
+
+    shape_idx_dict = {}
+    new_cap_list = []
+    sample_size = []
+    aesthetic_score = []
+    cnt_vid = 0
+    cnt_img = 0
+    cnt_too_long = 0
+    cnt_too_short = 0
+    cnt_no_cap = 0
+    cnt_no_resolution = 0
+    cnt_no_aesthetic = 0
+    cnt_img_res_mismatch_stride = 0
+    cnt_vid_res_mismatch_stride = 0
+    cnt_img_aspect_mismatch = 0
+    cnt_vid_aspect_mismatch = 0
+    cnt_img_res_too_small = 0
+    cnt_vid_res_too_small = 0
+    cnt_vid_after_filter = 0
+    cnt_img_after_filter = 0
+    cnt = 0
+
+
+    with open(data, 'r') as f:
+        folder_anno = [i.strip().split(',') for i in f.readlines() if len(i.strip()) > 0]
+    for sub_root, anno in tqdm(folder_anno):
+        print(f'Building {anno}...')
+        if anno.endswith('.json'):
+            with open(anno, 'r') as f:
+                sub_list = json.load(f)
+        elif anno.endswith('.pkl'):
+            with open(anno, "rb") as f: 
+                sub_list = pickle.load(f)
+        for index, i in enumerate(tqdm(sub_list)):
+            cnt += 1
+            path = os.path.join(sub_root, i['path'])
+            i['path'] = path
+            if path.endswith('.mp4'):
+                cnt_vid += 1
+            elif path.endswith('.jpg'):
+                cnt_img += 1
+
+            # ======no aesthetic=====
+            if i.get('aesthetic', None) is None or i.get('aes', None) is None:
+                cnt_no_aesthetic += 1
+            else:
+                aesthetic_score.append(i.get('aesthetic', None) or i.get('aes', None))
+
+            # ======no caption=====
+            cap = i.get('cap', None)
+            if cap is None:
+                cnt_no_cap += 1
+                continue
+
+            # ======resolution mismatch=====
+            if i.get('resolution', None) is None:
+                cnt_no_resolution += 1
+                continue
+            else:
+                if i['resolution'].get('height', None) is None or i['resolution'].get('width', None) is None:
+                    cnt_no_resolution += 1
+                    continue
+                else:
+                    height, width = i['resolution']['height'], i['resolution']['width']
+                    if not dataset.force_resolution:
+                        if height <= 0 or width <= 0:
+                            cnt_no_resolution += 1
+                            continue
+
+                        tr_h, tr_w = maxhwresize(height, width, dataset.max_hxw)
+                        _, _, sample_h, sample_w = get_params(tr_h, tr_w, dataset.hw_stride)
+
+                        if sample_h <= 0 or sample_w <= 0:
+                            if path.endswith('.mp4'):
+                                cnt_vid_res_mismatch_stride += 1
+                            elif path.endswith('.jpg'):
+                                cnt_img_res_mismatch_stride += 1
+                            continue
+
+                        # filter min_hxw
+                        if sample_h * sample_w < dataset.min_hxw:
+                            if path.endswith('.mp4'):
+                                cnt_vid_res_too_small += 1
+                            elif path.endswith('.jpg'):
+                                cnt_img_res_too_small += 1
+                            continue
+
+                        # filter aspect
+                        is_pick = filter_resolution(
+                            sample_h, sample_w, max_h_div_w_ratio=dataset.hw_aspect_thr, min_h_div_w_ratio=1/dataset.hw_aspect_thr
+                            )
+                        if not is_pick:
+                            if path.endswith('.mp4'):
+                                cnt_vid_aspect_mismatch += 1
+                            elif path.endswith('.jpg'):
+                                cnt_img_aspect_mismatch += 1
+                            continue
+
+                        i['resolution'].update(dict(sample_height=sample_h, sample_width=sample_w))
+
+                    else:
+                        aspect = dataset.max_height / dataset.max_width
+                        is_pick = filter_resolution(
+                            height, width, max_h_div_w_ratio=dataset.hw_aspect_thr*aspect, min_h_div_w_ratio=1/dataset.hw_aspect_thr*aspect
+                            )
+                        if not is_pick:
+                            if path.endswith('.mp4'):
+                                cnt_vid_aspect_mismatch += 1
+                            elif path.endswith('.jpg'):
+                                cnt_img_aspect_mismatch += 1
+                            continue
+                        sample_h, sample_w = dataset.max_height, dataset.max_width
+
+                        i['resolution'].update(dict(sample_height=sample_h, sample_width=sample_w))
+
+
+            if path.endswith('.mp4'):
+                fps = i.get('fps', 24)
+                # max 5.0 and min 1.0 are just thresholds to filter some videos which have suitable duration. 
+                if i['num_frames'] > dataset.too_long_factor * (dataset.num_frames * fps / dataset.train_fps * dataset.speed_factor):  # too long video is not suitable for this training stage (dataset.num_frames)
+                    cnt_too_long += 1
+                    continue
+
+                # resample in case high fps, such as 50/60/90/144 -> train_fps(e.g, 24)
+                frame_interval = 1.0 if abs(fps - dataset.train_fps) < 0.1 else fps / dataset.train_fps
+                start_frame_idx = i.get('cut', [0])[0]
+                i['start_frame_idx'] = start_frame_idx
+                frame_indices = np.arange(start_frame_idx, start_frame_idx+i['num_frames'], frame_interval).astype(int)
+                frame_indices = frame_indices[frame_indices < start_frame_idx+i['num_frames']]
+
+                # comment out it to enable dynamic frames training
+                if len(frame_indices) < dataset.num_frames and torch.rand(1, generator=dataset.generator).item() < dataset.drop_short_ratio:
+                    cnt_too_short += 1
+                    continue
+
+                #  too long video will be temporal-crop randomly
+                if len(frame_indices) > dataset.num_frames:
+                    begin_index, end_index = dataset.temporal_sample(len(frame_indices))
+                    frame_indices = frame_indices[begin_index: end_index]
+                    # frame_indices = frame_indices[:dataset.num_frames]  # head crop
+                # to find a suitable end_frame_idx, to ensure we do not need pad video
+                end_frame_idx = find_closest_y(
+                    len(frame_indices), vae_stride_t=dataset.ae_stride_t, model_ds_t=dataset.sp_size
+                    )
+                if end_frame_idx == -1:  # too short that can not be encoded exactly by videovae
+                    cnt_too_short += 1
+                    continue
+                frame_indices = frame_indices[:end_frame_idx]
+
+                i['sample_frame_range'] = (start_frame_idx, frame_interval, len(frame_indices))
+
+                new_cap_list.append(i)
+                cnt_vid_after_filter += 1
+
+            elif path.endswith('.jpg'):  # image
+                cnt_img_after_filter += 1
+                i['sample_frame_range'] = (0, 1.0, 1)
+                new_cap_list.append(i)
+
+            else:
+                raise NameError(f"Unknown file extention {path.split('.')[-1]}, only support .mp4 for video and .jpg for image")
+
+            pre_define_shape = f"{i['sample_frame_range'][2]}x{sample_h}x{sample_w}"
+            sample_size.append(pre_define_shape)
+            # if shape_idx_dict.get(pre_define_shape, None) is None:
+            #     shape_idx_dict[pre_define_shape] = [index]
+            # else:
+            #     shape_idx_dict[pre_define_shape].append(index)
+    counter = Counter(sample_size)
+    counter_cp = counter
+    if not dataset.force_resolution and dataset.max_hxw is not None and dataset.min_hxw is not None:
+        assert all([np.prod(np.array(k.split('x')[1:]).astype(np.int32)) <= dataset.max_hxw for k in counter_cp.keys()])
+        assert all([np.prod(np.array(k.split('x')[1:]).astype(np.int32)) >= dataset.min_hxw for k in counter_cp.keys()])
+
+    len_before_filter_major = len(sample_size)
+    filter_major_num = 4 * dataset.total_batch_size
+    new_cap_list, sample_size = zip(*[[i, j] for i, j in zip(new_cap_list, sample_size) if counter[j] >= filter_major_num])
+    for idx, shape in enumerate(sample_size):
+        if shape_idx_dict.get(shape, None) is None:
+            shape_idx_dict[shape] = [idx]
+        else:
+            shape_idx_dict[shape].append(idx)
+    cnt_filter_minority = len_before_filter_major - len(sample_size) 
+    counter = Counter(sample_size)
+    counters = dict(
+        cnt=cnt, cnt_vid=cnt_vid, cnt_img=cnt_img, cnt_too_long=cnt_too_long, cnt_too_short=cnt_too_short, 
+        cnt_no_cap=cnt_no_cap, cnt_no_resolution=cnt_no_resolution, cnt_no_aesthetic=cnt_no_aesthetic, 
+        cnt_img_res_mismatch_stride=cnt_img_res_mismatch_stride, cnt_vid_res_mismatch_stride=cnt_vid_res_mismatch_stride, 
+        cnt_img_aspect_mismatch=cnt_img_aspect_mismatch, cnt_vid_aspect_mismatch=cnt_vid_aspect_mismatch, 
+        cnt_img_res_too_small=cnt_img_res_too_small, cnt_vid_res_too_small=cnt_vid_res_too_small, 
+        cnt_vid_after_filter=cnt_vid_after_filter, cnt_img_after_filter=cnt_img_after_filter, 
+        cnt_filter_minority=cnt_filter_minority, 
+    )
+
+    print(f'no_cap: {cnt_no_cap}, no_resolution: {cnt_no_resolution}\n'
+            f'too_long: {cnt_too_long}, too_short: {cnt_too_short}\n'
+            f'cnt_img_res_mismatch_stride: {cnt_img_res_mismatch_stride}, cnt_vid_res_mismatch_stride: {cnt_vid_res_mismatch_stride}\n'
+            f'cnt_img_res_too_small: {cnt_img_res_too_small}, cnt_vid_res_too_small: {cnt_vid_res_too_small}\n'
+            f'cnt_img_aspect_mismatch: {cnt_img_aspect_mismatch}, cnt_vid_aspect_mismatch: {cnt_vid_aspect_mismatch}\n'
+            f'cnt_filter_minority: {cnt_filter_minority}\n'
+            f'Counter(sample_size): {counter}\n'
+            f'cnt_vid: {cnt_vid}, cnt_vid_after_filter: {cnt_vid_after_filter}, use_ratio: {round(cnt_vid_after_filter/(cnt_vid+1e-6), 5)*100}%\n'
+            f'cnt_img: {cnt_img}, cnt_img_after_filter: {cnt_img_after_filter}, use_ratio: {round(cnt_img_after_filter/(cnt_img+1e-6), 5)*100}%\n'
+            f'before filter: {cnt}, after filter: {len(new_cap_list)}, use_ratio: {round(len(new_cap_list)/cnt, 5)*100}%')
+
+    if len(aesthetic_score) > 0:
+        stats_aesthetic = calculate_statistics(aesthetic_score)
+        print(f"before filter: {cnt}, after filter: {len(new_cap_list)}\n"
+            f"aesthetic_score: {len(aesthetic_score)}, cnt_no_aesthetic: {cnt_no_aesthetic}\n"
+            f"{len([i for i in aesthetic_score if i>=5.75])} > 5.75, 4.5 > {len([i for i in aesthetic_score if i<=4.5])}\n"
+            f"Mean: {stats_aesthetic['mean']}, Var: {stats_aesthetic['variance']}, Std: {stats_aesthetic['std_dev']}\n"
+            f"Min: {stats_aesthetic['min']}, Max: {stats_aesthetic['max']}")
+
+    return new_cap_list, sample_size, shape_idx_dict, counters
+
+
+def bench_frame_index(args):
+    """Check that the vectorized `define_frame_index` matches the per-record loop, and time both."""
+    from opensora.dataset.t2v_datasets import T2V_dataset
+    from opensora.dataset.transform import TemporalRandomCrop
+
+    root = args.work_dir or tempfile.mkdtemp(prefix='opensora_frame_index_')
+    data = make_synthetic_annotations(root, args.num_samples, seed=args.seed)
+    for force_resolution in [False, True]:
+        ds_args = dataset_args(data, force_resolution=force_resolution, num_frames=args.num_frames, max_hxw=args.max_hxw)
+        dataset = T2V_dataset(
+            ds_args, transform=None, temporal_sample=TemporalRandomCrop(ds_args.num_frames), tokenizer_1=None, tokenizer_2=None
+            )
+        dataset.generator.manual_seed(dataset.seed)
+        s = time.time()
+        cap_list, sample_size, shape_idx_dict, counters = define_frame_index_legacy(dataset, data)
+        legacy_time = time.time() - s
+        dataset.generator.manual_seed(dataset.seed)
+        s = time.time()
+        _, vectorized_size, vectorized_idx_dict = dataset.define_frame_index(data)
+        vectorized_time = time.time() - s
+        columns = dataset.frame_index_columns
+
+        assert list(sample_size) == list(vectorized_size), 'sample_size mismatch'
+        assert shape_idx_dict == {k: list(v) for k, v in vectorized_idx_dict.items()}, 'shape_idx_dict mismatch'
+        assert counters == dataset.frame_index_counters, f'counters mismatch {counters} vs {dataset.frame_index_counters}'
+        # the fields the loop wrote into the records are columns now
+        derived = dict(
+            sample_height=[i['resolution']['sample_height'] for i in cap_list],
+            sample_width=[i['resolution']['sample_width'] for i in cap_list],
+            start_frame_idx=[i.get('start_frame_idx', 0) for i in cap_list],
+            frame_interval=[i['sample_frame_range'][1] for i in cap_list],
+            sample_num_frames=[i['sample_frame_range'][2] for i in cap_list],
+            )
+        for name, values in derived.items():
+            assert np.array_equal(np.array(values, dtype=columns[name].dtype), columns[name]), f'{name} mismatch'
+        print(f"force_resolution={force_resolution}: parity OK on {args.num_samples} records, "
+              f"{len(sample_size)} kept, legacy {legacy_time:.2f}s, vectorized {vectorized_time:.2f}s")
+
+
+def _sharded_batches(sampler, num_samples, world_size, batch_size=None):
+    """
+    The batches of every rank, through the DataLoader wrapping `accelerator.prepare` does (BatchSamplerShard), with
+    the pass counter started at the sampler's epoch as in train_t2v_diffusers.py.
+    """
+    from torch.utils.data import DataLoader
+    from accelerate.data_loader import prepare_data_loader
+
+    ranks = []
+    for rank in range(world_size):
+        if batch_size is None:
+            loader = DataLoader(range(num_samples), batch_sampler=sampler, collate_fn=list)
+        else:
+            loader = DataLoader(range(num_samples), sampler=sampler, batch_size=batch_size, drop_last=True, collate_fn=list)
+        loader = prepare_data_loader(loader, num_processes=world_size, process_index=rank, put_on_device=False)
+        loader.set_epoch(sampler.epoch)
+        ranks.append([[int(i) for i in batch] for batch in loader])
+    return ranks
+
+
+def bench_sampler(args):
+    """
+    Check that `LengthGroupedSampler` and `TokenBudgetBatchSampler`, sharded over ranks by accelerate, hand every rank
+    its rows of each megabatch, whatever the batch size of their shape, and that a sampler resumed from a state dict
+    carries on at its cursor.
+    """
+    from opensora.utils.dataset_utils import LengthGroupedSampler, TokenBudgetBatchSampler
+
+    rng = np.random.default_rng(args.seed)
+    lengths = ['1x256x256'] * args.num_images + ['33x256x256'] * args.num_videos
+    lengths = [lengths[i] for i in rng.permutation(len(lengths))]
+
+    def make_samplers():
+        token_sampler = TokenBudgetBatchSampler(
+            args.token_budget, world_size=args.world_size, gradient_accumulation_size=1, initial_global_step=0,
+            lengths=lengths, ae_stride_thw=(4, 8, 8), patch_size_thw=(1, 2, 2), seed=args.seed,
+            )
+        length_sampler = LengthGroupedSampler(
+            args.train_batch_size, world_size=args.world_size, gradient_accumulation_size=1, initial_global_step=0,
+            lengths=lengths, group_data=True, seed=args.seed,
+            )
+        return token_sampler, length_sampler
+
+    def raw_batches(epoch):
+        token_sampler, length_sampler = make_samplers()
+        token_sampler.set_epoch(epoch)
+        length_sampler.set_epoch(epoch)
+        flat = list(length_sampler)
+        return {
+            'token_budget': list(token_sampler),
+            'length_grouped': [flat[i: i + args.train_batch_size] for i in range(0, len(flat), args.train_batch_size)],
+            }
+
+    def sharded_batches(state=None):
+        token_sampler, length_sampler = make_samplers()
+        if state is not None:
+            token_sampler.load_state_dict(dict(state))
+            length_sampler.load_state_dict(dict(state))
+        return {
+            'token_budget': _sharded_batches(token_sampler, len(lengths), args.world_size),
+            'length_grouped': _sharded_batches(length_sampler, len(lengths), args.world_size, args.train_batch_size),
+            }
+
+    raw, sharded = raw_batches(0), sharded_batches()
+    for name in raw:
+        for rank in range(args.world_size):
+            assert sharded[name][rank] == raw[name][rank::args.world_size], f'{name}: rank {rank} batches differ from the sampler'
+        sizes = sorted(set(len(batch) for batch in raw[name]))
+        print(f'{name}: {len(raw[name])} batches of sizes {sizes}, {len(sharded[name][0])} per rank over {args.world_size} ranks, sharding OK')
+
+    # a resumed run restores (seed, epoch, cursor) before its first pass over the prepared loader
+    for epoch in [0, 1]:
+        state = dict(seed=args.seed, epoch=epoch, cursor=args.resume_cursor)
+        raw, resumed = raw_batches(epoch), sharded_batches(state)
+        for name in raw:
+            skipped = args.resume_cursor * args.world_size  # every megabatch holds one batch per rank
+            for rank in range(args.world_size):
+                assert resumed[name][rank] == raw[name][skipped:][rank::args.world_size], \
+                    f'{name}: rank {rank} does not resume at megabatch {args.resume_cursor} of epoch {epoch}'
+            print(f'{name}: resumed at megabatch {args.resume_cursor} of epoch {epoch}, '
+                  f'{len(resumed[name][0])} of {len(raw[name]) // args.world_size} batches per rank left, resume OK')
+
+
+def process_memory():
+    """
+    Rss and Private_Anonymous in MB, Linux only. Private_Anonymous counts the anonymous pages only this process
+    maps, i.e. the copy-on-write pages it has actually copied; pages of files on /dev/shm are not included.
+    """
+    memory = dict(Rss=0, Private_Anonymous=0)
+    mapping = {}
+    with open('/proc/self/smaps', 'r') as f:
+        for line in f:
+            key, value = line.split(None, 1)
+            if key in ['Rss:', 'Private_Dirty:', 'Anonymous:']:
+                mapping[key[:-1]] = int(value.split()[0]) / 1024
+                if key == 'Anonymous:':
+                    memory['Rss'] += mapping['Rss']
+                    memory['Private_Anonymous'] += min(mapping['Private_Dirty'], mapping['Anonymous'])
+    return memory
+
+
+def synthetic_cap_list(num_samples, num_frames, layout, seed=0):
+    """
+    Filtered `cap_list` as produced by `define_frame_index`. `layout='list'` stores the materialized
+    `sample_frame_index` of the old code, `layout='range'` the `(start, interval, count)` descriptor.
+    """
+    rng = np.random.default_rng(seed)
+    intervals = rng.choice([1.0, 1.5, 1.875, 3.75], size=num_samples).tolist()
+    starts = rng.integers(0, 30, size=num_samples).tolist()
+    cap_list = []
+    for i, (start, interval) in enumerate(zip(starts, intervals)):
+        record = dict(
+            path=f'/data/{i:08d}.mp4', cap=f'synthetic caption {i}', fps=16 * interval, num_frames=int(num_frames * interval),
+            resolution=dict(height=720, width=1280, sample_height=480, sample_width=640), start_frame_idx=start,
+            )
+        if layout == 'list':
+            record['sample_frame_index'] = (start + np.arange(num_frames) * interval).astype(int).tolist()
+        else:
+            record['sample_frame_range'] = (start, interval, num_frames)
+        cap_list.append(record)
+    return cap_list
+
+
+def _touch_cap_list(cap_list, key, queue):
+    # what a dataloader worker does over an epoch: index every record and read its frame indices
+    before = process_memory()
+    total = 0
+    for i in range(len(cap_list)):
+        value = cap_list[i][key]
+        total += len(value) if key == 'sample_frame_index' else value[2]
+    # a full collection walks every tracked container, as the cyclic gc eventually does in a long-lived worker
+    gc.collect()
+    after = process_memory()
+    queue.put(after['Private_Anonymous'] - before['Private_Anonymous'])
+
+
+def bench_frame_index_memory(args):
+    """Parent RSS and per-worker copy-on-write growth of `cap_list`, materialized index lists vs descriptors."""
+    ctx = mp.get_context('fork')
+    # keep the interpreter/torch objects out of the workers' collections, so only `cap_list` is measured
+    gc.collect()
+    gc.freeze()
+    for layout, key in [('list', 'sample_frame_index'), ('range', 'sample_frame_range')]:
+        gc.collect()
+        base = process_memory()['Rss']
+        cap_list = synthetic_cap_list(args.num_samples, args.num_frames, layout, seed=args.seed)
+        gc.collect()
+        rss = process_memory()['Rss'] - base
+        queue = ctx.Queue()
+        workers = [ctx.Process(target=_touch_cap_list, args=(cap_list, key, queue)) for _ in range(args.num_workers)]
+        for w in workers:
+            w.start()
+        copied = [queue.get() for _ in workers]
+        for w in workers:
+            w.join()
+        print(f'{layout:>5}: cap_list {rss:.0f}MB in parent, copied per worker {np.mean(copied):.0f}MB '
+              f'(x{args.num_workers} workers = {np.sum(copied):.0f}MB)')
+        del cap_list
+
+
+def _iterate_cap_list(cap_list, num_steps, num_reports, seed, queue):
+    # random access as in `get_video`/`get_image`, reporting copied pages at a few points of the run
+    rng = np.random.default_rng(seed)
+    before = process_memory()['Private_Anonymous']
+    growth = []
+    for chunk in np.array_split(rng.integers(len(cap_list), size=num_steps), num_reports):
+        for idx in chunk.tolist():
+            record = cap_list[idx]
+            _ = (record['path'], record['cap'], record['resolution']['sample_height'], record['sample_frame_range'])
+        gc.collect()
+        growth.append(process_memory()['Private_Anonymous'] - before)
+    queue.put(growth)
+
+
+def bench_cap_list_memory(args):
+    """Copy-on-write growth of dataloader workers reading a python `cap_list` vs the shared-memory store."""
+    from opensora.dataset.meta_index import shared_meta_index
+
+    ctx = mp.get_context('fork')
+    gc.collect()
+    gc.freeze()
+    for store in ['list', 'shared']:
+        cap_list = synthetic_cap_list(args.num_samples, args.num_frames, 'range', seed=args.seed)
+        if store == 'shared':
+            cap_list = shared_meta_index(cap_list, [f'{args.num_frames}x480x640'] * len(cap_list))
+        gc.collect()
+        queue = ctx.Queue()
+        workers = [
+            ctx.Process(target=_iterate_cap_list, args=(cap_list, args.num_steps, args.num_reports, args.seed + i, queue))
+            for i in range(args.num_workers)
+            ]
+        for w in workers:
+            w.start()
+        growth = np.array([queue.get() for _ in workers]).mean(0)
+        for w in workers:
+            w.join()
+        print(f"{store:>6}: copied per worker after {args.num_steps} steps: {' -> '.join(f'{g:.0f}MB' for g in growth)}")
+        if store == 'shared':
+            assert growth[-1] - growth[0] <= args.max_growth_mb, f'worker memory grows by {growth[-1] - growth[0]:.0f}MB'
+        del cap_list
+
+
+def make_synthetic_videos(root, num_videos, num_frames, height, width, fps=24, seed=0):
+    """Write `num_videos` mp4 files of moving noise (so the encoder can not skip frames). Returns their paths."""
+    import cv2
+
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for v in range(num_videos):
+        path = os.path.join(root, f'{v:04d}.mp4')
+        if not os.path.exists(path):
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+            texture = rng.integers(0, 256, size=(height, width * 2, 3), dtype=np.uint8)
+            for i in range(num_frames):
+                writer.write(np.ascontiguousarray(texture[:, i % width: i % width + width]))
+            writer.release()
+        paths.append(path)
+    return paths
+
+
+def _read_opencv_seek(path, frame_indices):
+    import cv2
+
+    cv2_vr = cv2.VideoCapture(path)
+    frames = []
+    for frame_idx in frame_indices:
+        cv2_vr.set(1, int(frame_idx))
+        _, frame = cv2_vr.read()
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    cv2_vr.release()
+    return np.stack(frames)
+
+
+def _read_opencv_sequential(path, frame_indices):
+    import cv2
+    from opensora.dataset.t2v_datasets import opencv_read_frames
+
+    cv2_vr = cv2.VideoCapture(path)
+    frames = opencv_read_frames(cv2_vr, frame_indices, path)
+    cv2_vr.release()
+    return frames
+
+
+def _read_decord(path, frame_indices):
+    from opensora.dataset.t2v_datasets import DecordDecoder
+
+    return DecordDecoder(path).get_batch(frame_indices).numpy()
+
+
+def bench_opencv_read(args):
+    """Time the seek-per-frame OpenCV reader, the sequential one and decord on synthetic clips; check their frames."""
+    root = args.work_dir or tempfile.mkdtemp(prefix='opensora_opencv_read_')
+    paths = make_synthetic_videos(root, args.num_videos, args.video_frames, args.height, args.width, seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    windows = []
+    for path in paths:
+        interval = args.frame_interval
+        span = int(np.ceil(args.num_frames * interval))
+        start = int(rng.integers(0, args.video_frames - span + 1))
+        windows.append((path, np.arange(start, start + span, interval).astype(int)[:args.num_frames]))
+    readers = [('opencv_seek', _read_opencv_seek), ('opencv_sequential', _read_opencv_sequential), ('decord', _read_decord)]
+    frames = {}
+    for name, reader in readers:
+        s = time.time()
+        for _ in range(args.repeats):
+            frames[name] = [reader(path, frame_indices) for path, frame_indices in windows]
+        e = time.time()
+        num_frames = args.repeats * sum(len(i) for _, i in windows)
+        print(f'{name:>18}: {(e - s) / (args.repeats * len(windows)) * 1000:8.1f}ms per clip, {num_frames / (e - s):8.1f} frames/s')
+    for a, b in zip(frames['opencv_seek'], frames['opencv_sequential']):
+        assert a.shape == b.shape and np.array_equal(a, b), 'the sequential reader returns other frames than the seeking one'
+    diff = max(np.abs(a.astype(np.int16) - b.astype(np.int16)).mean() for a, b in zip(frames['opencv_sequential'], frames['decord']))
+    print(f'opencv_sequential == opencv_seek on {len(windows)} clips, mean |opencv - decord| <= {diff:.2f}')
+
+
+def _peak_memory_mb():
+    """VmHWM of this process in MB, Linux only."""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _run_transform(name, transform, clips, queue):
+    import torch
+
+    torch.set_num_threads(1)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')  # reset VmHWM, so only this chain is measured
+    base = _peak_memory_mb()
+    s = time.process_time()
+    outputs = [transform(clip) for clip in clips]
+    cpu = (time.process_time() - s) / len(clips)
+    queue.put((name, cpu, _peak_memory_mb() - base, [o.numpy() for o in outputs[:2]]))
+
+
+def bench_transform(args):
+    """Per-sample CPU time and peak memory of the t2v transform: float-then-resize (old) vs uint8 resize-then-float."""
+    import torch
+    from torchvision.transforms import Compose, Lambda
+    from opensora.dataset.transform import ToTensorVideo, MaxHWResizeVideo, SpatialStrideCropVideo, CenterCropResizeVideo
+
+    rng = np.random.default_rng(args.seed)
+    # decoders return (T, H, W, C) permuted to (T, C, H, W), i.e. channels-last memory
+    clips = [
+        torch.from_numpy(rng.integers(0, 256, size=(args.num_frames, args.height, args.width, 3), dtype=np.uint8)).permute(0, 3, 1, 2)
+        for _ in range(args.num_clips)
+        ]
+    norm_fun = Lambda(lambda x: 2. * x - 1.)
+    if args.force_resolution:
+        resize = [CenterCropResizeVideo((args.max_height, args.max_width))]
+    else:
+        resize = [MaxHWResizeVideo(args.max_hxw), SpatialStrideCropVideo(stride=args.hw_stride)]
+    chains = [
+        ('float_then_resize', Compose([ToTensorVideo(), *resize, norm_fun])),
+        ('uint8_resize', Compose([*resize, ToTensorVideo(), norm_fun])),
+        ]
+    ctx = mp.get_context('fork')
+    results = {}
+    for name, transform in chains:
+        queue = ctx.Queue()
+        p = ctx.Process(target=_run_transform, args=(name, transform, clips, queue))
+        p.start()
+        name, cpu, peak, outputs = queue.get()
+        p.join()
+        results[name] = outputs
+        print(f'{name:>18}: {cpu * 1000:8.1f}ms CPU per sample, peak +{peak:.0f}MB, output {outputs[0].shape}')
+    diff = [np.abs(a - b) for a, b in zip(results['float_then_resize'], results['uint8_resize'])]
+    print(f'max |diff| {max(d.max() for d in diff) * 127.5:.2f}/255, mean {np.mean([d.mean() for d in diff]) * 127.5:.3f}/255')
+
+
+def make_synthetic_corpus(root, num_videos, num_images, video_frames=96, fps=24, seed=0):
+    """
+    Write real media for the loader benchmark, noise clips and jpgs over a few resolutions, and a `--data` txt
+    whose annotations describe them. Files already written by an earlier run with the same `root` are reused.
+    """
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    records = []
+    video_resolutions = [(480, 640), (360, 640), (640, 480)]
+    for k, (height, width) in enumerate(video_resolutions):
+        count = len(range(k, num_videos, len(video_resolutions)))
+        paths = make_synthetic_videos(
+            os.path.join(root, f'videos_{height}x{width}'), count, video_frames, height, width, fps=fps, seed=seed + k
+            )
+        for path in paths:
+            records.append(dict(
+                path=os.path.relpath(path, root), cap=f'synthetic video {len(records)}', fps=fps, num_frames=video_frames,
+                cut=[0, video_frames], resolution=dict(height=height, width=width), aesthetic=float(np.round(rng.uniform(4, 7), 3)),
+                ))
+    image_resolutions = [(480, 640), (512, 512), (720, 1280)]
+    for i in range(num_images):
+        height, width = image_resolutions[i % len(image_resolutions)]
+        path = os.path.join(root, 'images', f'{i:05d}.jpg')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cv2.imwrite(path, rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+        records.append(dict(
+            path=os.path.relpath(path, root), cap=f'synthetic image {i}', resolution=dict(height=height, width=width),
+            aesthetic=float(np.round(rng.uniform(4, 7), 3)),
+            ))
+    anno = os.path.join(root, 'corpus.json')
+    with open(anno, 'w') as f:
+        json.dump(records, f)
+    data = os.path.join(root, 'corpus.txt')
+    with open(data, 'w') as f:
+        f.write(f'{root},{anno}\n')
+    return data
+
+
+def config_tokens(path):
+    """The flags of the training script call in a launch script, e.g. scripts/text_condition/gpu/train_t2v_v1_3.sh."""
+    with open(path, 'r') as f:
+        tokens = shlex.split(f.read().replace('\\\n', ' '), comments=True)
+    for i, token in enumerate(tokens):
+        if token.endswith('.py'):
+            return tokens[i + 1:]
+    raise ValueError(f'no python script is called in {path}')
+
+
+class StageTimer(object):
+    """Seconds per pipeline stage spent in this process, summed over the decoder threads."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            s = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - s)
+        return timed
+
+    def pop(self):
+        with self.lock:
+            seconds, self.seconds = dict(self.seconds), defaultdict(float)
+        return seconds
+
+
+class _TimedIndex(object):
+    # `dataset_prog.cap_list` with the record lookups timed
+    def __init__(self, cap_list, timer):
+        self.cap_list = cap_list
+        self.timer = timer
+
+    def __len__(self):
+        return len(self.cap_list)
+
+    def __getitem__(self, idx):
+        s = time.perf_counter()
+        record = self.cap_list[idx]
+        self.timer.add('index', time.perf_counter() - s)
+        return record
+
+    def __getattr__(self, name):
+        return getattr(self.cap_list, name)
+
+
+class _TimedCollate(object):
+    # runs in the dataloader workers, and hands their stage times and RSS to the main process with every batch
+    def __init__(self, collate, timer):
+        self.collate = collate
+        self.timer = timer
+
+    def __call__(self, batch):
+        s = time.perf_counter()
+        out = self.collate(batch)
+        self.timer.add('collate', time.perf_counter() - s)
+        return out, dict(stages=self.timer.pop(), pid=os.getpid(), rss=_rss_mb(), num_samples=len(batch))
+
+
+def _rss_mb():
+    """VmRSS of this process in MB, Linux only."""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def bench_loader(args):
+    """
+    Throughput of `getdataset` + `LengthGroupedSampler` (or `TokenBudgetBatchSampler`) + `Collate` in a DataLoader,
+    with the time per stage, the worker RSS and how long the training loop waits for each batch. `--step_time`
+    simulates the compute of a training step, so the wait is what a real run would stall on.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from opensora.dataset import getdataset
+    from opensora.dataset import t2v_datasets
+    from opensora.models.causalvideovae import ae_stride_config
+    from opensora.utils.dataset_utils import LengthGroupedSampler, TokenBudgetBatchSampler, Collate, bucket_num_tokens
+
+    if args.config is not None:
+        # the flags given here override the ones of the launch script
+        args = args.parser.parse_known_args(config_tokens(args.config) + sys.argv[2:])[0]
+    if args.data is None or args.synthetic:
+        root = args.work_dir or tempfile.mkdtemp(prefix='opensora_loader_')
+        args.data = make_synthetic_corpus(root, args.num_videos, args.num_images, seed=args.seed)
+    args.ae_stride_t, args.ae_stride_h, args.ae_stride_w = ae_stride_config[args.ae]
+    args.ae_stride = args.ae_stride_h
+    args.patch_size_t, args.patch_size_h, args.patch_size_w = [int(i) for i in args.model[-3:]]
+    args.patch_size = args.patch_size_h
+    args.total_batch_size = args.train_batch_size * args.gradient_accumulation_steps
+    if args.max_hxw is not None and args.min_hxw is None:
+        args.min_hxw = args.max_hxw // 4
+    args.dataset, args.sp_size, args.dataloader_num_workers = 't2v', 1, args.num_workers
+
+    dataset = getdataset(args)
+    timer = StageTimer()
+    t2v_datasets.dataset_prog.cap_list = _TimedIndex(t2v_datasets.dataset_prog.cap_list, timer)
+    dataset.decord_read = timer.wrap('decode', dataset.decord_read)
+    dataset.opencv_read = timer.wrap('decode', dataset.opencv_read)
+    t2v_datasets.open_image = timer.wrap('decode', t2v_datasets.open_image)
+    dataset.transform = timer.wrap('transform', dataset.transform)
+    dataset.get_text_inputs = timer.wrap('tokenize', dataset.get_text_inputs)
+    collate = _TimedCollate(Collate(args), timer)
+
+    loader_kwargs = dict(num_workers=args.num_workers, collate_fn=collate, pin_memory=args.pin_memory)
+    if args.num_workers > 0:
+        loader_kwargs['prefetch_factor'] = args.prefetch_factor
+    if args.token_budget is not None:
+        sampler = TokenBudgetBatchSampler(
+            args.token_budget, world_size=1, gradient_accumulation_size=args.gradient_accumulation_steps,
+            initial_global_step=0, lengths=dataset.lengths, ae_stride_thw=(args.ae_stride_t, args.ae_stride_h, args.ae_stride_w),
+            patch_size_thw=(args.patch_size_t, args.patch_size_h, args.patch_size_w), max_batch_size=args.max_batch_size,
+            seed=args.seed,
+            )
+        dataloader = DataLoader(dataset, batch_sampler=sampler, **loader_kwargs)
+        dataset.set_sample_order(sampler)
+    else:
+        sampler = LengthGroupedSampler(
+            args.train_batch_size, world_size=1, gradient_accumulation_size=args.gradient_accumulation_steps,
+            initial_global_step=0, lengths=dataset.lengths, group_data=args.group_data, seed=args.seed,
+            )
+        dataloader = DataLoader(dataset, sampler=sampler, batch_size=args.train_batch_size, drop_last=True, **loader_kwargs)
+        dataset.set_sample_order(sampler)
+
+    stages, waits, worker_rss = defaultdict(float), [], {}
+    num_samples, num_tokens, num_batches = 0, 0, 0
+    tokens_per_patch = args.patch_size_t * args.patch_size_h * args.patch_size_w
+    s = time.perf_counter()
+    loader_iter = iter(dataloader)
+    for step in range(args.warmup_steps + args.num_steps):
+        t = time.perf_counter()
+        try:
+            batch, info = next(loader_iter)
+        except StopIteration:
+            print(f'the sampler ran out after {step} steps')
+            break
+        wait = time.perf_counter() - t
+        worker_rss[info['pid']] = max(worker_rss.get(info['pid'], 0.0), info['rss'])
+        if step == args.warmup_steps:
+            s = time.perf_counter() - wait
+        if step >= args.warmup_steps:
+            waits.append(wait)
+            for stage, seconds in info['stages'].items():
+                stages[stage] += seconds
+            num_samples += info['num_samples']
+            num_tokens += int(batch[1].sum()) // tokens_per_patch  # attention mask in latent units
+            num_batches += 1
+        if args.step_time > 0:
+            time.sleep(args.step_time)  # the training step the loader has to keep up with
+    e = time.perf_counter()
+    if num_batches == 0:
+        return
+
+    print(f'{num_batches} batches, {num_samples} samples in {e - s:.1f}s: {num_samples / (e - s):.2f} samples/s, '
+          f'{num_tokens / (e - s):.0f} tokens/s, {num_batches / (e - s):.2f} batches/s')
+    print('per stage, summed over the decoder threads of all workers:')
+    for stage in ['index', 'decode', 'transform', 'tokenize']:
+        print(f'  {stage:>10}: {stages.get(stage, 0.0) / num_samples * 1000:8.2f}ms per sample')
+    print(f"  {'collate':>10}: {stages.get('collate', 0.0) / num_batches * 1000:8.2f}ms per batch")
+    waits = np.array(waits) * 1000
+    stalled = waits > args.stall_ms
+    print(f'data wait per step: mean {waits.mean():.1f}ms, p50 {np.percentile(waits, 50):.1f}ms, '
+          f'p90 {np.percentile(waits, 90):.1f}ms, p99 {np.percentile(waits, 99):.1f}ms, max {waits.max():.1f}ms; '
+          f'{stalled.mean() * 100:.1f}% of steps stalled > {args.stall_ms}ms, {waits[stalled].sum() / 1000:.1f}s in total')
+    rss = list(worker_rss.values())
+    print(f'RSS: main {_rss_mb():.0f}MB, {len(rss)} workers max {max(rss):.0f}MB, sum {sum(rss):.0f}MB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    p = subparsers.add_parser('frame_index', help='parity and speed of the vectorized define_frame_index')
+    p.add_argument('--num_samples', type=int, default=100000)
+    p.add_argument('--num_frames', type=int, default=93)
+    p.add_argument('--max_hxw', type=int, default=384*384)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--work_dir', type=str, default=None)
+    p.set_defaults(func=bench_frame_index)
+
+    p = subparsers.add_parser('sampler', help='batches of the samplers after the rank sharding of accelerate.prepare')
+    p.add_argument('--num_images', type=int, default=40)
+    p.add_argument('--num_videos', type=int, default=12)
+    p.add_argument('--world_size', type=int, default=2)
+    p.add_argument('--token_budget', type=int, default=4096)
+    p.add_argument('--train_batch_size', type=int, default=2)
+    p.add_argument('--resume_cursor', type=int, default=5)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_sampler)
+
+    p = subparsers.add_parser('frame_index_memory', help='worker memory of sample_frame_index lists vs (start, interval, count)')
+    p.add_argument('--num_samples', type=int, default=1000000)
+    p.add_argument('--num_frames', type=int, default=93)
+    p.add_argument('--num_workers', type=int, default=4)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_frame_index_memory)
+
+    p = subparsers.add_parser('cap_list_memory', help='worker memory of a python cap_list vs the shared-memory store')
+    p.add_argument('--num_samples', type=int, default=1000000)
+    p.add_argument('--num_frames', type=int, default=93)
+    p.add_argument('--num_workers', type=int, default=4)
+    p.add_argument('--num_steps', type=int, default=1000000)
+    p.add_argument('--num_reports', type=int, default=4)
+    p.add_argument('--max_growth_mb', type=float, default=16)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_cap_list_memory)
+
+    p = subparsers.add_parser('opencv_read', help='seek-per-frame vs sequential OpenCV reads vs decord on synthetic clips')
+    p.add_argument('--num_videos', type=int, default=8)
+    p.add_argument('--video_frames', type=int, default=240)
+    p.add_argument('--num_frames', type=int, default=93)
+    p.add_argument('--frame_interval', type=float, default=1.0)
+    p.add_argument('--height', type=int, default=480)
+    p.add_argument('--width', type=int, default=640)
+    p.add_argument('--repeats', type=int, default=1)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--work_dir', type=str, default=None)
+    p.set_defaults(func=bench_opencv_read)
+
+    p = subparsers.add_parser('transform', help='CPU time and peak memory of the float vs uint8 t2v resize chain')
+    p.add_argument('--num_clips', type=int, default=4)
+    p.add_argument('--num_frames', type=int, default=33)
+    p.add_argument('--height', type=int, default=1080)
+    p.add_argument('--width', type=int, default=1920)
+    p.add_argument('--max_hxw', type=int, default=384*384)
+    p.add_argument('--hw_stride', type=int, default=32)
+    p.add_argument('--force_resolution', action='store_true')
+    p.add_argument('--max_height', type=int, default=480)
+    p.add_argument('--max_width', type=int, default=640)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_transform)
+
+    p = subparsers.add_parser('loader', help='throughput, stage times, worker RSS and data wait of the t2v DataLoader')
+    p.add_argument('--config', type=str, default=None, help='launch script to take the training flags from')
+    p.add_argument('--synthetic', action='store_true', help='use the synthetic corpus even if --data is given')
+    p.add_argument('--num_videos', type=int, default=48)
+    p.add_argument('--num_images', type=int, default=96)
+    p.add_argument('--num_steps', type=int, default=100)
+    p.add_argument('--warmup_steps', type=int, default=5)
+    p.add_argument('--step_time', type=float, default=0.0, help='seconds a simulated training step takes')
+    p.add_argument('--stall_ms', type=float, default=1.0)
+    p.add_argument('--num_workers', '--dataloader_num_workers', dest='num_workers', type=int, default=4)
+    p.add_argument('--prefetch_factor', type=int, default=2)
+    p.add_argument('--pin_memory', action='store_true')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--work_dir', type=str, default=None)
+    # the training flags the loader depends on
+    p.add_argument('--data', type=str, default=None)
+    p.add_argument('--model', type=str, default='OpenSoraT2V_v1_3-2B/122')
+    p.add_argument('--ae', type=str, default='WFVAEModel_D8_4x8x8')
+    p.add_argument('--text_encoder_name_1', type=str, default='google/mt5-xxl')
+    p.add_argument('--text_encoder_name_2', type=str, default=None)
+    p.add_argument('--cache_dir', type=str, default='./cache_dir')
+    p.add_argument('--model_max_length', type=int, default=512)
+    p.add_argument('--cfg', type=float, default=0.1)
+    p.add_argument('--num_frames', type=int, default=33)
+    p.add_argument('--train_fps', type=int, default=16)
+    p.add_argument('--speed_factor', type=float, default=1.0)
+    p.add_argument('--drop_short_ratio', type=float, default=1.0)
+    p.add_argument('--max_height', type=int, default=480)
+    p.add_argument('--max_width', type=int, default=640)
+    p.add_argument('--max_hxw', type=int, default=None)
+    p.add_argument('--min_hxw', type=int, default=None)
+    p.add_argument('--hw_stride', type=int, default=32)
+    p.add_argument('--force_resolution', action='store_true')
+    p.add_argument('--use_decord', action='store_true')
+    p.add_argument('--group_data', action='store_true')
+    p.add_argument('--train_batch_size', type=int, default=4)
+    p.add_argument('--gradient_accumulation_steps', type=int, default=1)
+    p.add_argument('--token_budget', type=int, default=None)
+    p.add_argument('--max_batch_size', type=int, default=None)
+    p.add_argument('--meta_index_dir', type=str, default=None)
+    p.add_argument('--token_cache_dir', type=str, default=None)
+    p.add_argument('--decode_threads', type=int, default=4)
+    p.add_argument('--decode_prefetch_batches', type=int, default=1)
+    p.add_argument('--decoder_cache_size', type=int, default=32)
+    p.add_argument('--decoder_cache_mb', type=int, default=2048)
+    p.add_argument('--windows_per_clip', type=int, default=1)
+    p.add_argument('--use_img_from_vid', action='store_true')
+    p.add_argument('--window_reservoir_mb', type=int, default=2048)
+    p.add_argument('--max_windows_per_batch', type=int, default=1)
+    p.set_defaults(func=bench_loader, parser=p)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
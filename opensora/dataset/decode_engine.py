@@ -0,0 +1,411 @@
+import os
+import json
+import math
+import time
+import heapq
+import random
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from torch.utils.data import get_worker_info
+
+from opensora.dataset.quarantine import QuarantineLedger, is_transient
+
+
+class LatencyHistogram(object):
+    """Decode latency counts in power-of-two millisecond buckets, plus the `top_k` slowest files."""
+
+    num_buckets = 20  # < 1ms, < 2ms, ..., >= 2**18ms
+
+    def __init__(self, top_k=32):
+        self.counts = [0] * self.num_buckets
+        self.total = 0.0
+        self.top_k = top_k
+        self.slowest = []  # min-heap of (seconds, path)
+
+    def add(self, path, seconds):
+        ms = seconds * 1000.0
+        bucket = 0 if ms < 1.0 else min(int(math.log2(ms)) + 1, self.num_buckets - 1)
+        self.counts[bucket] += 1
+        self.total += seconds
+        self.add_slowest(seconds, path)
+
+    def merge(self, state):
+        self.counts = [a + b for a, b in zip(self.counts, state['counts'])]
+        self.total += state['total']
+        for seconds, path in state['slowest']:
+            self.add_slowest(seconds, path)
+
+    def add_slowest(self, seconds, path):
+        if len(self.slowest) < self.top_k:
+            heapq.heappush(self.slowest, (seconds, path))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, path))
+
+    def state_dict(self):
+        return dict(counts=self.counts, total=self.total, slowest=sorted(self.slowest, reverse=True))
+
+    def percentile(self, q):
+        """Upper edge (ms) of the bucket holding the `q` quantile."""
+        n = sum(self.counts)
+        if n == 0:
+            return 0.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * n:
+                return float(2 ** bucket)
+        return float(2 ** (self.num_buckets - 1))
+
+    def report(self):
+        n = sum(self.counts)
+        lines = [f'{n} files, mean {self.total / max(n, 1) * 1000:.1f}ms, '
+                 f'p50 < {self.percentile(0.5):.0f}ms, p90 < {self.percentile(0.9):.0f}ms, p99 < {self.percentile(0.99):.0f}ms']
+        for bucket, count in enumerate(self.counts):
+            if count > 0:
+                lo = 0 if bucket == 0 else 2 ** (bucket - 1)
+                lines.append(f'  [{lo:>6}, {2 ** bucket:>6}) ms: {count:>8} {"#" * int(math.ceil(50 * count / n))}')
+        lines.append('  slowest:')
+        for seconds, path in sorted(self.slowest, reverse=True)[:10]:
+            lines.append(f'    {seconds * 1000:>10.1f}ms {path}')
+        return '\n'.join(lines)
+
+
+class WindowReservoir(object):
+    """
+    Extra samples cut from clips that were decoded anyway (other frame windows, still frames), by bucket shape. A
+    random one is handed out in place of a sample of the same shape, skipping those of clips the batch already has
+    `max_per_clip` samples of. At most `max_mb` are held, the oldest samples are dropped first.
+    """
+
+    def __init__(self, max_mb, max_per_clip=1):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_per_clip = max_per_clip
+        self.shapes = {}  # shape -> {key: (path, sample, nbytes)}
+        self.order = OrderedDict()  # key -> shape, oldest first
+        self.nbytes = 0
+        self.next_key = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def put(self, shape, path, sample):
+        nbytes = sum(v.numel() * v.element_size() for v in sample.values() if hasattr(v, 'element_size'))
+        key, self.next_key = self.next_key, self.next_key + 1
+        self.shapes.setdefault(shape, {})[key] = (path, sample, nbytes)
+        self.order[key] = shape
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.order) > 0:
+            key, shape = self.order.popitem(last=False)
+            self.nbytes -= self.shapes[shape].pop(key)[2]
+
+    def take(self, shape, clip_counts):
+        """A `(path, sample)` of `shape` whose clip is in `clip_counts` (the batch so far) less than `max_per_clip` times."""
+        items = self.shapes.get(shape, None)
+        if not items:
+            return None
+        keys = list(items)
+        for key in random.sample(keys, min(len(keys), 8)):
+            if clip_counts[items[key][0]] < self.max_per_clip:
+                path, sample, nbytes = items.pop(key)
+                del self.order[key]
+                self.nbytes -= nbytes
+                return path, sample
+        return None
+
+
+class DecodeEngine(object):
+    """
+    Fetches dataset samples for a DataLoader worker with a pool of `num_threads` decoder threads (decord, OpenCV and
+    the torch transforms release the GIL). A whole batch is decoded concurrently, and when the sampler was handed over
+    with `set_order`, the next `prefetch_batches` batches this worker will receive are submitted ahead of time. The
+    batches are looked up in the sampler's megabatches on demand, so nothing is computed for the whole epoch. The
+    stride between the batches of a worker (num_workers * num_processes) is learnt from the batches it gets, so
+    nothing about the DataLoader layout is assumed; a batch that is not where it was expected just disables the
+    look-ahead until the position is found again.
+
+    A failing sample is replaced by a random sample of the same shape, in a bounded loop instead of recursion. A
+    transient error (an IO error, see `is_transient`) is first retried `io_retries` times on the same file. Failures go
+    into the `quarantine` ledger with the reason and the seconds lost, which skips a file after one decode error or a
+    few transient ones.
+    Per-file decode latencies go into a `LatencyHistogram`, dumped every `stats_interval` samples to `stats_dir`.
+    The samples of the `read_ahead_batches` batches after the prefetched ones go to `dataset.read_ahead`, which can
+    stage their files from remote storage.
+
+    With `reservoir_mb > 0`, the `extra_samples` a sample comes with (more windows of the same decoded clip) go into a
+    `WindowReservoir`, and a batch is submitted with samples of the reservoir in place of those of the same shape
+    it would decode, at most `max_windows_per_batch` from one clip.
+    """
+
+    def __init__(self, dataset, num_threads=4, prefetch_batches=1, timeout=60, max_retries=16, io_retries=2,
+                 quarantine=None, stats_dir=None, stats_interval=500, read_ahead_batches=0, reservoir_mb=0,
+                 max_windows_per_batch=1, search_megabatches=64):
+        self.dataset = dataset
+        self.num_threads = num_threads
+        self.prefetch_batches = prefetch_batches
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.io_retries = io_retries
+        self.quarantine = quarantine if quarantine is not None else QuarantineLedger()
+        self.stats_dir = stats_dir
+        self.stats_interval = stats_interval
+        self.read_ahead_batches = read_ahead_batches
+        self.reservoir_mb = reservoir_mb
+        self.max_windows_per_batch = max_windows_per_batch
+        self.search_megabatches = search_megabatches
+        self.sampler = None
+        self.histogram = LatencyHistogram()
+        self.num_failures = 0
+        self._pid = None
+
+    def set_order(self, sampler):
+        """
+        The `LengthGroupedSampler` or `TokenBudgetBatchSampler` the DataLoader draws from. Its DataLoader batches are
+        the rows of `sampler.megabatch(k)` (one per rank) from megabatch `sampler.cursor` on.
+        """
+        self.sampler = sampler
+
+    def _start(self):
+        # threads do not survive the fork into DataLoader workers, so every process builds its own pool
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self.lock = threading.Lock()
+            self.pending = {}  # batch position -> futures
+            self.cursor, self.stride = None, None
+            self.num_fetched = 0
+            self.num_reused = 0
+            self.reservoir = WindowReservoir(self.reservoir_mb, self.max_windows_per_batch) if self.reservoir_mb > 0 else None
+            self.order_key = None
+
+    def _sync_order(self):
+        # a new epoch or a resumed cursor starts the batch positions over
+        key = (self.sampler.seed, self.sampler.epoch, self.sampler.cursor)
+        if key != self.order_key:
+            self.order_key = key
+            self.first_megabatch = self.sampler.cursor
+            self.num_batches = self.sampler.num_batches()
+            self.megabatches = OrderedDict()  # the few megabatches around the cursor
+            self.cursor, self.stride = None, None
+            for futures in self.pending.values():
+                for _, future in futures:
+                    future.cancel()
+            self.pending = {}
+
+    def _megabatch(self, k):
+        if k not in self.megabatches:
+            if len(self.megabatches) >= 16:
+                self.megabatches.popitem(last=False)
+            self.megabatches[k] = self.sampler.megabatch(self.first_megabatch + k)
+        return self.megabatches[k]
+
+    def _batch(self, pos):
+        """The batch at position `pos` of the DataLoader order."""
+        return self._megabatch(pos // self.sampler.world_size)[pos % self.sampler.world_size]
+
+    def _timed_get(self, idx):
+        path = self.dataset.get_path(idx)
+        s = time.perf_counter()
+        try:
+            data = self.dataset.get_data(idx)
+        except Exception as e:
+            e.seconds = time.perf_counter() - s  # for the quarantine ledger
+            raise
+        with self.lock:
+            self.histogram.add(path, time.perf_counter() - s)
+        return data
+
+    def _replacement(self, idx):
+        index_cand = self.dataset.shape_idx_dict[self.dataset.sample_size[idx]]  # pick same shape
+        for _ in range(self.max_retries):
+            new_idx = random.choice(index_cand)
+            if self.dataset.get_path(new_idx) not in self.quarantine:
+                return new_idx
+        return random.choice(index_cand)
+
+    def _submit(self, idx):
+        if self.dataset.get_path(idx) in self.quarantine:
+            idx = self._replacement(idx)
+        return idx, self.executor.submit(self._timed_get, idx)
+
+    def _submit_batch(self, indices):
+        if self.reservoir is None or len(self.reservoir) == 0:
+            return [self._submit(int(i)) for i in indices]
+        paths = [self.dataset.get_path(int(i)) for i in indices]
+        clip_counts = Counter(paths)
+        submitted = []
+        for idx, path in zip(indices, paths):
+            taken = self.reservoir.take(self.dataset.sample_size[int(idx)], clip_counts)
+            if taken is None:
+                submitted.append(self._submit(int(idx)))
+                continue
+            clip_counts[path] -= 1  # the clip of the sampled index is not read
+            clip_counts[taken[0]] += 1
+            future = Future()
+            future.set_result(taken[1])
+            submitted.append((int(idx), future))
+            self.num_reused += 1
+        return submitted
+
+    def _resolve(self, idx, future):
+        io_retries = 0
+        for _ in range(self.max_retries + self.io_retries + 1):
+            try:
+                return future.result(timeout=self.timeout)
+            except Exception as e:
+                error = e
+            path = self.dataset.get_path(idx)
+            if not future.done():
+                if not future.running():
+                    # still queued behind a stuck decoder, which is not this file's fault
+                    future.cancel()
+                    idx, future = self._submit(idx)
+                    continue
+                self.num_failures += 1
+                print(f"Error with TimeoutError, {self.timeout}s timeout occur with {path}")
+                self.quarantine.add(path, 'TimeoutError', self.timeout, transient=True)
+                # the stuck thread can not be interrupted, so leave it to the old pool and decode on fresh threads
+                self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+                idx, future = self._submit(self._replacement(idx))
+                io_retries = 0
+                continue
+            self.num_failures += 1
+            print(f'Error with {error}')
+            transient = is_transient(error)
+            if transient and io_retries < self.io_retries:
+                io_retries += 1
+                time.sleep(0.5 * io_retries)
+                future = self.executor.submit(self._timed_get, idx)
+                continue
+            if not isinstance(error, KeyError):  # cache misses are not the file's fault
+                self.quarantine.add(path, f'{type(error).__name__}: {error}', getattr(error, 'seconds', 0.0), transient=transient)
+            idx, future = self._submit(self._replacement(idx))
+            io_retries = 0
+        raise RuntimeError(f'{self.max_retries} replacements of sample {idx} failed in a row')
+
+    def _locate(self, batch):
+        """
+        Position of `batch` in the sampler order at or after the cursor, None if it is not found. Every megabatch holds
+        one batch per rank, so the first batch of a DataLoader worker is within `search_megabatches` megabatches
+        as long as there are no more workers than that.
+        """
+        if self.sampler is None or len(batch) == 0:
+            return None
+        if self.cursor is not None and self.stride is not None:
+            expected = self.cursor + self.stride
+            if expected < self.num_batches and self._is_batch(expected, batch):
+                return expected
+        world_size = self.sampler.world_size
+        start = 0 if self.cursor is None else self.cursor + 1
+        num_megabatches = self.num_batches // world_size
+        for k in range(start // world_size, min(start // world_size + self.search_megabatches, num_megabatches)):
+            megabatch = self._megabatch(k)
+            for row in np.flatnonzero(megabatch[:, 0] == batch[0]):
+                pos = k * world_size + int(row)
+                if pos >= start and np.array_equal(megabatch[row], batch):
+                    return pos
+        return None
+
+    def _is_batch(self, pos, batch):
+        return np.array_equal(self._batch(pos), batch)
+
+    def _prefetch(self, pos):
+        for k in range(1, self.prefetch_batches + 1):
+            ahead = pos + k * self.stride
+            if ahead < self.num_batches and ahead not in self.pending:
+                self.pending[ahead] = self._submit_batch(self._batch(ahead))
+
+    def _read_ahead(self, pos):
+        ahead = range(
+            pos + (self.prefetch_batches + 1) * self.stride,
+            min(pos + (self.prefetch_batches + self.read_ahead_batches) * self.stride + 1, self.num_batches), self.stride
+            )
+        if len(ahead) > 0:
+            self.dataset.read_ahead(np.concatenate([self._batch(p) for p in ahead]))
+
+    def fetch(self, indices):
+        self._start()
+        if self.sampler is not None:
+            self._sync_order()
+        pos = self._locate(indices)
+        submitted = self.pending.pop(pos, None) if pos is not None else None
+        if submitted is None:
+            submitted = self._submit_batch(indices)
+        if pos is not None:
+            if self.cursor is not None and pos > self.cursor:
+                self.stride = pos - self.cursor
+            self.cursor = pos
+            for stale in [p for p in self.pending if p < pos]:  # the order moved on, drop what was never asked for
+                for _, future in self.pending.pop(stale):
+                    future.cancel()
+            if self.stride is not None and self.prefetch_batches > 0:
+                self._prefetch(pos)
+            if self.stride is not None and self.read_ahead_batches > 0:
+                self._read_ahead(pos)
+        data = [self._resolve(idx, future) for idx, future in submitted]
+        for sample in data:
+            for shape, path, extra in sample.pop('extra_samples', None) or []:
+                if self.reservoir is not None:
+                    self.reservoir.put(shape, path, extra)
+        self.num_fetched += len(data)
+        if self.stats_dir is not None and self.num_fetched // self.stats_interval != (self.num_fetched - len(data)) // self.stats_interval:
+            self.dump_stats()
+        return data
+
+    def dump_stats(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rank = int(os.environ.get('RANK', 0))
+        os.makedirs(self.stats_dir, exist_ok=True)
+        path = os.path.join(self.stats_dir, f'decode_stats.rank{rank:05d}.worker{worker_id:03d}.json')
+        with self.lock:
+            state = dict(
+                self.histogram.state_dict(), num_fetched=self.num_fetched, num_failures=self.num_failures, num_reused=self.num_reused
+                )
+        if getattr(self.dataset, 'virtual_disk', None) is not None:
+            state['virtual_disk'] = self.dataset.virtual_disk.stats()
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+
+
+if __name__ == "__main__":
+    '''
+    Merge the decode latency histograms dumped by the DataLoader workers (--decode_stats_dir):
+    python -m opensora.dataset.decode_engine --decode_stats_dir /path/to/decode_stats
+    '''
+    import glob
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--decode_stats_dir", type=str, required=True)
+    parser.add_argument("--per_rank", action='store_true')
+    args = parser.parse_args()
+
+    merged, per_rank, num_fetched, num_failures, num_reused = LatencyHistogram(), {}, 0, 0, 0
+    remote, remote_counts = LatencyHistogram(), {}
+    for path in sorted(glob.glob(os.path.join(args.decode_stats_dir, 'decode_stats.*.json'))):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        merged.merge(state)
+        rank = os.path.basename(path).split('.')[1]
+        per_rank.setdefault(rank, LatencyHistogram()).merge(state)
+        num_fetched, num_failures = num_fetched + state['num_fetched'], num_failures + state['num_failures']
+        num_reused += state.get('num_reused', 0)
+        if 'virtual_disk' in state:
+            remote.merge(state['virtual_disk'].pop('latency'))
+            for k, v in state['virtual_disk'].items():
+                remote_counts[k] = remote_counts.get(k, 0) + v
+    print(f'{num_fetched} samples fetched, {num_reused} of them reused frame windows, {num_failures} failures')
+    print(merged.report())
+    if len(remote_counts) > 0:
+        print(f"virtual disk: {remote_counts['num_hits']} hits, {remote_counts['num_misses']} misses "
+              f"({remote_counts['num_bytes'] / 1024 ** 3:.2f} GB), {remote_counts['num_retries']} retries, {remote_counts['num_failures']} failures")
+        print(remote.report())
+    if args.per_rank:
+        for rank, histogram in per_rank.items():
+            print(f'{rank}: {histogram.report().splitlines()[0]}')
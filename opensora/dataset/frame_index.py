@@ -0,0 +1,345 @@
+import os
+import gc
+import json
+import pickle
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+MEDIA_OTHER, MEDIA_VIDEO, MEDIA_IMAGE = 0, 1, 2
+
+# per-reason drop counters reported by define_frame_index
+COUNTER_KEYS = [
+    'cnt', 'cnt_vid', 'cnt_img', 'cnt_too_long', 'cnt_too_short', 'cnt_no_cap', 'cnt_no_resolution',
+    'cnt_no_aesthetic', 'cnt_img_res_mismatch_stride', 'cnt_vid_res_mismatch_stride', 'cnt_img_aspect_mismatch',
+    'cnt_vid_aspect_mismatch', 'cnt_img_res_too_small', 'cnt_vid_res_too_small', 'cnt_vid_after_filter',
+    'cnt_img_after_filter', 'cnt_filter_minority',
+]
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic GC while annotations are parsed: every collection would traverse all the record dicts read
+    so far again, and the records hold no cycles to collect anyway.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def read_annotations(data):
+    """
+    Yield `(sub_root, anno, sub_list)` for every line `sub_root,anno` of the `--data` txt.
+    """
+    with open(data, 'r') as f:
+        folder_anno = [i.strip().split(',') for i in f.readlines() if len(i.strip()) > 0]
+    for sub_root, anno in tqdm(folder_anno):
+        print(f'Building {anno}...')
+        if anno.endswith('.json'):
+            with open(anno, 'r') as f:
+                sub_list = json.load(f)
+        elif anno.endswith('.pkl'):
+            with open(anno, "rb") as f:
+                sub_list = pickle.load(f)
+        yield sub_root, anno, sub_list
+
+
+def _get(record, key):
+    value = record.get(key, None)
+    return np.nan if value is None else value
+
+
+def annotation_columns(sub_list, sub_root):
+    """
+    Gather the fields used by the filter and stored by the meta index into arrays, one python pass over the
+    records. Missing values are NaN (-1 for `crop`). `path` of every record is joined with `sub_root` in place.
+    """
+    n = len(sub_list)
+    media = np.zeros(n, dtype=np.int8)
+    has_cap = np.zeros(n, dtype=np.bool_)
+    height = np.full(n, np.nan, dtype=np.float64)
+    width = np.full(n, np.nan, dtype=np.float64)
+    fps = np.full(n, np.nan, dtype=np.float64)
+    num_frames = np.full(n, np.nan, dtype=np.float64)
+    aesthetic = np.full(n, np.nan, dtype=np.float64)
+    aes = np.full(n, np.nan, dtype=np.float64)
+    start_frame_idx = np.zeros(n, dtype=np.int64)
+    crop = np.full((n, 4), -1, dtype=np.int64)
+    for idx, i in enumerate(sub_list):
+        path = os.path.join(sub_root, i['path'])
+        i['path'] = path
+        if path.endswith('.mp4'):
+            media[idx] = MEDIA_VIDEO
+        elif path.endswith('.jpg'):
+            media[idx] = MEDIA_IMAGE
+        has_cap[idx] = i.get('cap', None) is not None
+        resolution = i.get('resolution', None)
+        if resolution is not None:
+            height[idx] = _get(resolution, 'height')
+            width[idx] = _get(resolution, 'width')
+        fps[idx] = _get(i, 'fps')
+        num_frames[idx] = _get(i, 'num_frames')
+        aesthetic[idx] = _get(i, 'aesthetic')
+        aes[idx] = _get(i, 'aes')
+        cut = i.get('cut', None)
+        if cut is not None:
+            start_frame_idx[idx] = cut[0]
+        if i.get('crop', None):
+            crop[idx] = i['crop']
+    return dict(
+        media=media, has_cap=has_cap, height=height, width=width, fps=fps, num_frames=num_frames,
+        aesthetic=aesthetic, aes=aes, start_frame_idx=start_frame_idx, crop=crop
+    )
+
+
+def concat_columns(columns_list):
+    if len(columns_list) == 0:
+        return annotation_columns([], '')
+    return {k: np.concatenate([c[k] for c in columns_list]) for k in columns_list[0].keys()}
+
+
+def frame_range_indices(sample_frame_range):
+    """
+    Expand a `(start_frame_idx, frame_interval, num_frames)` descriptor into the frame indices it stands for.
+    Records only keep the descriptor, so no per-frame Python ints live in `cap_list`.
+    """
+    start_frame_idx, frame_interval, num_frames = sample_frame_range
+    return (start_frame_idx + np.arange(num_frames) * frame_interval).astype(int)
+
+
+def closest_frame_table(max_num_frames, vae_stride_t=4, model_ds_t=1, min_num_frames=29):
+    """
+    Vectorized `find_closest_y`: table[x] is the largest y <= x that the videovae can encode exactly, else -1.
+    """
+    y = np.arange(max_num_frames + 1)
+    valid = (y >= min_num_frames) & ((y - 1) % vae_stride_t == 0) & (((y - 1) // vae_stride_t + 1) % model_ds_t == 0)
+    table = np.where(valid, y, -1)
+    return np.maximum.accumulate(table)
+
+
+class FrameIndexBuilder(object):
+    """
+    Batched NumPy version of the per-record filter in `T2V_dataset.define_frame_index`. It applies the caption,
+    resolution, stride, min/max hxw, aspect-ratio, too-long and too-short checks on whole annotation columns and
+    returns the kept rows with their bucket shape and the same per-reason counters.
+    """
+
+    def __init__(
+        self, num_frames, train_fps, speed_factor, max_height, max_width, max_hxw, min_hxw, hw_stride,
+        force_resolution, drop_short_ratio, ae_stride_t, sp_size, total_batch_size, hw_aspect_thr=2.0,
+        too_long_factor=5.0, generator=None,
+    ):
+        self.num_frames = num_frames
+        self.train_fps = train_fps
+        self.speed_factor = speed_factor
+        self.max_height = max_height
+        self.max_width = max_width
+        self.max_hxw = max_hxw
+        self.min_hxw = min_hxw
+        self.hw_stride = hw_stride
+        self.force_resolution = force_resolution
+        self.drop_short_ratio = drop_short_ratio
+        self.ae_stride_t = ae_stride_t
+        self.sp_size = sp_size
+        self.total_batch_size = total_batch_size
+        self.hw_aspect_thr = hw_aspect_thr
+        self.too_long_factor = too_long_factor
+        self.generator = generator
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        return cls(
+            num_frames=dataset.num_frames, train_fps=dataset.train_fps, speed_factor=dataset.speed_factor,
+            max_height=dataset.max_height, max_width=dataset.max_width, max_hxw=dataset.max_hxw,
+            min_hxw=dataset.min_hxw, hw_stride=dataset.hw_stride, force_resolution=dataset.force_resolution,
+            drop_short_ratio=dataset.drop_short_ratio, ae_stride_t=dataset.ae_stride_t, sp_size=dataset.sp_size,
+            total_batch_size=dataset.total_batch_size, hw_aspect_thr=dataset.hw_aspect_thr,
+            too_long_factor=dataset.too_long_factor, generator=dataset.generator,
+        )
+
+    def __call__(self, columns):
+        media = columns['media']
+        is_vid, is_img = media == MEDIA_VIDEO, media == MEDIA_IMAGE
+        n = len(media)
+        counters = dict.fromkeys(COUNTER_KEYS, 0)
+        counters.update(cnt=n, cnt_vid=int(is_vid.sum()), cnt_img=int(is_img.sum()))
+
+        # ======no aesthetic=====
+        has_aes = ~np.isnan(columns['aesthetic']) & ~np.isnan(columns['aes'])
+        counters['cnt_no_aesthetic'] = int(n - has_aes.sum())
+        aesthetic_score = np.where(columns['aesthetic'] != 0, columns['aesthetic'], columns['aes'])[has_aes]
+
+        # ======no caption=====
+        alive = columns['has_cap'].copy()
+        counters['cnt_no_cap'] = int(n - alive.sum())
+
+        # ======resolution mismatch=====
+        height, width = columns['height'], columns['width']
+        no_res = alive & (np.isnan(height) | np.isnan(width))
+        if not self.force_resolution:
+            no_res |= alive & ~no_res & ((height <= 0) | (width <= 0))
+        counters['cnt_no_resolution'] = int(no_res.sum())
+        alive &= ~no_res
+
+        sample_h = np.zeros(n, dtype=np.int64)
+        sample_w = np.zeros(n, dtype=np.int64)
+        if not self.force_resolution:
+            h, w = np.where(alive, height, 1), np.where(alive, width, 1)
+            scale = np.sqrt(self.max_hxw / (h * w))
+            resize = h * w > self.max_hxw
+            tr_h = np.where(resize, np.trunc(h * scale), h).astype(np.int64)
+            tr_w = np.where(resize, np.trunc(w * scale), w).astype(np.int64)
+            sample_h = tr_h // self.hw_stride * self.hw_stride
+            sample_w = tr_w // self.hw_stride * self.hw_stride
+
+            drop = alive & ((sample_h <= 0) | (sample_w <= 0))
+            counters['cnt_vid_res_mismatch_stride'] = int((drop & is_vid).sum())
+            counters['cnt_img_res_mismatch_stride'] = int((drop & is_img).sum())
+            alive &= ~drop
+
+            # filter min_hxw
+            drop = alive & (sample_h * sample_w < self.min_hxw)
+            counters['cnt_vid_res_too_small'] = int((drop & is_vid).sum())
+            counters['cnt_img_res_too_small'] = int((drop & is_img).sum())
+            alive &= ~drop
+
+            # filter aspect
+            ratio = sample_h / np.where(alive, sample_w, 1)
+            drop = alive & ~((ratio <= self.hw_aspect_thr) & (ratio >= 1 / self.hw_aspect_thr))
+        else:
+            aspect = self.max_height / self.max_width
+            ratio = height / np.where(alive, width, 1)
+            drop = alive & ~((ratio <= self.hw_aspect_thr * aspect) & (ratio >= 1 / self.hw_aspect_thr * aspect))
+            sample_h[:], sample_w[:] = self.max_height, self.max_width
+        counters['cnt_vid_aspect_mismatch'] = int((drop & is_vid).sum())
+        counters['cnt_img_aspect_mismatch'] = int((drop & is_img).sum())
+        alive &= ~drop
+
+        other = alive & ~is_vid & ~is_img
+        if other.any():
+            raise NameError(f"Unknown file extention of row {np.flatnonzero(other)[0]}, only support .mp4 for video and .jpg for image")
+
+        # ======temporal filter for videos=====
+        vid = alive & is_vid
+        if np.isnan(columns['num_frames'][vid]).any():
+            raise KeyError(f"num_frames is missing in row {np.flatnonzero(vid & np.isnan(columns['num_frames']))[0]}")
+        fps = np.where(np.isnan(columns['fps']), 24.0, columns['fps'])
+        clip_frames = np.where(vid, columns['num_frames'], 0)
+        too_long = vid & (clip_frames > self.too_long_factor * (self.num_frames * fps / self.train_fps * self.speed_factor))
+        counters['cnt_too_long'] = int(too_long.sum())
+        vid &= ~too_long
+
+        # resample in case high fps, such as 50/60/90/144 -> train_fps(e.g, 24)
+        frame_interval = np.where(np.abs(fps - self.train_fps) < 0.1, 1.0, fps / self.train_fps)
+        sample_t = np.maximum(np.ceil(clip_frames / frame_interval), 0).astype(np.int64)
+
+        # the legacy loop draws one random number per short video, in order, from the dataset generator
+        short = vid & (sample_t < self.num_frames)
+        drop = np.zeros(n, dtype=np.bool_)
+        num_short = int(short.sum())
+        if num_short > 0:
+            rand = torch.rand(num_short, generator=self.generator).numpy()
+            drop[short] = rand < self.drop_short_ratio
+
+        #  too long video will be temporal-crop, then find a suitable end_frame_idx
+        sample_t = np.minimum(sample_t, self.num_frames)
+        table = closest_frame_table(self.num_frames, vae_stride_t=self.ae_stride_t, model_ds_t=self.sp_size)
+        sample_t = np.where(vid, table[np.where(vid, sample_t, 0)], 1)
+        too_short = drop | (vid & (sample_t == -1))
+        counters['cnt_too_short'] = int(too_short.sum())
+        vid &= ~too_short
+
+        alive &= ~(is_vid & ~vid)
+        counters['cnt_vid_after_filter'] = int((alive & is_vid).sum())
+        counters['cnt_img_after_filter'] = int((alive & is_img).sum())
+
+        # ======filter minority shapes=====
+        rows = np.flatnonzero(alive)
+        shape_key = (sample_t[rows] << 40) | (sample_h[rows] << 20) | sample_w[rows]
+        keys, inverse, counts = np.unique(shape_key, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        names = [f"{k >> 40}x{(k >> 20) & 0xFFFFF}x{k & 0xFFFFF}" for k in keys.tolist()]
+        if not self.force_resolution and self.max_hxw is not None and self.min_hxw is not None:
+            hw = ((keys >> 20) & 0xFFFFF) * (keys & 0xFFFFF)
+            assert np.all(hw <= self.max_hxw) and np.all(hw >= self.min_hxw)
+        major = counts[inverse] >= 4 * self.total_batch_size
+        counters['cnt_filter_minority'] = int(len(rows) - major.sum())
+        rows, inverse = rows[major], inverse[major]
+
+        return dict(
+            rows=rows,
+            sample_height=sample_h[rows],
+            sample_width=sample_w[rows],
+            sample_num_frames=sample_t[rows],
+            frame_interval=frame_interval[rows],
+            bucket=inverse,
+            bucket_names=names,
+            counters=counters,
+            aesthetic_score=aesthetic_score,
+        )
+
+
+def kept_columns(columns, frame_index):
+    """
+    The columns of the samples kept by `FrameIndexBuilder`, with what it derived for them, in the layout of
+    `write_meta_index`: the meta index is then written without reading the records field by field again.
+    """
+    rows = frame_index['rows']
+    is_video = columns['media'][rows] == MEDIA_VIDEO
+    return dict(
+        is_video=is_video,
+        height=columns['height'][rows].astype(np.int32),
+        width=columns['width'][rows].astype(np.int32),
+        sample_height=frame_index['sample_height'].astype(np.int32),
+        sample_width=frame_index['sample_width'].astype(np.int32),
+        fps=columns['fps'][rows].astype(np.float32),
+        num_frames=np.nan_to_num(columns['num_frames'][rows], nan=-1).astype(np.int32),
+        start_frame_idx=np.where(is_video, columns['start_frame_idx'][rows], 0).astype(np.int32),
+        frame_interval=np.where(is_video, frame_index['frame_interval'], 1.0),
+        sample_num_frames=frame_index['sample_num_frames'].astype(np.int32),
+        crop=columns['crop'][rows].astype(np.int32),
+        aesthetic=columns['aesthetic'][rows],
+        aes=columns['aes'][rows],
+    )
+
+
+def shape_idx_dict_from_buckets(bucket, bucket_names):
+    """{shape: [idx, ...]} of the kept samples, in index order."""
+    order = np.argsort(bucket, kind='stable')
+    splits = np.cumsum(np.bincount(bucket, minlength=len(bucket_names)))[:-1]
+    return {
+        bucket_names[b]: idx.tolist() for b, idx in enumerate(np.split(order, splits)) if len(idx) > 0
+    }
+
+
+def report_frame_index(counters, sample_size, aesthetic_score, calculate_statistics):
+    counter = Counter(sample_size)
+    c = counters
+    num_kept = len(sample_size)
+    print(f"no_cap: {c['cnt_no_cap']}, no_resolution: {c['cnt_no_resolution']}\n"
+            f"too_long: {c['cnt_too_long']}, too_short: {c['cnt_too_short']}\n"
+            f"cnt_img_res_mismatch_stride: {c['cnt_img_res_mismatch_stride']}, cnt_vid_res_mismatch_stride: {c['cnt_vid_res_mismatch_stride']}\n"
+            f"cnt_img_res_too_small: {c['cnt_img_res_too_small']}, cnt_vid_res_too_small: {c['cnt_vid_res_too_small']}\n"
+            f"cnt_img_aspect_mismatch: {c['cnt_img_aspect_mismatch']}, cnt_vid_aspect_mismatch: {c['cnt_vid_aspect_mismatch']}\n"
+            f"cnt_filter_minority: {c['cnt_filter_minority']}\n"
+            f"Counter(sample_size): {counter}\n"
+            f"cnt_vid: {c['cnt_vid']}, cnt_vid_after_filter: {c['cnt_vid_after_filter']}, use_ratio: {round(c['cnt_vid_after_filter']/(c['cnt_vid']+1e-6), 5)*100}%\n"
+            f"cnt_img: {c['cnt_img']}, cnt_img_after_filter: {c['cnt_img_after_filter']}, use_ratio: {round(c['cnt_img_after_filter']/(c['cnt_img']+1e-6), 5)*100}%\n"
+            f"before filter: {c['cnt']}, after filter: {num_kept}, use_ratio: {round(num_kept/(c['cnt']+1e-6), 5)*100}%")
+
+    if len(aesthetic_score) > 0:
+        stats_aesthetic = calculate_statistics(aesthetic_score)
+        print(f"before filter: {c['cnt']}, after filter: {num_kept}\n"
+            f"aesthetic_score: {len(aesthetic_score)}, cnt_no_aesthetic: {c['cnt_no_aesthetic']}\n"
+            f"{int((aesthetic_score >= 5.75).sum())} > 5.75, 4.5 > {int((aesthetic_score <= 4.5).sum())}\n"
+            f"Mean: {stats_aesthetic['mean']}, Var: {stats_aesthetic['variance']}, Std: {stats_aesthetic['std_dev']}\n"
+            f"Min: {stats_aesthetic['min']}, Max: {stats_aesthetic['max']}")
@@ -33,9 +33,10 @@ import decord
 from opensora.utils.dataset_utils import DecordInit
 from opensora.utils.utils import text_preprocessing
 from opensora.dataset.transform import get_params, maxhwresize, add_masking_notice, calculate_statistics, \
-    add_aesthetic_notice_image, add_aesthetic_notice_video
+    add_aesthetic_notice_image, add_aesthetic_notice_video, masking_notice_variants, aesthetic_notice_variants_image, \
+    aesthetic_notice_variants_video
 from opensora.utils.mask_utils import MaskProcessor, STR_TO_TYPE
-from opensora.dataset.t2v_datasets import T2V_dataset, DataSetProg
+from opensora.dataset.t2v_datasets import T2V_dataset, DataSetProg, open_image
 
 logger = get_logger(__name__)
 
@@ -51,6 +52,10 @@ def type_ratio_normalize(mask_type_ratio_dict):
     return {k: v / total for k, v in mask_type_ratio_dict.items()}
 
 class Inpaint_dataset(T2V_dataset):
+    default_text_image = "The image showcases a scene with coherent and clear visuals."
+    default_text_video = "The video showcases a scene with coherent and clear visuals."
+    constant_texts = [('', False), (default_text_image, False), (default_text_video, False)]
+
     def __init__(self, args, resize_transform, transform, temporal_sample, tokenizer_1, tokenizer_2):
         super().__init__(
             args=args, 
@@ -82,31 +87,14 @@ class Inpaint_dataset(T2V_dataset):
         )
 
         self.default_text_ratio = args.default_text_ratio
+        # inpaint samples are not bounded by the decode timeout
+        self.decode_engine.timeout = None
 
-    def __getitem__(self, idx):
-        try:
-            # future = self.executor.submit(self.get_data, idx)
-            # data = future.result(timeout=self.timeout) 
-            # return data
-            return self.get_data(idx)
-        except Exception as e:
-            # if len(str(e)) < 2:
-            #     e = f"TimeoutError, {self.timeout}s timeout occur with {dataset_prog.cap_list[idx]['path']}"
-            print(f'Error with {e}')
-            index_cand = self.shape_idx_dict[self.sample_size[idx]]  # pick same shape
-            return self.__getitem__(random.choice(index_cand))
-            # return self.__getitem__(idx)
-    
     def get_data(self, idx):
         path = dataset_prog.cap_list[idx]['path']
-        if not os.path.exists(path):
-            print(f"file {path} do not exist, random choice a new one with same shape!")
-            index_cand = self.shape_idx_dict[self.sample_size[idx]]
-            return self.__getitem__(random.choice(index_cand))
-        if path.endswith('.mp4'):
-            return self.get_video(idx)
-        else:
-            return self.get_image(idx)
+        if self.virtual_disk is None and not os.path.exists(path):
+            raise FileNotFoundError(f"file {path} does not exist")
+        return self.get_record_data(dataset_prog.cap_list[idx])
 
     def drop(self, text, is_video=True):
         rand_num = random.random()
@@ -115,22 +103,21 @@ class Inpaint_dataset(T2V_dataset):
         if rand_num < self.cfg:
             if rand_num_text < self.default_text_ratio:
                 if not is_video:
-                    text = "The image showcases a scene with coherent and clear visuals." 
+                    text = self.default_text_image
                 else:
-                    text = "The video showcases a scene with coherent and clear visuals." 
+                    text = self.default_text_video
             else:
                 text = ''
 
         return dict(text=text)
     
-    def get_video(self, idx):
+    def get_video(self, video_data):
         # npu_config.print_msg(f"current idx is {idx}")
         # video = random.choice([random_video_noise(65, 3, 336, 448), random_video_noise(65, 3, 1024, 1024), random_video_noise(65, 3, 360, 480)])
         # # print('random shape', video.shape)
         # input_ids = torch.ones(1, 120).to(torch.long).squeeze(0)
         # cond_mask = torch.cat([torch.ones(1, 60).to(torch.long), torch.ones(1, 60).to(torch.long)], dim=1).squeeze(0)
         # logger.info(f'Now we use t2v dataset {idx}')
-        video_data = dataset_prog.cap_list[idx]
         video_path = video_data['path']
         # assert os.path.exists(video_path), f"file {video_path} do not exist!"
         sample_h = video_data['resolution']['sample_height']
@@ -164,45 +151,20 @@ class Inpaint_dataset(T2V_dataset):
             aes = video_data.get('aesthetic', None) or video_data.get('aes', None)
             text = [add_aesthetic_notice_video(text[0], aes)]
 
+        # video captions are tokenized without text_preprocessing
         text = self.drop(text, is_video=True)['text']
+        if isinstance(text, list):
+            text_inputs = self.get_text_inputs(text[0], clean=False)
+        else:
+            text_inputs = self.get_text_inputs(text, clean=False)
 
-        text_tokens_and_mask_1 = self.tokenizer_1(
-            text,
-            max_length=self.model_max_length,
-            padding='max_length',
-            truncation=True,
-            return_attention_mask=True,
-            add_special_tokens=True,
-            return_tensors='pt'
-        )
-        input_ids_1 = text_tokens_and_mask_1['input_ids']
-        cond_mask_1 = text_tokens_and_mask_1['attention_mask']
-        
-        input_ids_2, cond_mask_2 = None, None
-        if self.tokenizer_2 is not None:
-            text_tokens_and_mask_2 = self.tokenizer_2(
-                text,
-                max_length=self.tokenizer_2.model_max_length,
-                padding='max_length',
-                truncation=True,
-                return_attention_mask=True,
-                add_special_tokens=True,
-                return_tensors='pt'
-            )
-            input_ids_2 = text_tokens_and_mask_2['input_ids']
-            cond_mask_2 = text_tokens_and_mask_2['attention_mask']
-
-        return dict(
-            pixel_values=video, input_ids_1=input_ids_1, cond_mask_1=cond_mask_1, 
-            input_ids_2=input_ids_2, cond_mask_2=cond_mask_2,
-            )
-
-    def get_image(self, idx):
-        image_data = dataset_prog.cap_list[idx]  # [{'path': path, 'cap': cap}, ...]
+        return dict(pixel_values=video, **text_inputs)
+
+    def get_image(self, image_data):
         sample_h = image_data['resolution']['sample_height']
         sample_w = image_data['resolution']['sample_width']
 
-        image = Image.open(image_data['path']).convert('RGB')  # [h, w, c]
+        image = open_image(image_data).convert('RGB')  # [h, w, c]
         image = torch.from_numpy(np.array(image))  # [h, w, c]
         image = rearrange(image, 'h w c -> c h w').unsqueeze(0)  #  [1 c h w]
 
@@ -227,36 +189,27 @@ class Inpaint_dataset(T2V_dataset):
         if image_data.get('aesthetic', None) is not None or image_data.get('aes', None) is not None:
             aes = image_data.get('aesthetic', None) or image_data.get('aes', None)
             caps = [add_aesthetic_notice_image(caps[0], aes)]
-        text = text_preprocessing(caps, support_Chinese=self.support_Chinese)
-        text = self.drop(text, is_video=False)['text']
-
-        text_tokens_and_mask_1 = self.tokenizer_1(
-            text,
-            max_length=self.model_max_length,
-            padding='max_length',
-            truncation=True,
-            return_attention_mask=True,
-            add_special_tokens=True,
-            return_tensors='pt'
-        )
-        input_ids_1 = text_tokens_and_mask_1['input_ids']  # 1, l
-        cond_mask_1 = text_tokens_and_mask_1['attention_mask']  # 1, l
-        
-        input_ids_2, cond_mask_2 = None, None
-        if self.tokenizer_2 is not None:
-            text_tokens_and_mask_2 = self.tokenizer_2(
-                text,
-                max_length=self.tokenizer_2.model_max_length,
-                padding='max_length',
-                truncation=True,
-                return_attention_mask=True,
-                add_special_tokens=True,
-                return_tensors='pt'
-            )
-            input_ids_2 = text_tokens_and_mask_2['input_ids']  # 1, l
-            cond_mask_2 = text_tokens_and_mask_2['attention_mask']  # 1, l
-
-        return dict(
-            pixel_values=image, input_ids_1=input_ids_1, cond_mask_1=cond_mask_1, motion_score=None, 
-            input_ids_2=input_ids_2, cond_mask_2=cond_mask_2
-            )
\ No newline at end of file
+        # drop(None) keeps None unless the caption is dropped for a default text or ''
+        text = self.drop(None, is_video=False)['text']
+        if text is None:
+            text_inputs = self.get_text_inputs(caps[0], clean=True)
+        else:
+            text_inputs = self.get_text_inputs(text, clean=False)
+
+        return dict(pixel_values=image, motion_score=None, **text_inputs)
+
+    @staticmethod
+    def caption_variants(record):
+        """
+        Every `(text, clean)` pair `get_video`/`get_image` can pass to `get_text_inputs` for `record`,
+        with the masking notice of /sam/ images. Used to build the token cache.
+        """
+        caps = record['cap'] if isinstance(record['cap'], list) else [record['cap']]
+        is_video = record['path'].endswith('.mp4')
+        if not is_video and '/sam/' in record['path']:
+            caps = [j for i in caps for j in masking_notice_variants(i)]
+        if record.get('aesthetic', None) is not None or record.get('aes', None) is not None:
+            aes = record.get('aesthetic', None) or record.get('aes', None)
+            add_notice = aesthetic_notice_variants_video if is_video else aesthetic_notice_variants_image
+            caps = [j for i in caps for j in add_notice(i, aes)]
+        return [(i, not is_video) for i in caps]
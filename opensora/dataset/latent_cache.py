@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import hashlib
+
+import numpy as np
+import torch
+
+
+LATENT_CACHE_VERSION = 1
+
+INDEX_DTYPE = np.dtype([('key', np.uint64), ('shard', np.int32), ('offset', np.int64), ('shape', np.int32, (4,))])
+
+
+def pipeline_signature(dataset, ae, ae_path):
+    """
+    Everything besides the record itself that changes the pixels fed to the VAE or the VAE itself. It is
+    stored with the cache and hashed into every key, so entries written with another pipeline never match.
+    """
+    return dict(
+        version=LATENT_CACHE_VERSION, ae=ae, ae_path=ae_path, transform=repr(dataset.transform),
+        video_reader=dataset.video_reader, num_frames=dataset.num_frames, train_fps=dataset.train_fps,
+        speed_factor=dataset.speed_factor, ae_stride_t=dataset.ae_stride_t, sp_size=dataset.sp_size,
+        temporal_sample=[type(dataset.temporal_sample).__name__, getattr(dataset.temporal_sample, 'size', None)],
+    )
+
+
+def signature_hash(signature):
+    return hashlib.sha1(json.dumps(signature, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def latent_key(record, window, sig_hash):
+    """64-bit key of one (clip, frame window, bucket resolution) under the pipeline `sig_hash`."""
+    resolution = record['resolution']
+    content = [
+        sig_hash, record['path'], list(record['sample_frame_range']), resolution['sample_height'],
+        resolution['sample_width'], record.get('crop', None), window
+    ]
+    digest = hashlib.blake2b(json.dumps(content).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _shard_paths(root, shard):
+    return os.path.join(root, f'moments.{shard:05d}.npy'), os.path.join(root, f'index.{shard:05d}.npy')
+
+
+class LatentCache(object):
+    """
+    VAE posterior moments (mean and logvar, concatenated on channels) of the dataset samples, built offline by
+    `python -m opensora.dataset.latent_cache`. Each shard holds a flat fp16/bf16 buffer of moments and an index of
+    (key, offset, shape); the indexes of all shards are merged and sorted at load, the buffers are memory-mapped.
+    `get` returns the moments of one of the `num_windows` cached frame windows of a record.
+    """
+
+    def __init__(self, root, signature):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != LATENT_CACHE_VERSION:
+            raise ValueError(f"latent cache {root} has version {self.meta['version']}, expected {LATENT_CACHE_VERSION}")
+        stale = [k for k in set(signature) | set(self.meta['signature']) if signature.get(k) != self.meta['signature'].get(k)]
+        if len(stale) > 0:
+            raise ValueError(
+                f"latent cache {root} is stale, it was built with "
+                f"{ {k: self.meta['signature'].get(k) for k in stale} } but the dataset uses { {k: signature.get(k) for k in stale} }"
+                )
+        self.sig_hash = signature_hash(signature)
+        self.num_windows = self.meta['num_windows']
+        self.dtype = torch.bfloat16 if self.meta['dtype'] == 'bf16' else torch.float16
+        indexes = []
+        for shard in range(self.meta['num_shards']):
+            index_path = _shard_paths(root, shard)[1]
+            if os.path.exists(index_path):
+                indexes.append(np.load(index_path))
+        index = np.concatenate(indexes) if len(indexes) > 0 else np.zeros(0, dtype=INDEX_DTYPE)
+        self.index = index[np.argsort(index['key'], kind='stable')]
+        self.shards = {}
+        print(f"Load latent cache from {root}: {len(self.index)} entries from {len(indexes)}/{self.meta['num_shards']} shards")
+
+    def __len__(self):
+        return len(self.index)
+
+    def _load_shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.load(_shard_paths(self.root, shard)[0], mmap_mode='r')
+        return self.shards[shard]
+
+    def get(self, record):
+        window = random.randrange(self.num_windows) if record['path'].endswith('.mp4') else 0
+        key = latent_key(record, window, self.sig_hash)
+        idx = int(np.searchsorted(self.index['key'], key))
+        if idx >= len(self.index) or self.index['key'][idx] != key:
+            raise KeyError(f"{record['path']} (window {window}) is not in the latent cache {self.root}")
+        entry = self.index[idx]
+        shape = entry['shape'].tolist()
+        moments = np.array(self._load_shard(int(entry['shard']))[entry['offset']: entry['offset'] + np.prod(shape)])
+        if self.dtype == torch.bfloat16:
+            moments = torch.from_numpy(moments.view(np.int16)).view(torch.bfloat16)
+        else:
+            moments = torch.from_numpy(moments)
+        return moments.reshape(shape)  # 2C T H W
+
+
+@torch.no_grad()
+def encode_shard(shard, root, dataset, cap_list, ae, shard_size, num_windows, dtype, device, sig_hash):
+    """
+    Encode the records `[shard * shard_size, (shard + 1) * shard_size)` of `cap_list`, `num_windows` frame windows
+    per video (the temporal crop is seeded by the entry key, so a window is reproducible), and write the shard
+    atomically. Records that fail to decode are skipped and reported. Returns the number of entries written.
+    """
+    entries, buffers, offset = [], [], 0
+    for row in range(shard * shard_size, min((shard + 1) * shard_size, len(cap_list))):
+        record = cap_list[row]
+        is_video = record['path'].endswith('.mp4')
+        for window in range(num_windows if is_video else 1):
+            key = latent_key(record, window, sig_hash)
+            random.seed(key)
+            try:
+                pixels = dataset.get_video_pixels(record) if is_video else dataset.get_image_pixels(record)  # C T H W
+            except Exception as e:
+                print(f"Skip {record['path']} (window {window}): {e}")
+                continue
+            moments = ae.encode_moments(pixels[None].to(device, dtype=ae.vae.dtype))[0]  # 2C T H W
+            if dtype == 'bf16':
+                moments = moments.to(torch.bfloat16).view(torch.int16).cpu().numpy().view(np.uint16)
+            else:
+                moments = moments.to(torch.float16).cpu().numpy()
+            entries.append((key, shard, offset, moments.shape))
+            buffers.append(moments.reshape(-1))
+            offset += moments.size
+    moments_path, index_path = _shard_paths(root, shard)
+    empty = np.zeros(0, dtype=np.uint16 if dtype == 'bf16' else np.float16)
+    for path, value in [
+        (moments_path, np.concatenate(buffers) if len(buffers) > 0 else empty),
+        (index_path, np.array(entries, dtype=INDEX_DTYPE))
+        ]:
+        tmp_path = f'{path}.tmp-{os.getpid()}.npy'
+        np.save(tmp_path, value)
+        os.rename(tmp_path, path)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    '''
+    Precompute VAE moments for every sample of the filtered dataset, resumable and split over processes by shard:
+    torchrun --nproc_per_node 8 -m opensora.dataset.latent_cache --data scripts/train_data/merge_data.txt \
+        --latent_cache_dir /path/to/latent_cache --ae WFVAEModel_D8_4x8x8 --ae_path /path/to/vae \
+        --num_frames 93 --max_hxw 236544 --train_fps 16 --total_batch_size 256 --use_decord --num_windows 2 ...
+    '''
+    import argparse
+    from opensora.dataset import getdataset
+    from opensora.dataset.t2v_datasets import dataset_prog
+    from opensora.models.causalvideovae import ae_wrapper, ae_stride_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, required=True)
+    parser.add_argument("--latent_cache_dir", type=str, required=True)
+    parser.add_argument("--ae", type=str, default="WFVAEModel_D8_4x8x8")
+    parser.add_argument("--ae_path", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, default='./cache_dir')
+    parser.add_argument("--text_encoder_name_1", type=str, default='google/mt5-xxl')
+    parser.add_argument("--text_encoder_name_2", type=str, default=None)
+    parser.add_argument("--train_fps", type=int, default=24)
+    parser.add_argument("--drop_short_ratio", type=float, default=1.0)
+    parser.add_argument("--speed_factor", type=float, default=1.0)
+    parser.add_argument("--num_frames", type=int, default=65)
+    parser.add_argument("--max_height", type=int, default=320)
+    parser.add_argument("--max_width", type=int, default=240)
+    parser.add_argument("--max_hxw", type=int, default=None)
+    parser.add_argument("--min_hxw", type=int, default=None)
+    parser.add_argument("--hw_stride", type=int, default=32)
+    parser.add_argument("--force_resolution", action="store_true")
+    parser.add_argument("--sp_size", type=int, default=1)
+    parser.add_argument("--use_decord", action="store_true")
+    parser.add_argument("--total_batch_size", type=int, required=True,
+                        help="train_batch_size * num_processes * gradient_accumulation_steps // sp_size * train_sp_batch_size")
+    parser.add_argument("--meta_index_dir", type=str, default=None)
+    parser.add_argument("--num_windows", type=int, default=1, help="frame windows cached per video, one is picked at random per sample")
+    parser.add_argument("--dtype", type=str, default='bf16', choices=['fp16', 'bf16'])
+    parser.add_argument("--shard_size", type=int, default=256)
+    parser.add_argument('--enable_tiling', action='store_true')
+    args = parser.parse_args()
+    if args.max_hxw is not None and args.min_hxw is None:
+        args.min_hxw = args.max_hxw // 4
+    args.dataset, args.model_max_length, args.cfg, args.dataloader_num_workers = 't2v', 512, 0.0, 0
+    args.ae_stride_t = ae_stride_config[args.ae][0]
+
+    rank, world_size = int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    device = torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
+
+    dataset = getdataset(args)
+    cap_list = dataset_prog.cap_list
+    signature = pipeline_signature(dataset, args.ae, args.ae_path)
+    sig_hash = signature_hash(signature)
+    num_shards = (len(cap_list) + args.shard_size - 1) // args.shard_size
+
+    os.makedirs(args.latent_cache_dir, exist_ok=True)
+    meta = dict(
+        version=LATENT_CACHE_VERSION, signature=signature, num_windows=args.num_windows, dtype=args.dtype,
+        num_shards=num_shards, shard_size=args.shard_size,
+        )
+    meta_path = os.path.join(args.latent_cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            old_meta = json.load(f)
+        if old_meta != meta:
+            raise ValueError(f'{meta_path} was written with other args, use a new --latent_cache_dir')
+    elif rank == 0:
+        tmp_path = f'{meta_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.rename(tmp_path, meta_path)
+
+    ae = ae_wrapper[args.ae](args.ae_path, cache_dir=args.cache_dir).eval().to(device)
+    if args.enable_tiling:
+        ae.vae.enable_tiling()
+
+    todo = [s for s in range(rank, num_shards, world_size) if not os.path.exists(_shard_paths(args.latent_cache_dir, s)[1])]
+    print(f'rank {rank}/{world_size}: {len(todo)} of {num_shards} shards left')
+    s = time.time()
+    total = 0
+    for i, shard in enumerate(todo):
+        total += encode_shard(
+            shard, args.latent_cache_dir, dataset, cap_list, ae, args.shard_size, args.num_windows, args.dtype, device, sig_hash
+            )
+        print(f'rank {rank}: shard {shard} done ({i+1}/{len(todo)}), {total/(time.time()-s):.2f} samples/s', flush=True)
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+META_INDEX_VERSION = 3
+
+# fields of T2V_dataset that change the result of define_frame_index
+FILTER_KEYS = [
+    'num_frames', 'train_fps', 'speed_factor', 'max_height', 'max_width', 'max_hxw', 'min_hxw',
+    'hw_stride', 'force_resolution', 'drop_short_ratio', 'ae_stride_t', 'sp_size', 'total_batch_size',
+    'hw_aspect_thr', 'too_long_factor', 'seed',
+]
+
+
+class StringTable(object):
+    """Arrow-style string column: int64 offsets (n+1) and one flat UTF-8 buffer."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(offsets, data)
+
+    @classmethod
+    def load(cls, root, name, mmap_mode='r'):
+        offsets = np.load(os.path.join(root, f'{name}.offsets.npy'), mmap_mode=mmap_mode)
+        data = np.load(os.path.join(root, f'{name}.data.npy'), mmap_mode=mmap_mode)
+        return cls(offsets, data)
+
+    def save(self, root, name):
+        np.save(os.path.join(root, f'{name}.offsets.npy'), self.offsets)
+        np.save(os.path.join(root, f'{name}.data.npy'), self.data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.data[start: end].tobytes().decode('utf-8')
+
+
+class BucketSequence(object):
+    """
+    Read-only view of the per-sample shape keys (e.g. '93x480x640'). It behaves like the
+    `sample_size` list built by `define_frame_index`, but only keeps an int32 id per sample.
+    """
+
+    def __init__(self, bucket_ids, bucket_names):
+        self.bucket_ids = bucket_ids
+        self.bucket_names = bucket_names
+
+    def __len__(self):
+        return len(self.bucket_ids)
+
+    def __getitem__(self, idx):
+        return self.bucket_names[self.bucket_ids[idx]]
+
+    def __iter__(self):
+        for i in self.bucket_ids:
+            yield self.bucket_names[i]
+
+
+def _read_float(record, key):
+    value = record.get(key, None)
+    return np.nan if value is None else value
+
+
+def write_meta_index(root, cap_list, sample_size, stats=None, columns=None):
+    """
+    Dump the filtered `cap_list` (list of dict) and its `sample_size` into columnar arrays under `root`.
+    `columns` (see `kept_columns`) holds every field but `path` and `cap`, which are then all that is read
+    from the records.
+    """
+    os.makedirs(root, exist_ok=True)
+    n = len(cap_list)
+
+    StringTable.from_strings([i['path'] for i in cap_list]).save(root, 'path')
+    StringTable.from_strings([json.dumps(i['cap'], ensure_ascii=False) for i in cap_list]).save(root, 'cap')
+
+    columns = dict(columns) if columns is not None else dict(
+        is_video=np.array([i['path'].endswith('.mp4') for i in cap_list], dtype=np.bool_),
+        height=np.array([i['resolution']['height'] for i in cap_list], dtype=np.int32),
+        width=np.array([i['resolution']['width'] for i in cap_list], dtype=np.int32),
+        sample_height=np.array([i['resolution']['sample_height'] for i in cap_list], dtype=np.int32),
+        sample_width=np.array([i['resolution']['sample_width'] for i in cap_list], dtype=np.int32),
+        fps=np.array([_read_float(i, 'fps') for i in cap_list], dtype=np.float32),
+        num_frames=np.array([i.get('num_frames', -1) for i in cap_list], dtype=np.int32),
+        start_frame_idx=np.array([i.get('start_frame_idx', 0) for i in cap_list], dtype=np.int32),
+        frame_interval=np.array([i['sample_frame_range'][1] for i in cap_list], dtype=np.float64),
+        sample_num_frames=np.array([i['sample_frame_range'][2] for i in cap_list], dtype=np.int32),
+        crop=np.array([i.get('crop', None) or [-1, -1, -1, -1] for i in cap_list], dtype=np.int32).reshape(n, 4),
+        aesthetic=np.array([_read_float(i, 'aesthetic') for i in cap_list], dtype=np.float64),
+        aes=np.array([_read_float(i, 'aes') for i in cap_list], dtype=np.float64),
+    )
+
+    # bucket ids are assigned by decreasing frequency, samples of a bucket are stored contiguously in `bucket_order`
+    bucket_names, bucket_ids, counts = np.unique(np.array(sample_size, dtype=str), return_inverse=True, return_counts=True)
+    rank = np.argsort(-counts, kind='stable')
+    remap = np.empty_like(rank)
+    remap[rank] = np.arange(len(rank))
+    columns['bucket'] = remap[bucket_ids.reshape(-1)].astype(np.int32)
+    columns['bucket_order'] = np.argsort(columns['bucket'], kind='stable').astype(np.int64)
+    for name, value in columns.items():
+        np.save(os.path.join(root, f'{name}.npy'), value)
+
+    meta = dict(
+        version=META_INDEX_VERSION,
+        num_samples=n,
+        buckets=[str(bucket_names[i]) for i in rank],
+        bucket_counts=[int(counts[i]) for i in rank],
+        stats=stats or {},
+    )
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class MetaIndex(object):
+    """
+    Memory-mapped, columnar replacement of `cap_list`. `index[i]` returns a record with the fields `define_frame_index`
+    derived (sample size, `sample_frame_range`, ...), so it can be dropped into `DataSetProg.cap_list`. All columns are opened
+    with `mmap_mode='r'`, so dataloader workers and every rank on the host share the same page cache.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != META_INDEX_VERSION:
+            raise ValueError(f"meta index {root} has version {self.meta['version']}, expected {META_INDEX_VERSION}")
+        self.path = StringTable.load(root, 'path')
+        self.cap = StringTable.load(root, 'cap')
+        for name in [
+            'is_video', 'height', 'width', 'sample_height', 'sample_width', 'fps', 'num_frames',
+            'start_frame_idx', 'frame_interval', 'sample_num_frames', 'crop', 'aesthetic', 'aes', 'bucket', 'bucket_order'
+            ]:
+            setattr(self, name, np.load(os.path.join(root, f'{name}.npy'), mmap_mode='r'))
+        self.buckets = self.meta['buckets']
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    @property
+    def sample_size(self):
+        return BucketSequence(self.bucket, self.buckets)
+
+    @property
+    def shape_idx_dict(self):
+        # zero-copy slices of `bucket_order`, one per bucket
+        splits = np.cumsum([0] + self.meta['bucket_counts'])
+        return {name: self.bucket_order[splits[i]: splits[i + 1]] for i, name in enumerate(self.buckets)}
+
+    def __getitem__(self, idx):
+        record = dict(
+            path=self.path[idx],
+            cap=json.loads(self.cap[idx]),
+            resolution=dict(
+                height=int(self.height[idx]), width=int(self.width[idx]),
+                sample_height=int(self.sample_height[idx]), sample_width=int(self.sample_width[idx]),
+            )
+        )
+        if self.is_video[idx]:
+            start_frame_idx = int(self.start_frame_idx[idx])
+            record.update(
+                num_frames=int(self.num_frames[idx]),
+                start_frame_idx=start_frame_idx,
+                sample_frame_range=(start_frame_idx, float(self.frame_interval[idx]), int(self.sample_num_frames[idx])),
+            )
+        else:
+            record['sample_frame_range'] = (0, 1.0, 1)
+        if not np.isnan(self.fps[idx]):
+            record['fps'] = float(self.fps[idx])
+        if self.crop[idx][0] >= 0:
+            record['crop'] = self.crop[idx].tolist()
+        if not np.isnan(self.aesthetic[idx]):
+            record['aesthetic'] = float(self.aesthetic[idx])
+        if not np.isnan(self.aes[idx]):
+            record['aes'] = float(self.aes[idx])
+        return record
+
+
+def shared_meta_index(cap_list, sample_size, shm_dir='/dev/shm', columns=None):
+    """
+    Move a filtered `cap_list` into a columnar store on a shared-memory filesystem and return it mapped.
+    The files are unlinked right after mapping: the mappings stay valid in this process and in the dataloader
+    workers forked from it, and the memory is released when the last of them exits.
+    """
+    root = tempfile.mkdtemp(prefix='opensora_meta_index_', dir=shm_dir if os.path.isdir(shm_dir) else None)
+    try:
+        write_meta_index(root, cap_list, sample_size, columns=columns)
+        index = MetaIndex(root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return index
+
+
+def filter_signature(dataset):
+    """
+    The key of a meta index: annotation files (path, size, mtime) plus every argument used by
+    `define_frame_index`, and the quarantined files. Any change of them leads to a new index directory.
+    """
+    with open(dataset.data, 'r') as f:
+        folder_anno = [i.strip().split(',') for i in f.readlines() if len(i.strip()) > 0]
+    annos = []
+    for sub_root, anno in folder_anno:
+        stat = os.stat(anno)
+        annos.append([sub_root, os.path.abspath(anno), stat.st_size, stat.st_mtime_ns])
+    signature = dict(version=META_INDEX_VERSION, annos=annos)
+    signature.update({k: getattr(dataset, k, None) for k in FILTER_KEYS})
+    if len(getattr(dataset, 'quarantine', ())) > 0:
+        signature['quarantine'] = dataset.quarantine.signature()
+    return signature
+
+
+def load_or_build_meta_index(index_dir, dataset):
+    """
+    Open the meta index matching `dataset`'s filtering args, building it with `dataset.define_frame_index`
+    if it does not exist yet. The build is guarded by a file lock, so only one process per host does the
+    work and the others wait and then map the result.
+    """
+    signature = filter_signature(dataset)
+    key = hashlib.sha1(json.dumps(signature, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    root = os.path.join(index_dir, key)
+    if not os.path.exists(os.path.join(root, 'meta.json')):
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, f'.{key}.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(root, 'meta.json')):
+                    s = time.time()
+                    cap_list, sample_size, _ = dataset.define_frame_index(dataset.data)
+                    tmp_root = f'{root}.tmp-{os.getpid()}'
+                    shutil.rmtree(tmp_root, ignore_errors=True)
+                    write_meta_index(tmp_root, cap_list, sample_size, columns=dataset.frame_index_columns)
+                    with open(os.path.join(tmp_root, 'signature.json'), 'w') as f:
+                        json.dump(signature, f, indent=2)
+                    os.rename(tmp_root, root)
+                    print(f'Build meta index {root} with {len(cap_list)} samples in {time.time()-s:.1f}s')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    print(f'Load meta index from {root}')
+    return MetaIndex(root)
+
+
+if __name__ == "__main__":
+    '''
+    Compile the annotation list offline, so training processes only need to map the result:
+    python -m opensora.dataset.meta_index --data scripts/train_data/merge_data.txt --meta_index_dir /path/to/index \
+        --num_frames 93 --max_hxw 236544 --train_fps 16 --total_batch_size 256 --force_resolution ...
+    '''
+    import argparse
+    from opensora.dataset.t2v_datasets import T2V_dataset
+    from opensora.dataset.transform import TemporalRandomCrop
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, required=True)
+    parser.add_argument("--meta_index_dir", type=str, required=True)
+    parser.add_argument("--train_fps", type=int, default=24)
+    parser.add_argument("--drop_short_ratio", type=float, default=1.0)
+    parser.add_argument("--speed_factor", type=float, default=1.0)
+    parser.add_argument("--num_frames", type=int, default=65)
+    parser.add_argument("--max_height", type=int, default=320)
+    parser.add_argument("--max_width", type=int, default=240)
+    parser.add_argument("--max_hxw", type=int, default=None)
+    parser.add_argument("--min_hxw", type=int, default=None)
+    parser.add_argument("--hw_stride", type=int, default=32)
+    parser.add_argument("--force_resolution", action="store_true")
+    parser.add_argument("--ae_stride_t", type=int, default=4)
+    parser.add_argument("--sp_size", type=int, default=1)
+    parser.add_argument("--total_batch_size", type=int, required=True,
+                        help="train_batch_size * num_processes * gradient_accumulation_steps // sp_size * train_sp_batch_size")
+    parser.add_argument("--text_encoder_name_1", type=str, default='google/mt5-xxl')
+    parser.add_argument("--text_encoder_name_2", type=str, default=None)
+    parser.add_argument("--quarantine_dir", type=str, default=None)
+    args = parser.parse_args()
+    if args.max_hxw is not None and args.min_hxw is None:
+        args.min_hxw = args.max_hxw // 4
+    args.model_max_length, args.cfg, args.use_decord, args.dataloader_num_workers = 512, 0.0, True, 0
+    T2V_dataset(args, transform=None, temporal_sample=TemporalRandomCrop(args.num_frames), tokenizer_1=None, tokenizer_2=None)
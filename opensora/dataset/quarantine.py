@@ -0,0 +1,122 @@
+import os
+import glob
+import json
+import time
+import hashlib
+from collections import Counter
+
+from torch.utils.data import get_worker_info
+
+
+class QuarantineLedger(object):
+    """
+    Files that failed to load, one JSON line per failure with the reason and the seconds lost on it. Every
+    (rank, dataloader worker) appends to its own `ledger.*.jsonl` in `root`, and loading merges the files of all
+    ranks and earlier runs. A path is quarantined by one decode or format failure, or by `max_transient` transient
+    ones (IO errors, timeouts, see `is_transient`) over all ranks and runs: the decode engine skips it, and the meta
+    index drops it at its next build. With `root=None` the ledger only lives in memory.
+    """
+
+    def __init__(self, root=None, max_transient=3):
+        self.root = root
+        self.max_transient = max_transient
+        self.paths = set()
+        self.transient = Counter()
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            for entry in load_ledger(root):
+                self._count(entry['path'], entry['transient'])
+            print(f'Load {len(self.paths)} quarantined files from {root}')
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def signature(self):
+        """Hash of the quarantined paths, part of the meta index key."""
+        return hashlib.sha1('\n'.join(sorted(self.paths)).encode('utf-8')).hexdigest()[:16]
+
+    def _own_path(self):
+        worker_info = get_worker_info()
+        worker = f'worker{worker_info.id:03d}' if worker_info is not None else 'main'
+        return os.path.join(self.root, f"ledger.rank{int(os.environ.get('RANK', 0)):05d}.{worker}.jsonl")
+
+    def _count(self, path, transient):
+        if transient:
+            self.transient[path] += 1
+            if self.transient[path] < self.max_transient:
+                return
+        self.paths.add(path)
+
+    def add(self, path, reason, seconds, transient=False):
+        entry = dict(
+            path=path, reason=reason[:500], seconds=round(seconds, 3), transient=transient,
+            rank=int(os.environ.get('RANK', 0)), time=time.time()
+            )
+        self._count(path, transient)
+        if self.root is not None:
+            # one short O_APPEND write per line, so the decoder threads of a worker can share its file
+            with open(self._own_path(), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def is_transient(error):
+    """
+    Whether a load error may go away on a retry: timeouts, connection errors and OS errors with an errno (EIO, ESTALE
+    of a flaky NFS, ...). PIL reports broken images as OSErrors without an errno, which count as format errors.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return isinstance(error, OSError) and error.errno is not None
+
+
+def load_ledger(root):
+    entries = []
+    for path in sorted(glob.glob(os.path.join(root, 'ledger.*.jsonl'))):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:  # a line cut short by a killed worker
+                    continue
+    return entries
+
+
+if __name__ == "__main__":
+    '''
+    Report the files quarantined by all ranks (--quarantine_dir) and the wall-clock time they cost:
+    python -m opensora.dataset.quarantine --quarantine_dir /path/to/quarantine
+    '''
+    import argparse
+    from collections import defaultdict
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quarantine_dir", type=str, required=True)
+    parser.add_argument("--top_k", type=int, default=20)
+    args = parser.parse_args()
+
+    entries = load_ledger(args.quarantine_dir)
+    ledger = QuarantineLedger()
+    for entry in entries:
+        ledger._count(entry['path'], entry['transient'])
+    num_transient = sum(entry['transient'] for entry in entries)
+    per_path, per_reason, per_rank = defaultdict(lambda: [0, 0.0]), defaultdict(lambda: [0, 0.0]), defaultdict(lambda: [0, 0.0])
+    for entry in entries:
+        reason = entry['reason'].split(':')[0]
+        for table, key in [(per_path, entry['path']), (per_reason, reason), (per_rank, entry['rank'])]:
+            table[key][0] += 1
+            table[key][1] += entry['seconds']
+    total = sum(entry['seconds'] for entry in entries)
+    print(f'{len(ledger)} quarantined files, {len(per_path)} files with failures, {len(entries)} failures '
+          f'({num_transient} transient), {total:.1f}s lost')
+    print('by reason:')
+    for reason, (count, seconds) in sorted(per_reason.items(), key=lambda item: -item[1][1]):
+        print(f'  {seconds:>10.1f}s {count:>8} {reason}')
+    print('by rank:')
+    for rank, (count, seconds) in sorted(per_rank.items()):
+        print(f'  rank {rank:>5}: {seconds:>10.1f}s {count:>8}')
+    print(f'top {args.top_k} files:')
+    for path, (count, seconds) in sorted(per_path.items(), key=lambda item: -item[1][1])[:args.top_k]:
+        print(f'  {seconds:>10.1f}s {count:>4}x {path}{"" if path in ledger else " (not quarantined)"}')
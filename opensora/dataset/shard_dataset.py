@@ -0,0 +1,379 @@
+import os
+import io
+import json
+import time
+import tarfile
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+SHARD_VERSION = 1
+
+SHARD_INDEX_DTYPE = np.dtype([
+    ('row', np.int64), ('json_offset', np.int64), ('json_size', np.int64), ('data_offset', np.int64), ('data_size', np.int64)
+    ])
+
+
+def shard_signature(dataset):
+    """The dataset args that decide which records pass the filters and their sample shapes, stored with the shards."""
+    return dict(
+        version=SHARD_VERSION, num_frames=dataset.num_frames, train_fps=dataset.train_fps, speed_factor=dataset.speed_factor,
+        max_height=dataset.max_height, max_width=dataset.max_width, max_hxw=dataset.max_hxw, min_hxw=dataset.min_hxw,
+        hw_stride=dataset.hw_stride, force_resolution=dataset.force_resolution, sp_size=dataset.sp_size,
+        ae_stride_t=dataset.ae_stride_t, drop_short_ratio=dataset.drop_short_ratio,
+    )
+
+
+def _shard_paths(root, shard):
+    return os.path.join(root, f'shard.{shard:06d}.tar'), os.path.join(root, f'shard.{shard:06d}.idx.npy')
+
+
+def plan_shards(sample_size, samples_per_shard):
+    """Cut the rows of every bucket, in order, into shards of `samples_per_shard`. Returns [(bucket, rows)]."""
+    rows_per_bucket = OrderedDict()
+    for row, bucket in enumerate(sample_size):
+        rows_per_bucket.setdefault(bucket, []).append(row)
+    return [
+        (bucket, rows[i: i + samples_per_shard])
+        for bucket, rows in rows_per_bucket.items() for i in range(0, len(rows), samples_per_shard)
+        ]
+
+
+def _add_member(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = 0
+    offset = tar.offset + len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+    tar.addfile(tarinfo, io.BytesIO(data))
+    return offset
+
+
+def write_shard(root, shard, cap_list, rows):
+    """
+    Pack the records `rows` of `cap_list` into one uncompressed tar, a `{row}.json` (the record) followed by
+    `{row}.mp4`/`{row}.jpg` (the file) per sample, WebDataset style, and write the offset index next to it.
+    Records whose file can not be read are skipped and reported. Returns the number of samples written.
+    """
+    tar_path, index_path = _shard_paths(root, shard)
+    tmp_tar_path = f'{tar_path}.tmp-{os.getpid()}'
+    entries = []
+    with tarfile.open(tmp_tar_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for row in rows:
+            record = cap_list[row]
+            try:
+                with open(record['path'], 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                print(f"Skip {record['path']}: {e}")
+                continue
+            meta = json.dumps(record, ensure_ascii=False).encode('utf-8')
+            json_offset = _add_member(tar, f'{row:09d}.json', meta)
+            data_offset = _add_member(tar, f'{row:09d}{os.path.splitext(record["path"])[1]}', data)
+            entries.append((row, json_offset, len(meta), data_offset, len(data)))
+    tmp_index_path = f'{index_path}.tmp-{os.getpid()}.npy'
+    np.save(tmp_index_path, np.array(entries, dtype=SHARD_INDEX_DTYPE))
+    # the index is renamed last, its presence marks a complete shard
+    os.rename(tmp_tar_path, tar_path)
+    os.rename(tmp_index_path, index_path)
+    return len(entries)
+
+
+class ShardReader(object):
+    """Reads samples out of the shards of one process, keeping the last `max_open` shard files open."""
+
+    def __init__(self, root, max_open=8):
+        self.root = root
+        self.max_open = max_open
+        self.files = OrderedDict()  # shard -> (fd, index)
+
+    def _open(self, shard):
+        if shard in self.files:
+            self.files.move_to_end(shard)
+        else:
+            tar_path, index_path = _shard_paths(self.root, shard)
+            self.files[shard] = (os.open(tar_path, os.O_RDONLY), np.load(index_path))
+            while len(self.files) > self.max_open:
+                fd, _ = self.files.popitem(last=False)[1]
+                os.close(fd)
+        return self.files[shard]
+
+    def read(self, shard, entry):
+        """The record of sample `entry` of `shard`, with the file content under `bytes`."""
+        fd, index = self._open(shard)
+        e = index[entry]
+        # the json and the file are adjacent members, so one read gets both
+        buf = os.pread(fd, int(e['data_offset'] + e['data_size'] - e['json_offset']), int(e['json_offset']))
+        record = json.loads(buf[:e['json_size']].decode('utf-8'))
+        record['bytes'] = buf[e['data_offset'] - e['json_offset']:]
+        return record
+
+    def close(self):
+        for fd, _ in self.files.values():
+            os.close(fd)
+        self.files.clear()
+
+
+class ShardStream(IterableDataset):
+    """
+    Streams the samples of `dataset` out of the shards under `root` (built by `python -m opensora.dataset.shard_dataset`)
+    instead of opening every file, for data on network filesystems. Every epoch the shards are shuffled and dealt
+    to the `world_size * num_workers` (rank, worker) slots. A slot reads its shards front to back through a shuffle
+    buffer of `shuffle_buffer` samples and puts consecutive samples of one bucket into batches of `batch_size`, which
+    a DataLoader with the same `batch_size` collects unchanged. Every slot yields the same number of batches, so
+    ranks stay in lockstep. The schedule only depends on (seed, epoch, slot) and is computed from the shard indexes
+    without reading any data, so the state (seed, epoch, cursor) resumes exactly, as in `LengthGroupedSampler`.
+    A sample that fails to decode is replaced by another sample of its batch; when none of a batch decodes, the
+    last good record of the bucket or up to `max_stand_ins` records of its later batches are tried instead.
+    """
+
+    def __init__(self, dataset, root, batch_size, world_size, rank, num_workers, gradient_accumulation_size,
+                 initial_global_step, shuffle_buffer=1024, num_threads=4, seed=42, max_stand_ins=16):
+        self.dataset = dataset
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        signature = shard_signature(dataset)
+        stale = [k for k in set(signature) | set(self.meta['signature']) if signature.get(k) != self.meta['signature'].get(k)]
+        if len(stale) > 0:
+            raise ValueError(
+                f"shards {root} were written with {({k: self.meta['signature'].get(k) for k in stale})} "
+                f"but the dataset uses {({k: signature.get(k) for k in stale})}"
+                )
+        missing = [s for s in range(len(self.meta['shards'])) if not os.path.exists(_shard_paths(root, s)[1])]
+        if len(missing) > 0:
+            raise ValueError(f'shards {root} misses {len(missing)} shards, e.g. {missing[:8]}, resume the shard writer first')
+        self.shards = self.meta['shards']  # [{bucket, num_samples}]
+        self.batch_size = batch_size
+        self.world_size = world_size
+        self.rank = rank
+        self.num_workers = max(num_workers, 1)
+        self.gradient_accumulation_size = gradient_accumulation_size
+        self.shuffle_buffer = shuffle_buffer
+        self.num_threads = num_threads
+        self.max_stand_ins = max_stand_ins
+        self.seed = seed
+        self.epoch = 0
+        self.cursor = initial_global_step * gradient_accumulation_size  # batches of this rank already trained on
+        self.num_steps = 0
+        self.num_batches = self.batches_per_slot()
+        print(f'Stream {sum(i["num_samples"] for i in self.shards)} samples from {len(self.shards)} shards of {root}, '
+              f'{self.num_batches} batches per dataloader worker')
+
+    @property
+    def num_slots(self):
+        return self.world_size * self.num_workers
+
+    def slot_shards(self, slot):
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shards))
+        return order[slot::self.num_slots]
+
+    def batches_per_slot(self):
+        """Full single-bucket batches of the poorest slot, which every slot stops at."""
+        num_batches = []
+        for slot in range(self.num_slots):
+            counts = {}
+            for shard in self.slot_shards(slot):
+                counts[self.shards[shard]['bucket']] = counts.get(self.shards[shard]['bucket'], 0) + self.shards[shard]['num_samples']
+            num_batches.append(sum(count // self.batch_size for count in counts.values()))
+        return min(num_batches)
+
+    def schedule(self, slot):
+        """The batches of `slot` this epoch, as lists of (shard, entry)."""
+        rng = np.random.default_rng([self.seed, self.epoch, slot])
+        pool, pending, batches = [], {}, []
+
+        def emit(item):
+            bucket = self.shards[item[0]]['bucket']
+            pending.setdefault(bucket, []).append(item)
+            if len(pending[bucket]) == self.batch_size:
+                batches.append(pending.pop(bucket))
+
+        for shard in self.slot_shards(slot):
+            for entry in range(self.shards[shard]['num_samples']):
+                pool.append((int(shard), entry))
+                if len(pool) >= self.shuffle_buffer:
+                    j = rng.integers(len(pool))
+                    pool[j], pool[-1] = pool[-1], pool[j]
+                    emit(pool.pop())
+        for j in rng.permutation(len(pool)):
+            emit(pool[j])
+        return batches[:self.num_batches]
+
+    def __len__(self):
+        return max(self.num_batches * self.num_workers - self.cursor, 0) * self.batch_size
+
+    def set_epoch(self, epoch):
+        # as in LengthGroupedSampler, only a new epoch starts over
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.cursor = 0
+            self.num_steps = 0
+            self.num_batches = self.batches_per_slot()
+
+    def set_progress(self, num_steps):
+        """Optimizer steps trained since the stream was (re)started, so that `state_dict` points past them."""
+        self.num_steps = num_steps
+
+    def state_dict(self):
+        return dict(seed=self.seed, epoch=self.epoch, cursor=self.cursor + self.num_steps * self.gradient_accumulation_size)
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.cursor = state['seed'], state['epoch'], state['cursor']
+        self.num_steps = 0
+        self.num_batches = self.batches_per_slot()
+        print(f"Resume the shard stream at batch {self.cursor} of epoch {self.epoch} (seed {self.seed})")
+
+    def _decode(self, record):
+        try:
+            return self.dataset.get_record_data(record)
+        except Exception as e:
+            print(f"Error with {e} in {record['path']}")
+            return None
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker = worker_info.id if worker_info is not None else 0
+        assert worker_info is None or worker_info.num_workers == self.num_workers, \
+            f'the stream was built for {self.num_workers} workers, the DataLoader has {worker_info.num_workers}'
+        # the DataLoader takes the batches of a rank from its workers in turn, starting at worker 0 also after a
+        # resume, so worker w continues batch `cursor + w` of the rank, which was dealt to slot (cursor + w) % num_workers
+        position = self.cursor + worker
+        batches = self.schedule(self.rank * self.num_workers + position % self.num_workers)
+        skip = position // self.num_workers
+        reader = ShardReader(self.root)
+        read_pool, decode_pool = ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=self.num_threads)
+        last_good = {}  # bucket -> record, to stand in for a batch none of whose samples decode
+
+        def read_batch(batch):
+            return [reader.read(shard, entry) for shard, entry in batch]
+
+        def stand_in(bucket, b):
+            # the last good record of the bucket, the first records of its later batches, then the same for the other
+            # buckets (the whole batch is replaced, so it stays of one shape); the reads go through the read thread,
+            # which owns the reader
+            def candidates(same_bucket):
+                yield from ((other, record) for other, record in list(last_good.items()) if (other == bucket) == same_bucket)
+                for later in batches[b + 1:]:
+                    other = self.shards[later[0][0]]['bucket']
+                    if (other == bucket) == same_bucket:
+                        yield other, read_pool.submit(reader.read, *later[0]).result()
+            tried = itertools.chain(candidates(True), candidates(False))
+            for (other, record), _ in zip(tried, range(self.max_stand_ins)):
+                sample = self._decode(record)
+                if sample is not None:
+                    last_good[other] = record
+                    return sample
+            raise RuntimeError(f'none of batch {b} nor of {self.max_stand_ins} stand-ins decoded')
+
+        try:
+            pending = read_pool.submit(read_batch, batches[skip]) if skip < len(batches) else None
+            for b in range(skip, len(batches)):
+                records = pending.result()
+                # the next batch is read sequentially while this one decodes
+                pending = read_pool.submit(read_batch, batches[b + 1]) if b + 1 < len(batches) else None
+                samples = list(decode_pool.map(self._decode, records))
+                bucket = self.shards[batches[b][0][0]]['bucket']
+                # a sample that failed is replaced by another one of the batch (all of one bucket), so every rank
+                # still yields the same number of batches
+                good = [sample for sample in samples if sample is not None]
+                if len(good) > 0:
+                    last_good[bucket] = records[samples.index(good[-1])]
+                else:
+                    good = [stand_in(bucket, b)]
+                samples = [sample if sample is not None else good[i % len(good)] for i, sample in enumerate(samples)]
+                yield from samples
+        finally:
+            read_pool.shutdown(wait=True)
+            decode_pool.shutdown(wait=True)
+            reader.close()
+
+
+if __name__ == "__main__":
+    '''
+    Pack the filtered dataset into tar shards grouped by bucket, resumable and split over processes by shard:
+    torchrun --nproc_per_node 8 -m opensora.dataset.shard_dataset --data scripts/train_data/merge_data.txt \
+        --shard_dir /path/to/shards --ae WFVAEModel_D8_4x8x8 --num_frames 93 --max_hxw 236544 --train_fps 16 \
+        --total_batch_size 256 --samples_per_shard 512 ...
+    '''
+    import argparse
+    from opensora.dataset import getdataset
+    from opensora.dataset.t2v_datasets import dataset_prog
+    from opensora.models.causalvideovae import ae_stride_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, required=True)
+    parser.add_argument("--shard_dir", type=str, required=True)
+    parser.add_argument("--ae", type=str, default="WFVAEModel_D8_4x8x8")
+    parser.add_argument("--cache_dir", type=str, default='./cache_dir')
+    parser.add_argument("--text_encoder_name_1", type=str, default='google/mt5-xxl')
+    parser.add_argument("--text_encoder_name_2", type=str, default=None)
+    parser.add_argument("--train_fps", type=int, default=24)
+    parser.add_argument("--drop_short_ratio", type=float, default=1.0)
+    parser.add_argument("--speed_factor", type=float, default=1.0)
+    parser.add_argument("--num_frames", type=int, default=65)
+    parser.add_argument("--max_height", type=int, default=320)
+    parser.add_argument("--max_width", type=int, default=240)
+    parser.add_argument("--max_hxw", type=int, default=None)
+    parser.add_argument("--min_hxw", type=int, default=None)
+    parser.add_argument("--hw_stride", type=int, default=32)
+    parser.add_argument("--force_resolution", action="store_true")
+    parser.add_argument("--sp_size", type=int, default=1)
+    parser.add_argument("--use_decord", action="store_true")
+    parser.add_argument("--total_batch_size", type=int, required=True,
+                        help="train_batch_size * num_processes * gradient_accumulation_steps // sp_size * train_sp_batch_size")
+    parser.add_argument("--meta_index_dir", type=str, default=None)
+    parser.add_argument("--samples_per_shard", type=int, default=512)
+    args = parser.parse_args()
+    if args.max_hxw is not None and args.min_hxw is None:
+        args.min_hxw = args.max_hxw // 4
+    args.dataset, args.model_max_length, args.cfg, args.dataloader_num_workers = 't2v', 512, 0.0, 0
+    args.ae_stride_t = ae_stride_config[args.ae][0]
+
+    rank, world_size = int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+    dataset = getdataset(args)
+    cap_list = dataset_prog.cap_list
+    plan = plan_shards(dataset.sample_size, args.samples_per_shard)
+
+    os.makedirs(args.shard_dir, exist_ok=True)
+    meta_path = os.path.join(args.shard_dir, 'meta.json')
+    plan_meta = dict(
+        version=SHARD_VERSION, signature=shard_signature(dataset), samples_per_shard=args.samples_per_shard,
+        shard_rows=[len(rows) for _, rows in plan], num_samples=len(cap_list),
+        )
+    plan_path = os.path.join(args.shard_dir, 'plan.json')
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r') as f:
+            if json.load(f) != plan_meta:
+                raise ValueError(f'{plan_path} was written with other args or data, use a new --shard_dir')
+    elif rank == 0:
+        tmp_path = f'{plan_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(plan_meta, f)
+        os.rename(tmp_path, plan_path)
+
+    todo = [s for s in range(rank, len(plan), world_size) if not os.path.exists(_shard_paths(args.shard_dir, s)[1])]
+    print(f'rank {rank}/{world_size}: {len(todo)} of {len(plan)} shards left')
+    s = time.time()
+    total = 0
+    for i, shard in enumerate(todo):
+        total += write_shard(args.shard_dir, shard, cap_list, plan[shard][1])
+        print(f'rank {rank}: shard {shard} done ({i+1}/{len(todo)}), {total/(time.time()-s):.2f} samples/s', flush=True)
+
+    # the last process to finish lists the shards with the samples they really hold (unreadable files were skipped)
+    done = [os.path.exists(_shard_paths(args.shard_dir, s)[1]) for s in range(len(plan))]
+    if all(done):
+        shards = [
+            dict(bucket=bucket, num_samples=len(np.load(_shard_paths(args.shard_dir, s)[1])))
+            for s, (bucket, _) in enumerate(plan)
+            ]
+        meta = dict(version=SHARD_VERSION, signature=shard_signature(dataset), shards=shards)
+        tmp_path = f'{meta_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, meta_path)
+        print(f'{sum(i["num_samples"] for i in shards)} samples in {len(shards)} shards, wrote {meta_path}')
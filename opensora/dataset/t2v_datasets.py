@@ -15,7 +15,9 @@ import numpy as np
 import torchvision
 from einops import rearrange
 from os.path import join as opj
-from collections import Counter
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import threading
 
 import cv2
 import pandas as pd
@@ -32,7 +34,16 @@ import gc
 from opensora.utils.dataset_utils import DecordInit
 from opensora.utils.utils import text_preprocessing
 from opensora.dataset.transform import get_params, maxhwresize, add_masking_notice, calculate_statistics, \
-    add_aesthetic_notice_image, add_aesthetic_notice_video
+    add_aesthetic_notice_image, add_aesthetic_notice_video, aesthetic_notice_variants_image, aesthetic_notice_variants_video
+from opensora.dataset.meta_index import load_or_build_meta_index, shared_meta_index
+from opensora.dataset.token_cache import TokenCache
+from opensora.dataset.text_embed_cache import TextEmbedCache
+from opensora.dataset.latent_cache import LatentCache, pipeline_signature
+from opensora.dataset.decode_engine import DecodeEngine
+from opensora.dataset.quarantine import QuarantineLedger
+from opensora.dataset.virtual_disk import VirtualDisk, LocalDirBackend
+from opensora.dataset.frame_index import FrameIndexBuilder, read_annotations, annotation_columns, concat_columns, frame_range_indices, \
+    shape_idx_dict_from_buckets, report_frame_index, kept_columns, gc_paused
 
 import decord
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
@@ -85,7 +96,7 @@ class DataSetProg(metaclass=SingletonMeta):
         self.num_workers = num_workers
         self.cap_list = cap_list
         self.n_elements = n_elements
-        self.elements = list(range(n_elements))
+        self.elements = range(n_elements)
         
         print(f"n_elements: {len(self.elements)}", flush=True)
         # if torch_npu is not None:
@@ -138,13 +149,16 @@ def read_parquet(path):
 
 
 class DecordDecoder(object):
-    def __init__(self, url, num_threads=1):
+    """`shape` (height, width), e.g. the resolution of the record, saves reading it from the stream."""
+    def __init__(self, url, num_threads=1, shape=None):
 
+        self.url = url
         self.num_threads = num_threads
         self.ctx = decord.cpu(0)
         self.reader = decord.VideoReader(url,
                                     ctx=self.ctx,
                                     num_threads=self.num_threads)
+        self.shape = tuple(shape) if shape is not None else None
 
     def get_avg_fps(self):
         return self.reader.get_avg_fps() if self.reader.get_avg_fps() > 0 else 30.0
@@ -152,24 +166,137 @@ class DecordDecoder(object):
     def get_num_frames(self):
         return len(self.reader)
 
+    def get_shape(self):
+        # set by every `get_batch`, so only a reader that decoded nothing yet reads frame 0, where it stands anyway
+        if self.shape is None:
+            self.shape = tuple(self.reader[0].shape[:2])
+            self.reader.seek(0)
+        return self.shape
+
     def get_height(self):
-        return self.reader[0].shape[0] if self.get_num_frames() > 0 else 0
+        return self.get_shape()[0] if self.get_num_frames() > 0 else 0
 
     def get_width(self):
-        return self.reader[0].shape[1] if self.get_num_frames() > 0 else 0
+        return self.get_shape()[1] if self.get_num_frames() > 0 else 0
 
     # output shape [T, H, W, C]
     def get_batch(self, frame_indices):
         try:
             #frame_indices[0] = 1000
-            video_data = self.reader.get_batch(frame_indices).asnumpy()
+            # decode every frame once and in order, so the reader only seeks forward
+            unique, inverse = np.unique(np.asarray(frame_indices, dtype=np.int64), return_inverse=True)
+            video_data = self.reader.get_batch(unique.tolist()).asnumpy()
             video_data = torch.from_numpy(video_data)
+            if len(unique) != len(frame_indices) or np.any(inverse != np.arange(len(inverse))):
+                video_data = video_data[torch.from_numpy(inverse)]
+            self.shape = tuple(video_data.shape[1:3])
             return video_data
         except Exception as e:
             print('get_batch execption:', e)
             return None
-        
+
+    def get_windows(self, windows):
+        """Frames of several index windows (e.g. temporal crops) of the clip in one read, [T, H, W, C] per window."""
+        video_data = self.get_batch(np.concatenate([np.asarray(w, dtype=np.int64) for w in windows]))
+        if video_data is None:
+            return None
+        return list(torch.split(video_data, [len(w) for w in windows]))
+
+
+class DecoderCache(object):
+    """
+    LRU of open `DecordDecoder`s of one process, keyed by path, so consecutive reads of a clip skip the container
+    parse and index build. It keeps at most `max_open` readers (file descriptors) and `max_mb` of their estimated
+    frame buffers. A reader is checked out while in use, so concurrent decoder threads never share one.
+    """
+
+    frames_buffered = 8  # rough number of decoded frames a reader holds on to
+
+    def __init__(self, max_open=32, max_mb=2048, num_threads=1):
+        self.max_open = max_open
+        self.max_bytes = max_mb * 1024 * 1024
+        self.num_threads = num_threads
+        self._pid = None
+
+    def _start(self):
+        # readers and locks are not shared with forked DataLoader workers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.lock = threading.Lock()
+            self.idle = OrderedDict()  # path -> (decoder, bytes)
+            self.idle_bytes = 0
+            self.num_hits, self.num_misses = 0, 0
+
+    def _evict(self):
+        while len(self.idle) > self.max_open or (self.idle_bytes > self.max_bytes and len(self.idle) > 0):
+            _, (_, nbytes) = self.idle.popitem(last=False)
+            self.idle_bytes -= nbytes
+
+    @contextmanager
+    def open(self, path, shape=None):
+        """Check out the reader of `path`; `shape` (height, width) sizes it without probing the file."""
+        self._start()
+        with self.lock:
+            decoder, nbytes = self.idle.pop(path, (None, 0))
+            self.idle_bytes -= nbytes
+        if decoder is None:
+            self.num_misses += 1
+            decoder = DecordDecoder(path, num_threads=self.num_threads, shape=shape)
+        else:
+            self.num_hits += 1
+        yield decoder
+        # only returned when the read went through, a reader that raised is dropped
+        height, width = decoder.get_shape()
+        nbytes = height * width * 3 * self.frames_buffered
+        with self.lock:
+            if path not in self.idle:
+                self.idle[path] = (decoder, nbytes)
+                self.idle_bytes += nbytes
+            self._evict()
+
+
+def open_image(record):
+    """PIL image of a record, from the bytes streamed out of a shard if it has them, else from its path."""
+    return Image.open(io.BytesIO(record['bytes']) if 'bytes' in record else record['path'])
+
+
+def opencv_read_frames(cv2_vr, frame_indices, path=''):
+    """
+    RGB frames (T, H, W, C) uint8 of an opened `cv2.VideoCapture`. A non-decreasing index list is read with one
+    seek and then sequentially, grabbing (not converting) the skipped frames and reusing repeated ones; any other
+    order falls back to a seek per frame. Frames are converted straight into one preallocated buffer.
+    """
+    frame_indices = np.asarray(frame_indices, dtype=np.int64)
+    buffer = None
+    sequential = len(frame_indices) > 0 and bool(np.all(np.diff(frame_indices) >= 0))
+    if sequential and frame_indices[0] > 0:
+        cv2_vr.set(cv2.CAP_PROP_POS_FRAMES, int(frame_indices[0]))
+    position = int(frame_indices[0]) if sequential else -1  # index of the next frame `read` returns
+    for i, frame_idx in enumerate(frame_indices):
+        if sequential:
+            if i > 0 and frame_idx == frame_indices[i - 1]:
+                buffer[i] = buffer[i - 1]
+                continue
+            while position < frame_idx:
+                if not cv2_vr.grab():
+                    raise ValueError(f'can not grab frame {position} of {path}')
+                position += 1
+            position += 1
+        else:
+            cv2_vr.set(cv2.CAP_PROP_POS_FRAMES, int(frame_idx))
+        ok, frame = cv2_vr.read()
+        if not ok:
+            raise ValueError(f'can not read frame {frame_idx} of {path}')
+        if buffer is None:
+            buffer = np.empty((len(frame_indices), *frame.shape), dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=buffer[i])
+    return buffer
+
+
 class T2V_dataset(Dataset):
+    # texts tokenized as-is whatever the record, e.g. the cfg drop
+    constant_texts = [('', False)]
+
     def __init__(self, args, transform, temporal_sample, tokenizer_1, tokenizer_2):
         self.data = args.data
         self.num_frames = args.num_frames
@@ -204,49 +331,149 @@ class T2V_dataset(Dataset):
         if args.text_encoder_name_2 is not None and 'mt5' in args.text_encoder_name_2:
             self.support_Chinese = True
 
+        self.token_cache = None
+        if getattr(args, 'token_cache_dir', None) is not None:
+            self.token_cache = TokenCache(args.token_cache_dir)
+            self.token_cache.check(args.text_encoder_name_1, args.text_encoder_name_2, self.model_max_length, self.support_Chinese)
+            print(f'Load token cache from {args.token_cache_dir} with {len(self.token_cache)} texts')
+        self.text_embed_cache = None
+        if getattr(args, 'text_embed_cache_dir', None) is not None:
+            assert self.token_cache is not None, '--text_embed_cache_dir needs the --token_cache_dir it was built from'
+            self.text_embed_cache = TextEmbedCache(args.text_embed_cache_dir, self.token_cache)
+            print(f'Load text embedding cache from {args.text_embed_cache_dir}')
+
+        self.quarantine = QuarantineLedger(getattr(args, 'quarantine_dir', None))
         s = time.time()
-        cap_list, self.sample_size, self.shape_idx_dict = self.define_frame_index(self.data)
+        self.meta_index_dir = getattr(args, 'meta_index_dir', None)
+        if self.meta_index_dir is not None:
+            cap_list = load_or_build_meta_index(self.meta_index_dir, self)
+            self.sample_size, self.shape_idx_dict = cap_list.sample_size, cap_list.shape_idx_dict
+        else:
+            cap_list, sample_size, _ = self.define_frame_index(self.data)
+            # hand the records to a shared-memory columnar store, so forked workers do not copy them on refcount updates
+            cap_list = shared_meta_index(cap_list, sample_size, columns=self.frame_index_columns)
+            self.sample_size, self.shape_idx_dict = cap_list.sample_size, cap_list.shape_idx_dict
         e = time.time()
         print(f'Build data time: {e-s}')
+        self.latent_cache = None
+        if getattr(args, 'latent_cache_dir', None) is not None:
+            self.latent_cache = LatentCache(args.latent_cache_dir, pipeline_signature(self, args.ae, args.ae_path))
         self.lengths = self.sample_size
 
         n_elements = len(cap_list)
         dataset_prog.set_cap_list(args.dataloader_num_workers, cap_list, n_elements)
         print(f"Data length: {len(dataset_prog.cap_list)}")
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.timeout = 60
+        self.decoder_cache = DecoderCache(
+            max_open=getattr(args, 'decoder_cache_size', 32), max_mb=getattr(args, 'decoder_cache_mb', 2048)
+            )
+        self.virtual_disk = None
+        if getattr(args, 'virtual_disk_dir', None) is not None and self.latent_cache is None:
+            remote = getattr(args, 'virtual_disk_remote', None)
+            self.virtual_disk = VirtualDisk(
+                args.virtual_disk_dir, size=getattr(args, 'virtual_disk_size', '64G'),
+                backend=LocalDirBackend(remote) if remote is not None else None,
+                max_transfers=getattr(args, 'virtual_disk_max_transfers', 32),
+                )
+        self.windows_per_clip = getattr(args, 'windows_per_clip', 1)
+        self.use_img_from_vid = getattr(args, 'use_img_from_vid', False)
+        reuse_windows = self.latent_cache is None and (self.windows_per_clip > 1 or self.use_img_from_vid)
+        self.decode_engine = DecodeEngine(
+            self, num_threads=getattr(args, 'decode_threads', 4), prefetch_batches=getattr(args, 'decode_prefetch_batches', 1),
+            timeout=60, quarantine=self.quarantine, stats_dir=getattr(args, 'decode_stats_dir', None),
+            read_ahead_batches=getattr(args, 'virtual_disk_read_ahead', 8) if self.virtual_disk is not None else 0,
+            reservoir_mb=getattr(args, 'window_reservoir_mb', 2048) if reuse_windows else 0,
+            max_windows_per_batch=getattr(args, 'max_windows_per_batch', 1),
+            )
 
     def set_checkpoint(self, n_used_elements):
         for i in range(len(dataset_prog.n_used_elements)):
             dataset_prog.n_used_elements[i] = n_used_elements
 
+    def set_sample_order(self, sampler):
+        # lets the decode engine of every DataLoader worker prefetch the batches it will be asked for next
+        self.decode_engine.set_order(sampler)
+
     def __len__(self):
         return dataset_prog.n_elements
 
     def __getitem__(self, idx):
-        try:
-            future = self.executor.submit(self.get_data, idx)
-            data = future.result(timeout=self.timeout) 
-            # data = self.get_data(idx)
-            return data
-        except Exception as e:
-            if len(str(e)) < 2:
-                e = f"TimeoutError, {self.timeout}s timeout occur with {dataset_prog.cap_list[idx]['path']}"
-            print(f'Error with {e}')
-            index_cand = self.shape_idx_dict[self.sample_size[idx]]  # pick same shape
-            return self.__getitem__(random.choice(index_cand))
+        return self.decode_engine.fetch([idx])[0]
+
+    def __getitems__(self, indices):
+        # called by the DataLoader fetcher with a whole batch, which is decoded concurrently
+        return self.decode_engine.fetch(indices)
+
+    def get_path(self, idx):
+        return dataset_prog.cap_list[idx]['path']
+
+    def read_ahead(self, indices):
+        # the decode engine hands over the samples of the batches after the prefetched ones
+        self.virtual_disk.prefetch([dataset_prog.cap_list[int(idx)]['path'] for idx in indices])
 
     def get_data(self, idx):
-        path = dataset_prog.cap_list[idx]['path']
-        if path.endswith('.mp4'):
-            return self.get_video(idx)
+        return self.get_record_data(dataset_prog.cap_list[idx])
+
+    def get_record_data(self, record):
+        """
+        Sample of one record; a record streamed from a shard carries the file content in `bytes`. With
+        `--virtual_disk_dir`, the path of a record is the remote object and the file is read from the local cache.
+        """
+        if self.virtual_disk is not None and 'bytes' not in record:
+            record = dict(record, path=self.virtual_disk.get_data(record['path']))
+        if record['path'].endswith('.mp4'):
+            return self.get_video(record)
         else:
-            return self.get_image(idx)
+            return self.get_image(record)
     
-    def get_video(self, idx):
-        video_data = dataset_prog.cap_list[idx]
+    def get_video(self, video_data):
+        extra_samples = None
+        if self.latent_cache is not None:
+            video = self.latent_cache.get(video_data)  # 2C T H W moments of one cached frame window
+        elif self.windows_per_clip > 1 or self.use_img_from_vid:
+            video, extra_samples = self.get_video_windows(video_data)
+        else:
+            video = self.get_video_pixels(video_data)
+        sample = dict(pixel_values=video, **self.get_video_text_inputs(video_data))
+        if extra_samples is not None:
+            sample['extra_samples'] = extra_samples  # taken out by the decode engine
+        return sample
+
+    def get_video_text_inputs(self, video_data):
+        text = video_data['cap']
+        if not isinstance(text, list):
+            text = [text]
+        text = [random.choice(text)]
+        if video_data.get('aesthetic', None) is not None or video_data.get('aes', None) is not None:
+            aes = video_data.get('aesthetic', None) or video_data.get('aes', None)
+            text = [add_aesthetic_notice_video(text[0], aes)]
+
+        if random.random() > self.cfg:
+            return self.get_text_inputs(text[0], clean=True)
+        else:
+            return self.get_text_inputs("", clean=False)
+
+    def get_image(self, image_data):
+        if self.latent_cache is not None:
+            image = self.latent_cache.get(image_data)  # 2C 1 H W moments
+        else:
+            image = self.get_image_pixels(image_data)
+        return dict(pixel_values=image, **self.get_image_text_inputs(image_data))
+
+    def get_image_text_inputs(self, image_data):
+        caps = image_data['cap'] if isinstance(image_data['cap'], list) else [image_data['cap']]
+        caps = [random.choice(caps)]
+        if image_data.get('aesthetic', None) is not None or image_data.get('aes', None) is not None:
+            aes = image_data.get('aesthetic', None) or image_data.get('aes', None)
+            caps = [add_aesthetic_notice_image(caps[0], aes)]
+
+        if random.random() > self.cfg:
+            return self.get_text_inputs(caps[0], clean=True)
+        else:
+            return self.get_text_inputs("", clean=False)
+
+    def get_video_pixels(self, video_data):
         video_path = video_data['path']
-        assert os.path.exists(video_path), f"file {video_path} do not exist!"
+        assert 'bytes' in video_data or os.path.exists(video_path), f"file {video_path} do not exist!"
         sample_h = video_data['resolution']['sample_height']
         sample_w = video_data['resolution']['sample_width']
         if self.video_reader == 'decord':
@@ -261,70 +488,70 @@ class T2V_dataset(Dataset):
 
         # video = torch.rand(105, 3, 640, 640)
 
-        video = video.transpose(0, 1)  # T C H W -> C T H W
-        text = video_data['cap']
-        if not isinstance(text, list):
-            text = [text]
-        text = [random.choice(text)]
-        if video_data.get('aesthetic', None) is not None or video_data.get('aes', None) is not None:
-            aes = video_data.get('aesthetic', None) or video_data.get('aes', None)
-            text = [add_aesthetic_notice_video(text[0], aes)]
-        text = text_preprocessing(text, support_Chinese=self.support_Chinese)
-
-        text = text if random.random() > self.cfg else ""
-
-        text_tokens_and_mask_1 = self.tokenizer_1(
-            text,
-            max_length=self.model_max_length,
-            padding='max_length',
-            truncation=True,
-            return_attention_mask=True,
-            add_special_tokens=True,
-            return_tensors='pt'
-        )
-        input_ids_1 = text_tokens_and_mask_1['input_ids']
-        cond_mask_1 = text_tokens_and_mask_1['attention_mask']
-        
-        input_ids_2, cond_mask_2 = None, None
-        if self.tokenizer_2 is not None:
-            text_tokens_and_mask_2 = self.tokenizer_2(
-                text,
-                max_length=self.tokenizer_2.model_max_length,
-                padding='max_length',
-                truncation=True,
-                return_attention_mask=True,
-                add_special_tokens=True,
-                return_tensors='pt'
-            )
-            input_ids_2 = text_tokens_and_mask_2['input_ids']
-            cond_mask_2 = text_tokens_and_mask_2['attention_mask']
-
-        return dict(
-            pixel_values=video, input_ids_1=input_ids_1, cond_mask_1=cond_mask_1, 
-            input_ids_2=input_ids_2, cond_mask_2=cond_mask_2,
-            )
+        return video.transpose(0, 1)  # T C H W -> C T H W
 
-    def get_image(self, idx):
-        image_data = dataset_prog.cap_list[idx]  # [{'path': path, 'cap': cap}, ...]
+    def get_video_windows(self, video_data):
+        """
+        Pixels of one frame window of the clip, plus the extra samples the same read yields for the reservoir of the
+        decode engine, as `(shape, path, sample)`: the other windows (`--windows_per_clip`), and with
+        `--use_img_from_vid` one still frame per window for the image bucket of the same size.
+        """
+        path = video_data['path']
+        assert 'bytes' in video_data or os.path.exists(path), f"file {path} do not exist!"
+        sample_h = video_data['resolution']['sample_height']
+        sample_w = video_data['resolution']['sample_width']
+        windows = self.get_frame_windows(video_data, self.windows_per_clip)
+        read = self.decord_read if self.video_reader == 'decord' else self.opencv_read
+        frames = read(video_data, frame_indices=np.concatenate(windows))  # one read of all windows, in clip order
+        clips = []
+        for frames_window in torch.split(frames, [len(w) for w in windows]):
+            video = self.transform(frames_window)  # T C H W -> T C H W
+            assert video.shape[2] == sample_h and video.shape[3] == sample_w, f'sample_h ({sample_h}), sample_w ({sample_w}), video ({video.shape})'
+            clips.append(video.transpose(0, 1))  # T C H W -> C T H W
+        primary = random.randrange(len(clips))
+        extra_samples = []
+        for i, video in enumerate(clips):
+            if i != primary:
+                extra_samples.append((
+                    f'{video.shape[1]}x{sample_h}x{sample_w}', path, dict(pixel_values=video, **self.get_video_text_inputs(video_data))
+                    ))
+            if self.use_img_from_vid and f'1x{sample_h}x{sample_w}' in self.shape_idx_dict:
+                t = random.randrange(video.shape[1])
+                image = video[:, t: t + 1].clone()  # C 1 H W, not holding on to the window
+                extra_samples.append((
+                    f'1x{sample_h}x{sample_w}', path, dict(pixel_values=image, **self.get_image_text_inputs(video_data))
+                    ))
+        return clips[primary], extra_samples
+
+    def get_image_pixels(self, image_data):
         sample_h = image_data['resolution']['sample_height']
         sample_w = image_data['resolution']['sample_width']
 
-        image = Image.open(image_data['path']).convert('RGB')  # [h, w, c]
+        image = open_image(image_data).convert('RGB')  # [h, w, c]
         image = torch.from_numpy(np.array(image))  # [h, w, c]
         image = rearrange(image, 'h w c -> c h w').unsqueeze(0)  #  [1 c h w]
 
         image = self.transform(image) #  [1 C H W] -> num_img [1 C H W]
         assert image.shape[2] == sample_h and image.shape[3] == sample_w, f"image_data: {image_data}, but found image {image.shape}"
         # image = torch.rand(1, 3, sample_h, sample_w)
-        image = image.transpose(0, 1)  # [1 C H W] -> [C 1 H W]
-
-        caps = image_data['cap'] if isinstance(image_data['cap'], list) else [image_data['cap']]
-        caps = [random.choice(caps)]
-        if image_data.get('aesthetic', None) is not None or image_data.get('aes', None) is not None:
-            aes = image_data.get('aesthetic', None) or image_data.get('aes', None)
-            caps = [add_aesthetic_notice_image(caps[0], aes)]
-        text = text_preprocessing(caps, support_Chinese=self.support_Chinese)
-        text = text if random.random() > self.cfg else ""
+        return image.transpose(0, 1)  # [1 C H W] -> [C 1 H W]
+
+    def get_text_inputs(self, text, clean=True):
+        """
+        Token ids and masks of both tokenizers for `text`, `clean` running `text_preprocessing` first. They are
+        read from the token cache (`--token_cache_dir`) when it has the text, else tokenized on the fly.
+        With `--text_embed_cache_dir`, `input_ids_1`/`input_ids_2` hold the text encoder outputs instead.
+        """
+        if self.token_cache is not None:
+            row = self.token_cache.index(text, clean)
+            if row >= 0:
+                if self.text_embed_cache is not None:
+                    return self.text_embed_cache.get_row(row)
+                return self.token_cache.get_row(row)
+            if self.text_embed_cache is not None:
+                raise KeyError(f'{text} (clean={clean}) is not in the text embedding cache')
+        if clean:
+            text = text_preprocessing([text], support_Chinese=self.support_Chinese)
 
         text_tokens_and_mask_1 = self.tokenizer_1(
             text,
@@ -352,262 +579,124 @@ class T2V_dataset(Dataset):
             input_ids_2 = text_tokens_and_mask_2['input_ids']  # 1, l
             cond_mask_2 = text_tokens_and_mask_2['attention_mask']  # 1, l
 
-        return dict(
-            pixel_values=image, input_ids_1=input_ids_1, cond_mask_1=cond_mask_1, 
-            input_ids_2=input_ids_2, cond_mask_2=cond_mask_2
-            )
+        return dict(input_ids_1=input_ids_1, cond_mask_1=cond_mask_1, input_ids_2=input_ids_2, cond_mask_2=cond_mask_2)
+
+    @staticmethod
+    def caption_variants(record):
+        """
+        Every `(text, clean)` pair `get_video`/`get_image` can pass to `get_text_inputs` for `record`,
+        i.e. each caption with each aesthetic notice and placement. Used to build the token cache.
+        """
+        caps = record['cap'] if isinstance(record['cap'], list) else [record['cap']]
+        if record.get('aesthetic', None) is not None or record.get('aes', None) is not None:
+            aes = record.get('aesthetic', None) or record.get('aes', None)
+            add_notice = aesthetic_notice_variants_video if record['path'].endswith('.mp4') else aesthetic_notice_variants_image
+            caps = [j for i in caps for j in add_notice(i, aes)]
+        return [(i, True) for i in caps]
 
     def define_frame_index(self, data):
-        
-        shape_idx_dict = {}
-        new_cap_list = []
-        sample_size = []
-        aesthetic_score = []
-        cnt_vid = 0
-        cnt_img = 0
-        cnt_too_long = 0
-        cnt_too_short = 0
-        cnt_no_cap = 0
-        cnt_no_resolution = 0
-        cnt_no_aesthetic = 0
-        cnt_img_res_mismatch_stride = 0
-        cnt_vid_res_mismatch_stride = 0
-        cnt_img_aspect_mismatch = 0
-        cnt_vid_aspect_mismatch = 0
-        cnt_img_res_too_small = 0
-        cnt_vid_res_too_small = 0
-        cnt_vid_after_filter = 0
-        cnt_img_after_filter = 0
-        cnt = 0
-        
-
-        with open(data, 'r') as f:
-            folder_anno = [i.strip().split(',') for i in f.readlines() if len(i.strip()) > 0]
-        for sub_root, anno in tqdm(folder_anno):
-            print(f'Building {anno}...')
-            if anno.endswith('.json'):
-                with open(anno, 'r') as f:
-                    sub_list = json.load(f)
-            elif anno.endswith('.pkl'):
-                with open(anno, "rb") as f: 
-                    sub_list = pickle.load(f)
-            for index, i in enumerate(tqdm(sub_list)):
-                cnt += 1
-                path = os.path.join(sub_root, i['path'])
-                i['path'] = path
-                if path.endswith('.mp4'):
-                    cnt_vid += 1
-                elif path.endswith('.jpg'):
-                    cnt_img += 1
-
-                # ======no aesthetic=====
-                if i.get('aesthetic', None) is None or i.get('aes', None) is None:
-                    cnt_no_aesthetic += 1
-                else:
-                    aesthetic_score.append(i.get('aesthetic', None) or i.get('aes', None))
-
-                # ======no caption=====
-                cap = i.get('cap', None)
-                if cap is None:
-                    cnt_no_cap += 1
-                    continue
-
-                # ======resolution mismatch=====
-                if i.get('resolution', None) is None:
-                    cnt_no_resolution += 1
-                    continue
-                else:
-                    if i['resolution'].get('height', None) is None or i['resolution'].get('width', None) is None:
-                        cnt_no_resolution += 1
-                        continue
-                    else:
-                        height, width = i['resolution']['height'], i['resolution']['width']
-                        if not self.force_resolution:
-                            if height <= 0 or width <= 0:
-                                cnt_no_resolution += 1
-                                continue
-                            
-                            tr_h, tr_w = maxhwresize(height, width, self.max_hxw)
-                            _, _, sample_h, sample_w = get_params(tr_h, tr_w, self.hw_stride)
-
-                            if sample_h <= 0 or sample_w <= 0:
-                                if path.endswith('.mp4'):
-                                    cnt_vid_res_mismatch_stride += 1
-                                elif path.endswith('.jpg'):
-                                    cnt_img_res_mismatch_stride += 1
-                                continue
-                            
-                            # filter min_hxw
-                            if sample_h * sample_w < self.min_hxw:
-                                if path.endswith('.mp4'):
-                                    cnt_vid_res_too_small += 1
-                                elif path.endswith('.jpg'):
-                                    cnt_img_res_too_small += 1
-                                continue
-
-                            # filter aspect
-                            is_pick = filter_resolution(
-                                sample_h, sample_w, max_h_div_w_ratio=self.hw_aspect_thr, min_h_div_w_ratio=1/self.hw_aspect_thr
-                                )
-                            if not is_pick:
-                                if path.endswith('.mp4'):
-                                    cnt_vid_aspect_mismatch += 1
-                                elif path.endswith('.jpg'):
-                                    cnt_img_aspect_mismatch += 1
-                                continue
-
-                            i['resolution'].update(dict(sample_height=sample_h, sample_width=sample_w))
-                            
-                        else:
-                            aspect = self.max_height / self.max_width
-                            is_pick = filter_resolution(
-                                height, width, max_h_div_w_ratio=self.hw_aspect_thr*aspect, min_h_div_w_ratio=1/self.hw_aspect_thr*aspect
-                                )
-                            if not is_pick:
-                                if path.endswith('.mp4'):
-                                    cnt_vid_aspect_mismatch += 1
-                                elif path.endswith('.jpg'):
-                                    cnt_img_aspect_mismatch += 1
-                                continue
-                            sample_h, sample_w = self.max_height, self.max_width
-                            
-                            i['resolution'].update(dict(sample_height=sample_h, sample_width=sample_w))
-
-
-                if path.endswith('.mp4'):
-                    fps = i.get('fps', 24)
-                    # max 5.0 and min 1.0 are just thresholds to filter some videos which have suitable duration. 
-                    if i['num_frames'] > self.too_long_factor * (self.num_frames * fps / self.train_fps * self.speed_factor):  # too long video is not suitable for this training stage (self.num_frames)
-                        cnt_too_long += 1
-                        continue
-
-                    # resample in case high fps, such as 50/60/90/144 -> train_fps(e.g, 24)
-                    frame_interval = 1.0 if abs(fps - self.train_fps) < 0.1 else fps / self.train_fps
-                    start_frame_idx = i.get('cut', [0])[0]
-                    i['start_frame_idx'] = start_frame_idx
-                    frame_indices = np.arange(start_frame_idx, start_frame_idx+i['num_frames'], frame_interval).astype(int)
-                    frame_indices = frame_indices[frame_indices < start_frame_idx+i['num_frames']]
-
-                    # comment out it to enable dynamic frames training
-                    if len(frame_indices) < self.num_frames and torch.rand(1, generator=self.generator).item() < self.drop_short_ratio:
-                        cnt_too_short += 1
-                        continue
-
-                    #  too long video will be temporal-crop randomly
-                    if len(frame_indices) > self.num_frames:
-                        begin_index, end_index = self.temporal_sample(len(frame_indices))
-                        frame_indices = frame_indices[begin_index: end_index]
-                        # frame_indices = frame_indices[:self.num_frames]  # head crop
-                    # to find a suitable end_frame_idx, to ensure we do not need pad video
-                    end_frame_idx = find_closest_y(
-                        len(frame_indices), vae_stride_t=self.ae_stride_t, model_ds_t=self.sp_size
-                        )
-                    if end_frame_idx == -1:  # too short that can not be encoded exactly by videovae
-                        cnt_too_short += 1
-                        continue
-                    frame_indices = frame_indices[:end_frame_idx]
-
-                    i['sample_frame_index'] = frame_indices.tolist()
-
-                    new_cap_list.append(i)
-                    cnt_vid_after_filter += 1
-
-                elif path.endswith('.jpg'):  # image
-                    cnt_img_after_filter += 1
-                    i['sample_frame_index'] = [0]
-                    new_cap_list.append(i)
-                
-                else:
-                    raise NameError(f"Unknown file extention {path.split('.')[-1]}, only support .mp4 for video and .jpg for image")
-
-                pre_define_shape = f"{len(i['sample_frame_index'])}x{sample_h}x{sample_w}"
-                sample_size.append(pre_define_shape)
-                # if shape_idx_dict.get(pre_define_shape, None) is None:
-                #     shape_idx_dict[pre_define_shape] = [index]
-                # else:
-                #     shape_idx_dict[pre_define_shape].append(index)
-        counter = Counter(sample_size)
-        counter_cp = counter
-        if not self.force_resolution and self.max_hxw is not None and self.min_hxw is not None:
-            assert all([np.prod(np.array(k.split('x')[1:]).astype(np.int32)) <= self.max_hxw for k in counter_cp.keys()])
-            assert all([np.prod(np.array(k.split('x')[1:]).astype(np.int32)) >= self.min_hxw for k in counter_cp.keys()])
-
-        len_before_filter_major = len(sample_size)
-        filter_major_num = 4 * self.total_batch_size
-        new_cap_list, sample_size = zip(*[[i, j] for i, j in zip(new_cap_list, sample_size) if counter[j] >= filter_major_num])
-        for idx, shape in enumerate(sample_size):
-            if shape_idx_dict.get(shape, None) is None:
-                shape_idx_dict[shape] = [idx]
-            else:
-                shape_idx_dict[shape].append(idx)
-        cnt_filter_minority = len_before_filter_major - len(sample_size) 
-        counter = Counter(sample_size)
-        
-        print(f'no_cap: {cnt_no_cap}, no_resolution: {cnt_no_resolution}\n'
-                f'too_long: {cnt_too_long}, too_short: {cnt_too_short}\n'
-                f'cnt_img_res_mismatch_stride: {cnt_img_res_mismatch_stride}, cnt_vid_res_mismatch_stride: {cnt_vid_res_mismatch_stride}\n'
-                f'cnt_img_res_too_small: {cnt_img_res_too_small}, cnt_vid_res_too_small: {cnt_vid_res_too_small}\n'
-                f'cnt_img_aspect_mismatch: {cnt_img_aspect_mismatch}, cnt_vid_aspect_mismatch: {cnt_vid_aspect_mismatch}\n'
-                f'cnt_filter_minority: {cnt_filter_minority}\n'
-                f'Counter(sample_size): {counter}\n'
-                f'cnt_vid: {cnt_vid}, cnt_vid_after_filter: {cnt_vid_after_filter}, use_ratio: {round(cnt_vid_after_filter/(cnt_vid+1e-6), 5)*100}%\n'
-                f'cnt_img: {cnt_img}, cnt_img_after_filter: {cnt_img_after_filter}, use_ratio: {round(cnt_img_after_filter/(cnt_img+1e-6), 5)*100}%\n'
-                f'before filter: {cnt}, after filter: {len(new_cap_list)}, use_ratio: {round(len(new_cap_list)/cnt, 5)*100}%')
-        # import ipdb;ipdb.set_trace()
-        
-        if len(aesthetic_score) > 0:
-            stats_aesthetic = calculate_statistics(aesthetic_score)
-            print(f"before filter: {cnt}, after filter: {len(new_cap_list)}\n"
-                f"aesthetic_score: {len(aesthetic_score)}, cnt_no_aesthetic: {cnt_no_aesthetic}\n"
-                f"{len([i for i in aesthetic_score if i>=5.75])} > 5.75, 4.5 > {len([i for i in aesthetic_score if i<=4.5])}\n"
-                f"Mean: {stats_aesthetic['mean']}, Var: {stats_aesthetic['variance']}, Std: {stats_aesthetic['std_dev']}\n"
-                f"Min: {stats_aesthetic['min']}, Max: {stats_aesthetic['max']}")
-
+        """
+        Filter the records of `data` and bucket them by shape. The kept records are returned as read, what the filter
+        derived for them (sample size, frame range) is left in `self.frame_index_columns` for `write_meta_index`.
+        """
+        sub_lists, columns_list, cnt_quarantined = [], [], 0
+        with gc_paused():
+            for sub_root, anno, sub_list in read_annotations(data):
+                if len(self.quarantine) > 0:
+                    n = len(sub_list)
+                    sub_list = [i for i in sub_list if os.path.join(sub_root, i['path']) not in self.quarantine]
+                    cnt_quarantined += n - len(sub_list)
+                columns_list.append(annotation_columns(sub_list, sub_root))
+                sub_lists.append(sub_list)
+            records = [i for sub_list in sub_lists for i in sub_list]
+            columns = concat_columns(columns_list)
+            frame_index = FrameIndexBuilder.from_dataset(self)(columns)
+            new_cap_list = [records[row] for row in frame_index['rows'].tolist()]
+        self.frame_index_columns = kept_columns(columns, frame_index)
+
+        bucket_names = frame_index['bucket_names']
+        sample_size = [bucket_names[b] for b in frame_index['bucket'].tolist()]
+        shape_idx_dict = shape_idx_dict_from_buckets(frame_index['bucket'], bucket_names)
+        self.frame_index_counters = frame_index['counters']
+        if cnt_quarantined > 0:
+            print(f'Drop {cnt_quarantined} quarantined samples')
+        report_frame_index(frame_index['counters'], sample_size, frame_index['aesthetic_score'], calculate_statistics)
         return new_cap_list, sample_size, shape_idx_dict
-    
-    def decord_read(self, video_data):
+
+    def decord_read(self, video_data, frame_indices=None):
         path = video_data['path']
-        predefine_frame_indice = video_data['sample_frame_index']
+        sample_frame_range = video_data['sample_frame_range']
         start_frame_idx = video_data['start_frame_idx']
         clip_total_frames = video_data['num_frames']
         fps = video_data['fps']
         s_x, e_x, s_y, e_y = video_data.get('crop', [None, None, None, None])
 
-        predefine_num_frames = len(predefine_frame_indice)
-        # decord_vr = decord.VideoReader(path, ctx=decord.cpu(0), num_threads=1)
-        decord_vr = DecordDecoder(path)
-
-        frame_indices = self.get_actual_frame(
-            fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, predefine_frame_indice
-            )
+        predefine_num_frames = sample_frame_range[2]
+        if frame_indices is None:
+            frame_indices = self.get_actual_frame(
+                fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, sample_frame_range
+                )
         
-        # video_data = decord_vr.get_batch(frame_indices).asnumpy()
-        # video_data = torch.from_numpy(video_data)
-        video_data = decord_vr.get_batch(frame_indices)
-        if video_data is not None:
-            video_data = video_data.permute(0, 3, 1, 2)  # (T, H, W, C) -> (T C H W)
-            if s_y is not None:
-                video_data = video_data[:, :, s_y: e_y, s_x: e_x]
+        # decord_vr = decord.VideoReader(path, ctx=decord.cpu(0), num_threads=1)
+        resolution = video_data['resolution']
+        if 'bytes' in video_data:
+            # streamed from a shard: decode from memory, there is no file to keep a reader open on
+            decord_vr = DecordDecoder(io.BytesIO(video_data['bytes']), shape=(resolution['height'], resolution['width']))
+            video_data = decord_vr.get_batch(frame_indices)
+            if video_data is None:
+                raise ValueError(f'Get video_data {video_data} from {path}')
         else:
-            raise ValueError(f'Get video_data {video_data}')
+            with self.decoder_cache.open(path, shape=(resolution['height'], resolution['width'])) as decord_vr:
+                # video_data = decord_vr.get_batch(frame_indices).asnumpy()
+                # video_data = torch.from_numpy(video_data)
+                video_data = decord_vr.get_batch(frame_indices)
+                if video_data is None:
+                    raise ValueError(f'Get video_data {video_data}')  # raised inside, so the failed reader is not cached
+        video_data = video_data.permute(0, 3, 1, 2)  # (T, H, W, C) -> (T C H W)
+        if s_y is not None:
+            video_data = video_data[:, :, s_y: e_y, s_x: e_x]
         # del decord_vr
         # gc.collect()
         return video_data
     
-    def opencv_read(self, video_data):
+    def opencv_read(self, video_data, frame_indices=None):
         path = video_data['path']
-        predefine_frame_indice = video_data['sample_frame_index']
+        sample_frame_range = video_data['sample_frame_range']
         start_frame_idx = video_data['start_frame_idx']
         clip_total_frames = video_data['num_frames']
         fps = video_data['fps']
         s_x, e_x, s_y, e_y = video_data.get('crop', [None, None, None, None])
 
-        predefine_num_frames = len(predefine_frame_indice)
+        predefine_num_frames = sample_frame_range[2]
+        if 'bytes' in video_data:
+            raise ValueError(f'OpenCV can not decode {path} from memory, use --use_decord to read shards')
+        cv2_vr = cv2.VideoCapture(path)
+        if not cv2_vr.isOpened():
+            raise ValueError(f'can not open {path}')
+        if frame_indices is None:
+            frame_indices = self.get_actual_frame(
+                fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, sample_frame_range
+                )
+
+        try:
+            video_data = opencv_read_frames(cv2_vr, frame_indices, path)  # (T H W C)
+        finally:
+            cv2_vr.release()
+        video_data = torch.from_numpy(video_data).permute(0, 3, 1, 2)  # (T, H, W, C) -> (T C H W)
+        if s_y is not None:
+            video_data = video_data[:, :, s_y: e_y, s_x: e_x]
+        return video_data
+
+    def opencv_read_legacy(self, video_data):
+        """The former seek-per-frame reader, kept for `python -m opensora.dataset.benchmark opencv_read`."""
+        path = video_data['path']
+        sample_frame_range = video_data['sample_frame_range']
+        s_x, e_x, s_y, e_y = video_data.get('crop', [None, None, None, None])
         cv2_vr = cv2.VideoCapture(path)
         if not cv2_vr.isOpened():
             raise ValueError(f'can not open {path}')
         frame_indices = self.get_actual_frame(
-            fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, predefine_frame_indice
+            video_data['fps'], video_data['start_frame_idx'], video_data['num_frames'], path, sample_frame_range[2], sample_frame_range
             )
 
         video_data = []
@@ -622,7 +711,7 @@ class T2V_dataset(Dataset):
             video_data = video_data[:, :, s_y: e_y, s_x: e_x]
         return video_data
 
-    def get_actual_frame(self, fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, predefine_frame_indice):
+    def resample_frame_indices(self, fps, start_frame_idx, clip_total_frames):
         # resample in case high fps, such as 50/60/90/144 -> train_fps(e.g, 24)
         frame_interval = 1.0 if abs(fps - self.train_fps) < 0.1 else fps / self.train_fps
         frame_indices = np.arange(start_frame_idx, start_frame_idx+clip_total_frames, frame_interval).astype(int)
@@ -636,6 +725,27 @@ class T2V_dataset(Dataset):
             target_frame_count = int(len(frame_indices) / speed_factor)
             speed_frame_idx = np.linspace(0, len(frame_indices) - 1, target_frame_count, dtype=int)
             frame_indices = frame_indices[speed_frame_idx]
+        return frame_indices
+
+    def get_frame_windows(self, video_data, num_windows):
+        """
+        Up to `num_windows` non-overlapping windows of `sample_frame_range[2]` frames, at random places of the clip
+        resampled as in `get_actual_frame`, in clip order. A clip too short for two gives the `get_actual_frame` one.
+        """
+        num_frames = video_data['sample_frame_range'][2]
+        frame_indices = self.resample_frame_indices(video_data['fps'], video_data['start_frame_idx'], video_data['num_frames'])
+        k = min(num_windows, len(frame_indices) // num_frames)
+        if k <= 1:
+            return [self.get_actual_frame(
+                video_data['fps'], video_data['start_frame_idx'], video_data['num_frames'], video_data['path'],
+                num_frames, video_data['sample_frame_range']
+                )]
+        # k windows and k + 1 gaps sharing the spare frames at random
+        gaps = sorted(random.randint(0, len(frame_indices) - k * num_frames) for _ in range(k))
+        return [frame_indices[g + i * num_frames: g + (i + 1) * num_frames] for i, g in enumerate(gaps)]
+
+    def get_actual_frame(self, fps, start_frame_idx, clip_total_frames, path, predefine_num_frames, sample_frame_range):
+        frame_indices = self.resample_frame_indices(fps, start_frame_idx, clip_total_frames)
 
         #  too long video will be temporal-crop randomly
         if len(frame_indices) > self.num_frames:
@@ -651,7 +761,7 @@ class T2V_dataset(Dataset):
             raise IndexError(f'video ({path}) has {clip_total_frames} frames, but need to sample {len(frame_indices)} frames ({frame_indices})')
         frame_indices = frame_indices[:end_frame_idx]
         if predefine_num_frames != len(frame_indices):
-            raise ValueError(f'video ({path}) predefine_num_frames ({predefine_num_frames}) ({predefine_frame_indice}) is not equal with frame_indices ({len(frame_indices)}) ({frame_indices})')
+            raise ValueError(f'video ({path}) predefine_num_frames ({predefine_num_frames}) ({frame_range_indices(sample_frame_range)}) is not equal with frame_indices ({len(frame_indices)}) ({frame_indices})')
         if len(frame_indices) < self.num_frames and self.drop_short_ratio >= 1:
             raise IndexError(f'video ({path}) has {clip_total_frames} frames, but need to sample {len(frame_indices)} frames ({frame_indices})')
         return frame_indices
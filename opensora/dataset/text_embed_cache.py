@@ -0,0 +1,195 @@
+import os
+import json
+import time
+
+import numpy as np
+import torch
+
+
+TEXT_EMBED_CACHE_VERSION = 1
+
+
+def _shard_path(root, k, shard):
+    return os.path.join(root, f'emb_{k}.{shard:05d}.npy')
+
+
+class TextEmbedCache(object):
+    """
+    Text encoder outputs of every text of a `TokenCache`, built offline by `python -m opensora.dataset.text_embed_cache`.
+    Rows are split into shards of `shard_size` consecutive token cache rows. For text encoder 1 a shard holds the
+    `last_hidden_state` trimmed to the attention-mask length (concatenated along the token axis, so the token cache
+    offsets locate each text); for text encoder 2 it holds one pooled vector per text. fp16 is stored as float16,
+    bf16 as its uint16 bit pattern. Shards are memory-mapped on first use.
+    """
+
+    def __init__(self, root, token_cache):
+        self.root = root
+        self.token_cache = token_cache
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != TEXT_EMBED_CACHE_VERSION:
+            raise ValueError(f"text embedding cache {root} has version {self.meta['version']}, expected {TEXT_EMBED_CACHE_VERSION}")
+        if self.meta['num_texts'] != len(token_cache):
+            raise ValueError(f"text embedding cache {root} has {self.meta['num_texts']} texts, but the token cache has {len(token_cache)}")
+        missing = [s for s in range(self.meta['num_shards']) if not os.path.exists(_shard_path(root, '1', s))]
+        if len(missing) > 0:
+            raise ValueError(f'text embedding cache {root} misses {len(missing)} shards, e.g. {missing[:8]}, resume the precompute job first')
+        self.shard_size = self.meta['shard_size']
+        self.dtype = torch.bfloat16 if self.meta['dtype'] == 'bf16' else torch.float16
+        self.shards = {}
+
+    def __len__(self):
+        return self.meta['num_texts']
+
+    def _load_shard(self, k, shard):
+        if (k, shard) not in self.shards:
+            self.shards[(k, shard)] = np.load(_shard_path(self.root, k, shard), mmap_mode='r')
+        return self.shards[(k, shard)]
+
+    def _to_tensor(self, array):
+        array = np.array(array)
+        if self.dtype == torch.bfloat16:
+            return torch.from_numpy(array.view(np.int16)).view(torch.bfloat16)
+        return torch.from_numpy(array)
+
+    def get_row(self, idx):
+        """
+        Same layout as `TokenCache.get_row`, but `input_ids_1` is the padded `last_hidden_state` (1, L, D) and
+        `input_ids_2` the pooled embedding (1, D) of text encoder 2.
+        """
+        inputs = self.token_cache.get_row(idx)
+        shard, shard_start = idx // self.shard_size, idx // self.shard_size * self.shard_size
+        offsets, _ = self.token_cache.tokens['1']
+        start, end = offsets[idx] - offsets[shard_start], offsets[idx + 1] - offsets[shard_start]
+        emb = self._to_tensor(self._load_shard('1', shard)[start: end])
+        cond_1 = torch.zeros((1, inputs['cond_mask_1'].shape[1], emb.shape[1]), dtype=self.dtype)
+        cond_1[0, :emb.shape[0]] = emb
+        inputs['input_ids_1'] = cond_1
+        if '2' in self.meta['dims']:
+            pooled = self._load_shard('2', shard)[idx - shard_start]
+            inputs['input_ids_2'] = self._to_tensor(pooled)[None]
+        return inputs
+
+
+def _pad_batch(token_cache, rows, k):
+    lengths = [token_cache.num_tokens(r, k) for r in rows]
+    offsets, data = token_cache.tokens[k]
+    pad_token_id = token_cache.meta['tokenizers'][k]['pad_token_id']
+    input_ids = torch.full((len(rows), max(lengths)), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max(lengths)), dtype=torch.long)
+    for i, r in enumerate(rows):
+        input_ids[i, :lengths[i]] = torch.from_numpy(data[offsets[r]: offsets[r + 1]].astype(np.int64))
+        attention_mask[i, :lengths[i]] = 1
+    return input_ids, attention_mask, lengths
+
+
+def _to_numpy(tensor, dtype):
+    if dtype == 'bf16':
+        return tensor.to(torch.bfloat16).view(torch.int16).cpu().numpy().view(np.uint16)
+    return tensor.to(torch.float16).cpu().numpy()
+
+
+@torch.no_grad()
+def encode_shard(shard, root, token_cache, text_enc_1, text_enc_2, shard_size, batch_size, dtype, device):
+    """
+    Encode the token cache rows of `shard`, batching rows of similar length so little padding is computed,
+    and write the shard files atomically. Returns the number of texts and tokens encoded.
+    """
+    rows = np.arange(shard * shard_size, min((shard + 1) * shard_size, len(token_cache)))
+    lengths_1 = np.array([token_cache.num_tokens(r, '1') for r in rows], dtype=np.int64)
+    offsets_1 = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths_1, out=offsets_1[1:])
+    emb_1, emb_2 = None, None
+    order = np.argsort(lengths_1, kind='stable')
+    for b in range(0, len(order), batch_size):
+        batch = order[b: b + batch_size]
+        input_ids, attention_mask, lengths = _pad_batch(token_cache, rows[batch], '1')
+        hidden = text_enc_1(input_ids.to(device), attention_mask.to(device))  # B L D
+        if emb_1 is None:
+            emb_1 = np.zeros((offsets_1[-1], hidden.shape[-1]), dtype=np.uint16 if dtype == 'bf16' else np.float16)
+        hidden = _to_numpy(hidden, dtype)
+        for i, j in enumerate(batch):
+            emb_1[offsets_1[j]: offsets_1[j + 1]] = hidden[i, :lengths[i]]
+        if text_enc_2 is not None:
+            input_ids_2, attention_mask_2, _ = _pad_batch(token_cache, rows[batch], '2')
+            pooled = _to_numpy(text_enc_2(input_ids_2.to(device), attention_mask_2.to(device)), dtype)  # B D
+            if emb_2 is None:
+                emb_2 = np.zeros((len(rows), pooled.shape[-1]), dtype=pooled.dtype)
+            emb_2[batch] = pooled
+    for k, emb in [('1', emb_1), ('2', emb_2)]:
+        if emb is not None:
+            tmp_path = _shard_path(root, k, shard) + f'.tmp-{os.getpid()}.npy'
+            np.save(tmp_path, emb)
+            os.rename(tmp_path, _shard_path(root, k, shard))
+    return len(rows), int(offsets_1[-1]), (emb_1.shape[-1] if emb_1 is not None else None), \
+        (emb_2.shape[-1] if emb_2 is not None else None)
+
+
+if __name__ == "__main__":
+    '''
+    Precompute the text encoder outputs of a token cache, resumable and split over processes by shard:
+    torchrun --nproc_per_node 8 -m opensora.dataset.text_embed_cache --token_cache_dir /path/to/token_cache \
+        --text_embed_cache_dir /path/to/text_embed_cache --text_encoder_name_1 google/mt5-xxl --cache_dir ../../cache_dir/
+    '''
+    import argparse
+    from opensora.dataset.token_cache import TokenCache
+    from opensora.models.text_encoder import get_text_warpper
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--token_cache_dir", type=str, required=True)
+    parser.add_argument("--text_embed_cache_dir", type=str, required=True)
+    parser.add_argument("--text_encoder_name_1", type=str, default='google/mt5-xxl')
+    parser.add_argument("--text_encoder_name_2", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default='./cache_dir')
+    parser.add_argument("--dtype", type=str, default='bf16', choices=['fp16', 'bf16'])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--shard_size", type=int, default=65536)
+    args = parser.parse_args()
+
+    rank, world_size = int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    device = torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
+
+    token_cache = TokenCache(args.token_cache_dir)
+    token_cache.check(
+        args.text_encoder_name_1, args.text_encoder_name_2, token_cache.meta['model_max_length'], token_cache.meta['support_Chinese']
+        )
+    num_shards = (len(token_cache) + args.shard_size - 1) // args.shard_size
+    os.makedirs(args.text_embed_cache_dir, exist_ok=True)
+    meta_path = os.path.join(args.text_embed_cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['shard_size'] != args.shard_size or meta['dtype'] != args.dtype or meta['num_texts'] != len(token_cache):
+            raise ValueError(f'{meta_path} was written with other args, use a new --text_embed_cache_dir')
+
+    torch_dtype = torch.bfloat16 if args.dtype == 'bf16' else torch.float16
+    text_enc_1 = get_text_warpper(args.text_encoder_name_1)(args, torch_dtype=torch_dtype).eval().to(device)
+    text_enc_2 = None
+    if args.text_encoder_name_2 is not None:
+        text_enc_2 = get_text_warpper(args.text_encoder_name_2)(args, torch_dtype=torch_dtype).eval().to(device)
+
+    todo = [s for s in range(rank, num_shards, world_size) if not os.path.exists(_shard_path(args.text_embed_cache_dir, '1', s))]
+    print(f'rank {rank}/{world_size}: {len(todo)} of {num_shards} shards left')
+    s = time.time()
+    total_texts, total_tokens, dims = 0, 0, {}
+    for i, shard in enumerate(todo):
+        num_texts, num_tokens, dim_1, dim_2 = encode_shard(
+            shard, args.text_embed_cache_dir, token_cache, text_enc_1, text_enc_2,
+            args.shard_size, args.batch_size, args.dtype, device
+            )
+        total_texts, total_tokens = total_texts + num_texts, total_tokens + num_tokens
+        dims = {k: v for k, v in [('1', dim_1), ('2', dim_2)] if v is not None}
+        e = time.time()
+        print(f'rank {rank}: shard {shard} done ({i+1}/{len(todo)}), '
+              f'{total_texts/(e-s):.1f} texts/s, {total_tokens/(e-s):.1f} tokens/s', flush=True)
+
+    if len(dims) > 0:
+        meta = dict(
+            version=TEXT_EMBED_CACHE_VERSION, num_texts=len(token_cache), num_shards=num_shards, shard_size=args.shard_size,
+            dtype=args.dtype, dims=dims, text_encoder_name_1=args.text_encoder_name_1, text_encoder_name_2=args.text_encoder_name_2,
+            )
+        tmp_path = f'{meta_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.rename(tmp_path, meta_path)
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from opensora.utils.utils import text_preprocessing
+
+
+TOKEN_CACHE_VERSION = 1
+
+
+def caption_key(text, clean):
+    """64-bit key of the exact string handed to the tokenizers, `clean` meaning `text_preprocessing` runs first."""
+    digest = hashlib.blake2b(f'{int(clean)}\x00{text}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class TokenCache(object):
+    """
+    Pre-tokenized captions, built offline by `build_token_cache`. Keys are sorted uint64 `caption_key`s, and
+    every tokenizer has an int32 token table (offsets + unpadded ids), all opened with `mmap_mode='r'`.
+    `get` returns the same padded `input_ids`/`attention_mask` tensors as calling the tokenizers with
+    `padding='max_length'`, or None on a cache miss.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != TOKEN_CACHE_VERSION:
+            raise ValueError(f"token cache {root} has version {self.meta['version']}, expected {TOKEN_CACHE_VERSION}")
+        self.keys = np.load(os.path.join(root, 'keys.npy'), mmap_mode='r')
+        self.tokens = {}
+        for k in self.meta['tokenizers'].keys():
+            offsets = np.load(os.path.join(root, f'tokens_{k}.offsets.npy'), mmap_mode='r')
+            data = np.load(os.path.join(root, f'tokens_{k}.data.npy'), mmap_mode='r')
+            self.tokens[k] = (offsets, data)
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def check(self, text_encoder_name_1, text_encoder_name_2, model_max_length, support_Chinese):
+        expected = dict(
+            text_encoder_name_1=text_encoder_name_1, text_encoder_name_2=text_encoder_name_2,
+            model_max_length=model_max_length, support_Chinese=support_Chinese
+            )
+        for k, v in expected.items():
+            if self.meta[k] != v:
+                raise ValueError(f'token cache {self.root} was built with {k}={self.meta[k]}, but got {v}')
+
+    def index(self, text, clean):
+        """Row of `text` in the cache, -1 on a miss."""
+        key = caption_key(text, clean)
+        idx = int(np.searchsorted(self.keys, key))
+        if idx >= len(self.keys) or self.keys[idx] != key:
+            self.num_misses += 1
+            return -1
+        self.num_hits += 1
+        return idx
+
+    def num_tokens(self, idx, k='1'):
+        offsets, _ = self.tokens[k]
+        return int(offsets[idx + 1] - offsets[idx])
+
+    def get(self, text, clean):
+        idx = self.index(text, clean)
+        return self.get_row(idx) if idx >= 0 else None
+
+    def get_row(self, idx):
+        inputs = dict(input_ids_2=None, cond_mask_2=None)
+        for k, (offsets, data) in self.tokens.items():
+            tokenizer = self.meta['tokenizers'][k]
+            tokens = torch.from_numpy(data[offsets[idx]: offsets[idx + 1]].astype(np.int64))
+            input_ids = torch.full((1, tokenizer['max_length']), tokenizer['pad_token_id'], dtype=torch.long)
+            cond_mask = torch.zeros((1, tokenizer['max_length']), dtype=torch.long)
+            input_ids[0, :len(tokens)] = tokens
+            cond_mask[0, :len(tokens)] = 1
+            inputs[f'input_ids_{k}'], inputs[f'cond_mask_{k}'] = input_ids, cond_mask
+        return inputs
+
+
+_worker_tokenizers = None
+
+
+def _init_worker(tokenizers, cache_dir, support_Chinese):
+    from transformers import AutoTokenizer
+    global _worker_tokenizers
+    _worker_tokenizers = dict(
+        support_Chinese=support_Chinese,
+        tokenizers={
+            k: (AutoTokenizer.from_pretrained(v['name'], cache_dir=cache_dir), v['max_length'])
+            for k, v in tokenizers.items()
+            }
+        )
+
+
+def _tokenize_chunk(chunk):
+    support_Chinese = _worker_tokenizers['support_Chinese']
+    keys = np.array([caption_key(text, clean) for text, clean in chunk], dtype=np.uint64)
+    texts = [text_preprocessing([text], support_Chinese=support_Chinese) if clean else text for text, clean in chunk]
+    tokens = {}
+    for k, (tokenizer, max_length) in _worker_tokenizers['tokenizers'].items():
+        input_ids = tokenizer(
+            texts, max_length=max_length, padding=False, truncation=True, add_special_tokens=True
+            )['input_ids']
+        lengths = np.array([len(i) for i in input_ids], dtype=np.int64)
+        data = np.fromiter((t for i in input_ids for t in i), dtype=np.int32, count=int(lengths.sum()))
+        tokens[k] = (lengths, data)
+    return keys, tokens
+
+
+def _sort_ragged(lengths, data, order):
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    lengths = lengths[order]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    gather = np.repeat(starts[order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return offsets, data[gather]
+
+
+def build_token_cache(root, texts, text_encoder_name_1, text_encoder_name_2, model_max_length, support_Chinese,
+                      cache_dir=None, num_workers=8, chunk_size=4096):
+    """
+    Clean and tokenize every `(text, clean)` pair in `texts` with `num_workers` processes and write the
+    result under `root`.
+    """
+    from transformers import AutoTokenizer
+
+    texts = sorted(set(texts))
+    tokenizers = dict([('1', dict(name=text_encoder_name_1, max_length=model_max_length))])
+    if text_encoder_name_2 is not None:
+        tokenizer_2 = AutoTokenizer.from_pretrained(text_encoder_name_2, cache_dir=cache_dir)
+        tokenizers['2'] = dict(name=text_encoder_name_2, max_length=tokenizer_2.model_max_length)
+    for k, v in tokenizers.items():
+        v['pad_token_id'] = AutoTokenizer.from_pretrained(v['name'], cache_dir=cache_dir).pad_token_id
+
+    s = time.time()
+    chunks = [texts[i: i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    keys, tokens = [], {k: ([], []) for k in tokenizers.keys()}
+    with Pool(num_workers, initializer=_init_worker, initargs=(tokenizers, cache_dir, support_Chinese)) as pool:
+        for chunk_keys, chunk_tokens in tqdm(pool.imap(_tokenize_chunk, chunks), total=len(chunks)):
+            keys.append(chunk_keys)
+            for k, (lengths, data) in chunk_tokens.items():
+                tokens[k][0].append(lengths)
+                tokens[k][1].append(data)
+    keys = np.concatenate(keys) if len(keys) > 0 else np.zeros(0, dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    if np.any(keys[1:] == keys[:-1]):
+        raise ValueError('caption_key collision, the token cache can not be built')
+
+    tmp_root = f'{root}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    os.makedirs(tmp_root)
+    np.save(os.path.join(tmp_root, 'keys.npy'), keys)
+    for k, (lengths, data) in tokens.items():
+        lengths = np.concatenate(lengths) if len(lengths) > 0 else np.zeros(0, dtype=np.int64)
+        data = np.concatenate(data) if len(data) > 0 else np.zeros(0, dtype=np.int32)
+        offsets, data = _sort_ragged(lengths, data, order)
+        np.save(os.path.join(tmp_root, f'tokens_{k}.offsets.npy'), offsets)
+        np.save(os.path.join(tmp_root, f'tokens_{k}.data.npy'), data)
+    meta = dict(
+        version=TOKEN_CACHE_VERSION, num_texts=len(keys), tokenizers=tokenizers,
+        text_encoder_name_1=text_encoder_name_1, text_encoder_name_2=text_encoder_name_2,
+        model_max_length=model_max_length, support_Chinese=support_Chinese,
+        )
+    with open(os.path.join(tmp_root, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(root, ignore_errors=True)
+    os.rename(tmp_root, root)
+    e = time.time()
+    print(f'Build token cache {root} with {len(keys)} texts in {e-s:.1f}s ({len(keys)/max(e-s, 1e-6):.0f} texts/s)')
+
+
+def annotation_texts(data, dataset_cls):
+    """All `(text, clean)` pairs `dataset_cls` can tokenize for the annotations listed in the `--data` txt."""
+    from opensora.dataset.frame_index import read_annotations
+
+    texts = set(dataset_cls.constant_texts)
+    for sub_root, anno, sub_list in read_annotations(data):
+        for record in sub_list:
+            if record.get('cap', None) is None:
+                continue
+            record['path'] = os.path.join(sub_root, record['path'])
+            texts.update(dataset_cls.caption_variants(record))
+    return texts
+
+
+if __name__ == "__main__":
+    '''
+    Pre-tokenize every caption variant (aesthetic/masking notices included) of the annotations:
+    python -m opensora.dataset.token_cache --data scripts/train_data/merge_data.txt --token_cache_dir /path/to/cache \
+        --dataset t2v --text_encoder_name_1 google/mt5-xxl --model_max_length 512 --num_workers 32
+    '''
+    import argparse
+    from opensora.dataset.t2v_datasets import T2V_dataset
+    from opensora.dataset.inpaint_dataset import Inpaint_dataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, required=True)
+    parser.add_argument("--token_cache_dir", type=str, required=True)
+    parser.add_argument("--dataset", type=str, default='t2v', choices=['t2v', 'i2v', 'inpaint'])
+    parser.add_argument("--text_encoder_name_1", type=str, default='google/mt5-xxl')
+    parser.add_argument("--text_encoder_name_2", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default='./cache_dir')
+    parser.add_argument("--model_max_length", type=int, default=512)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--chunk_size", type=int, default=4096)
+    args = parser.parse_args()
+
+    dataset_cls = T2V_dataset if args.dataset == 't2v' else Inpaint_dataset
+    support_Chinese = 'mt5' in args.text_encoder_name_1 or \
+        (args.text_encoder_name_2 is not None and 'mt5' in args.text_encoder_name_2)
+    texts = annotation_texts(args.data, dataset_cls)
+    build_token_cache(
+        args.token_cache_dir, texts, args.text_encoder_name_1, args.text_encoder_name_2, args.model_max_length,
+        support_Chinese, cache_dir=args.cache_dir, num_workers=args.num_workers, chunk_size=args.chunk_size
+        )
@@ -51,6 +51,7 @@ def crop(clip, i, j, h, w):
 
 
 def resize(clip, target_size, interpolation_mode):
+    # uint8 clips stay uint8 (torch has a fast antialiased uint8 kernel, best on the channels-last frames decoders return)
     if len(target_size) != 2:
         raise ValueError(f"target size should be tuple (height, width), instead got {target_size}")
     return torch.nn.functional.interpolate(clip, size=target_size, mode=interpolation_mode, align_corners=True, antialias=True)
@@ -372,7 +373,7 @@ class MaxHWResizeVideo:
         return resize_clip
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(size={self.size}, interpolation_mode={self.interpolation_mode}"
+        return f"{self.__class__.__name__}(max_hxw={self.max_hxw}, interpolation_mode={self.interpolation_mode})"
 
 
 class CenterCropResizeVideo:
@@ -787,6 +788,29 @@ def add_high_aesthetic_notice_image_human(caption):
     notice = random.choice(high_aesthetic_score_notices_image_human)
     return random.choice([caption + ' ' + notice, notice + ' ' + caption])
 
+# every caption the add_*_notice functions above can return, used to pre-tokenize captions offline
+def notice_variants(caption, notices):
+    return [j for notice in notices for j in [caption + ' ' + notice, notice + ' ' + caption]]
+
+def masking_notice_variants(caption):
+    if any(keyword in caption for keyword in keywords):
+        return notice_variants(caption, masking_notices)
+    return [caption]
+
+def aesthetic_notice_variants_video(caption, aesthetic_score):
+    if aesthetic_score <= 4.25:
+        return notice_variants(caption, low_aesthetic_score_notices_video)
+    if aesthetic_score >= 5.75:
+        return notice_variants(caption, high_aesthetic_score_notices_video)
+    return [caption]
+
+def aesthetic_notice_variants_image(caption, aesthetic_score):
+    if aesthetic_score <= 4.25:
+        return notice_variants(caption, low_aesthetic_score_notices_image)
+    if aesthetic_score >= 5.75:
+        return notice_variants(caption, high_aesthetic_score_notices_image)
+    return [caption]
+
 def basic_clean(text):
     text = ftfy.fix_text(text)
     text = html.unescape(html.unescape(text))
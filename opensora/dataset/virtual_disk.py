@@ -1,8 +1,16 @@
 import subprocess
 import json
-import pickle
-from collections import OrderedDict
-from opensora.npu_config import npu_config
+import time
+import fcntl
+import shutil
+import heapq
+import random
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from opensora.dataset.decode_engine import LatencyHistogram
 
 import sys
 import os
@@ -33,6 +41,7 @@ class ObsConnection:
     keys & tokens: https://uconsole.ccaicc.com/#/mgt/modelarts -> 对象控制台 -> 获取访问密匙(AK 和 SK)
     """
     def __init__(self):
+        from opensora.npu_config import npu_config
         with open(f"{npu_config.work_path}/scripts/train_data/key.json", "r") as f:
             key = json.load(f)
         self.AK = key["AK"]
@@ -54,28 +63,109 @@ class ObsConnection:
         else:
             print("Successfully configured obsutil")
 
+
+def file_md5(path, chunk_size=1 << 22):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class ObsBackend:
+    """
+    Objects of the OBS bucket, each fetched by an obsutil subprocess. obsutil checks the MD5 of the download against
+    the object itself (`-vmd5`), so `checksum` has nothing to add.
+    """
+    def __init__(self, obs="/home/opensora/obsutil_linux_arm64_5.5.12/obsutil"):
+        self.obs = obs
+        self.connection = ObsConnection()
+        self.connection.connect(obs)
+
+    def checksum(self, key):
+        return None
+
+    def fetch(self, key, local_path):
+        # the output is captured instead of swapping sys.stdout, which concurrent fetches would race on
+        result = subprocess.run(
+            [self.obs, 'cp', f'obs://{self.connection.bucket}/{key.lstrip("/")}', local_path, '-vmd5'],
+            capture_output=True, text=True
+            )
+        if result.returncode != 0:
+            raise IOError(f"obsutil cp of {key} failed: {result.stderr or result.stdout}")
+
+
+class LocalDirBackend:
+    """Objects stored as files under `root`, a stand-in for the remote store (tests, or a slow network mount)."""
+    def __init__(self, root):
+        self.root = root
+
+    def checksum(self, key):
+        """MD5 the fetched file is checked against, None to skip the check."""
+        return file_md5(os.path.join(self.root, key.lstrip('/')))
+
+    def fetch(self, key, local_path):
+        shutil.copyfile(os.path.join(self.root, key.lstrip('/')), local_path)
+
+
 class VirtualDisk:
     """
+    Local cache of remote objects, bounded to `size` bytes with LRU eviction. A cached object is a file under
+    `storage_dir/data` at its key as relative path. The index is an append-only log of JSON lines `[key, size]`
+    (`size` None once evicted) shared by the DataLoader workers of all ranks on a host: a download appends one line,
+    and every process replays only the lines added since it last looked to keep its tally of the cache size. Only
+    when that tally is over `size` does a process take the index flock and evict the least recently used files, by
+    file mtime (bumped by every hit), down to `low_watermark` of `size`; the log is compacted then too. A key is
+    fetched once at a time on the host: the threads of a process wait on one future, processes on a striped per-key
+    flock. `prefetch` fetches the files the sampler hands out next on `num_threads` background threads.
+
+    At most `max_transfers` downloads run at once on the host, each holding one of as many flock slots, so the
+    workers of all ranks share the bandwidth instead of queueing behind each other on the remote store. A failed
+    download (including a checksum mismatch) is retried `max_retries` times with exponential backoff and jitter.
+    Hits, misses, bytes, retries and download latencies are counted per process, see `stats`.
+
     :param storage_dir: 内存虚拟磁盘的挂载点路径。
     :param size: 内存虚拟磁盘的大小，例如 '1G'。
     :param obs: linux 系统里面obs具体位置
-    :param connection: 抽象出obs连接管理
+    :param backend: remote store with a `fetch(key, local_path)` method, the OBS bucket through obsutil by default
+    :param ramdisk: mount `storage_dir` as tmpfs, by default only with the OBS backend
+    :param min_age: files used in the last `min_age` seconds are not evicted, a reader may be about to open them
+    :param verify: check a download against `backend.checksum(key)` before it enters the cache
+    :param low_watermark: fraction of `size` an eviction frees the cache down to
     """
-    def __init__(self, storage_dir, size="1G", obs="/home/opensora/obsutil_linux_arm64_5.5.12/obsutil"):
-        self.obs = obs
-        self.connection = ObsConnection()
-        self.connection.connect(obs)
+    num_lock_stripes = 256
+
+    def __init__(self, storage_dir, size="1G", obs="/home/opensora/obsutil_linux_arm64_5.5.12/obsutil",
+                 backend=None, ramdisk=None, num_threads=8, min_age=30.0, max_transfers=32, max_retries=3,
+                 backoff=0.5, verify=True, low_watermark=0.9):
+        self.backend = ObsBackend(obs) if backend is None else backend
         os.makedirs(storage_dir, exist_ok=True)
         self.storage_dir = storage_dir
         self.size = self._convert_size_to_bytes(size)
-        if not self.is_tmpfs_mounted():
-            self.create_ramdisk()
-        else:
-            print(f"{self.storage_dir} is already mounted as tmpfs.")
-        self.index_file = os.path.join(self.storage_dir, 'index.pkl')
-        self.index = self.load_index()
-        self.lru = OrderedDict()
-        self.current_size = self.get_total_storage_size()  # 初始化时计算总大小
+        if ramdisk if ramdisk is not None else backend is None:
+            if not self.is_tmpfs_mounted():
+                self.create_ramdisk()
+            else:
+                print(f"{self.storage_dir} is already mounted as tmpfs.")
+        self.data_dir = os.path.join(self.storage_dir, 'data')
+        self.lock_dir = os.path.join(self.storage_dir, 'locks')
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.index_file = os.path.join(self.storage_dir, 'index.log')
+        self.index_lock = os.path.join(self.storage_dir, 'index.lock')
+        self.num_threads = num_threads
+        self.min_age = min_age
+        self.max_transfers = max_transfers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.verify = verify
+        self.low_watermark = low_watermark
+        self.index, self.current_size = {}, 0
+        self._log_inode, self._log_offset, self._log_lines = None, 0, 0
+        self.load_index()
+        self._pid = None
+        print(f"Virtual disk {self.storage_dir}: {len(self.index)} cached files, "
+              f"{self.current_size / 1024 ** 3:.2f} of {self.size / 1024 ** 3:.2f} GB")
     
     def _convert_size_to_bytes(self, size):
         unit = size[-1].upper()
@@ -109,19 +199,57 @@ class VirtualDisk:
     def load_index(self):
         """
         加载索引文件。
-        :return: 索引字典。
+        Replays the whole log.
         """
-        if os.path.exists(self.index_file):
-            with open(self.index_file, 'rb') as f:
-                return pickle.load(f)
-        return {}
+        self._replay()
+        return self.index
 
     def save_index(self):
         """
         保存索引文件。
+        Compacts the log to one line per cached file, written aside and renamed over it. Called with the index lock
+        held exclusively: appenders hold it shared, so none of their lines goes to the replaced file.
         """
-        with open(self.index_file, 'wb') as f:
-            pickle.dump(self.index, f)
+        tmp_path = f'{self.index_file}.tmp-{os.getpid()}-{threading.get_ident()}'
+        with open(tmp_path, 'w') as f:
+            for key, size in self.index.items():
+                f.write(json.dumps([key, size]) + '\n')
+            offset, inode = f.tell(), os.fstat(f.fileno()).st_ino
+        os.rename(tmp_path, self.index_file)
+        self._log_inode, self._log_offset, self._log_lines = inode, offset, len(self.index)
+
+    def _write_log(self, entries):
+        # one write of whole lines with O_APPEND, so the lines of concurrent writers never interleave
+        data = ''.join(json.dumps([key, size]) + '\n' for key, size in entries).encode('utf-8')
+        fd = os.open(self.index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _replay(self):
+        """Apply the log lines appended since the last call to `index` and `current_size`."""
+        try:
+            f = open(self.index_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._log_inode:  # compacted since, start over on the new log
+                self.index, self.current_size = {}, 0
+                self._log_inode, self._log_offset, self._log_lines = inode, 0, 0
+            f.seek(self._log_offset)
+            data = f.read()
+        # a line still being written is left for the next call
+        data = data[:data.rfind(b'\n') + 1]
+        self._log_offset += len(data)
+        for line in data.splitlines():
+            key, size = json.loads(line)
+            self.current_size -= self.index.pop(key, 0)
+            if size is not None:
+                self.index[key] = size
+                self.current_size += size
+            self._log_lines += 1
  
     """
     取消挂载内存虚拟磁盘。
@@ -153,78 +281,201 @@ class VirtualDisk:
             print(f"An error occurred while checking if tmpfs is mounted: {e}")
             return False
 
-    def get_data(self, key):
-        """
-        获取存储在本地磁盘上的数据。如果数据不存在，通过 obsutil 从远端获取并存储。
-        :param key: 数据的唯一键。
-        :return: 数据。
-        """
-        # if key in self.index:
-        #     data_file = self.index[key]
-        #     if os.path.exists(data_file):
-        #         self.lru.move_to_end(key)
-        #         with open(data_file, 'rb') as f:
-        #             # print(f"Successfully get {key} from local")
-        #             return pickle.load(f)
+    def _start(self):
+        # threads do not survive the fork into DataLoader workers, so every process builds its own pool
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self.lock = threading.Lock()
+            self.index_mutex = threading.Lock()
+            self.inflight = {}  # key -> future of its fetch
+            self.num_hits, self.num_misses, self.num_bytes, self.num_retries, self.num_failures = 0, 0, 0, 0, 0
+            self.histogram = LatencyHistogram()
 
+    @contextmanager
+    def _flock(self, path, operation=fcntl.LOCK_EX):
+        with open(path, 'a') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
-        # 如果数据不存在，使用 obsutil 从远端获取
-        object_name = key  # 假设 key 对应于远端对象名称
-        local_path = os.path.join(self.storage_dir, key)
+    def _key_lock(self, key):
+        stripe = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self.num_lock_stripes
+        return os.path.join(self.lock_dir, f'{stripe:03d}.lock')
 
-        with self.connection.suppress_stdout:
-            self.download_and_convert_to_pickle(self.connection.bucket, object_name, local_path)
+    @contextmanager
+    def _transfer_slot(self):
+        """One of the `max_transfers` download slots of the host, polled without blocking."""
+        while True:
+            for slot in random.sample(range(self.max_transfers), self.max_transfers):
+                f = open(os.path.join(self.lock_dir, f'transfer.{slot:03d}.lock'), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    f.close()
+                return
+            time.sleep(0.01)
 
-        # 保存数据的位置
-        # self.index[key] = local_path
-        # self.save_index()
-        # self.lru[key] = local_path
-        #
-        # file_size = os.path.getsize(local_path)
-        # self.current_size += file_size
+    def _download(self, key, tmp_path):
+        """Fetch `key` into `tmp_path`, verified and retried with backoff; returns the seconds the transfer took."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._transfer_slot():
+                    s = time.perf_counter()
+                    expected = self.backend.checksum(key) if self.verify else None
+                    self.backend.fetch(key, tmp_path)
+                    seconds = time.perf_counter() - s
+                if expected is not None and file_md5(tmp_path) != expected:
+                    raise IOError(f"checksum mismatch of {key}")
+                return seconds
+            except FileNotFoundError:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                with self.lock:
+                    self.num_retries += 1
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                print(f"Fetch of {key} failed ({e}), retry in {delay:.1f}s")
+                time.sleep(delay)
 
-        # self.ensure_storage_limit()
+    def stats(self):
+        self._start()
+        with self.lock:
+            return dict(
+                num_hits=self.num_hits, num_misses=self.num_misses, num_bytes=self.num_bytes,
+                num_retries=self.num_retries, num_failures=self.num_failures, latency=self.histogram.state_dict(),
+                )
 
-        return local_path
+    def local_path(self, key):
+        return os.path.join(self.data_dir, key.lstrip('/'))
 
-    def del_data(self, local_path):
-        os.remove(local_path)
-
-    def download_and_convert_to_pickle(self, bucket, object_name, local_path):
+    def get_data(self, key):
         """
-        使用 obsutil 从 OBS 下载文件并转换为 pickle 格式存储到本地路径。
-        :param bucket: OBS 存储桶名称。
-        :param object_name: OBS 中的对象名称。
-        :param local_path: 本地文件路径。
+        获取存储在本地磁盘上的数据。如果数据不存在，从 backend 获取并存储。
+        :param key: 数据的唯一键 (远端对象名称)。
+        :return: 本地文件路径。
         """
-        # try:
-            # 下载文件到local_path路径
-        subprocess.run([self.obs, 'cp', f'obs://{bucket}/{object_name}', local_path], check=True)
-            # print(f"Successfully downloaded obs://{bucket}/{object_name} to {local_path}.")
+        self._start()
+        local_path = self.local_path(key)
+        try:
+            os.utime(local_path)  # a hit, and the mtime is the LRU clock of every process on the host
+            with self.lock:
+                self.num_hits += 1
+            return local_path
+        except FileNotFoundError:
+            pass
+        return self._submit(key).result()
+
+    def prefetch(self, keys):
+        """Fetch `keys` in the background, e.g. the files of the batches the sampler hands out next."""
+        self._start()
+        for key in keys:
+            if key not in self.inflight and not os.path.exists(self.local_path(key)):
+                self._submit(key)
+
+    def _submit(self, key):
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.executor.submit(self._fetch, key)
+                self.inflight[key] = future
+        return future
 
-        # except subprocess.CalledProcessError as e:
-        #     print(f"Failed to download obs://{bucket}/{object_name} to {local_path}: {e}")
+    def _fetch(self, key):
+        local_path = self.local_path(key)
+        try:
+            with self._flock(self._key_lock(key)):  # one fetch of a key at a time on the host
+                if not os.path.exists(local_path):
+                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                    tmp_path = f'{local_path}.tmp-{os.getpid()}-{threading.get_ident()}'
+                    try:
+                        seconds = self._download(key, tmp_path)
+                        os.rename(tmp_path, local_path)
+                    except Exception:
+                        with self.lock:
+                            self.num_failures += 1
+                        raise
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                    os.utime(local_path)
+                    size = os.path.getsize(local_path)
+                    with self.lock:
+                        self.num_misses += 1
+                        self.num_bytes += size
+                        self.histogram.add(key, seconds)
+                    self._add_index(key, size)
+                else:
+                    os.utime(local_path)
+            return local_path
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def _add_index(self, key, size):
+        """Log a downloaded file, and evict only if the cache is over its size now."""
+        with self._flock(self.index_lock, fcntl.LOCK_SH):
+            self._write_log([(key, size)])
+        with self.index_mutex:
+            self._replay()
+            if self.current_size <= self.size:
+                return
+            with self._flock(self.index_lock):
+                self.ensure_storage_limit()
+
+    def del_data(self, local_path):
+        try:
+            os.remove(local_path)
+        except FileNotFoundError:
+            pass
 
     def ensure_storage_limit(self):
         """
         确保存储总大小不超过虚拟磁盘大小，超出时根据LRU策略删除最旧的文件。
+        Called with the index lock held exclusively. Another process may have evicted already, so the log is replayed
+        first; then files are evicted by oldest mtime down to `low_watermark` of the size.
         """
-        while self.current_size > self.size:
-            oldest_key, oldest_path = self.lru.popitem(last=False)
-            file_size = os.path.getsize(oldest_path)
-            os.remove(oldest_path)
-            del self.index[oldest_key]
+        self._replay()
+        if self.current_size <= self.size:
+            return
+        heap, removed = [], []
+        for key in self.index:
+            try:
+                heap.append((os.path.getmtime(self.local_path(key)), key))
+            except FileNotFoundError:
+                removed.append(key)
+        heapq.heapify(heap)
+        now = time.time()
+        freed = sum(self.index[key] for key in removed)
+        while self.current_size - freed > self.size * self.low_watermark and len(heap) > 0:
+            mtime, key = heapq.heappop(heap)
+            if now - mtime < self.min_age:
+                if self.current_size - freed > self.size:
+                    print(f"Virtual disk {self.storage_dir} is {self.current_size - freed - self.size} bytes over its limit, "
+                          f"every file left was used in the last {self.min_age}s")
+                break
+            removed.append(key)
+            freed += self.index[key]
+        # logged before the files go, so a download of an evicted key is always logged after its eviction
+        self._write_log([(key, None) for key in removed])
+        for key in removed:
+            self.del_data(self.local_path(key))
+        self._replay()
+        if self._log_lines > 2 * len(self.index) + 1024:
             self.save_index()
-            print(f"Removed {oldest_key} to free up {file_size} bytes.")
-            self.current_size -= file_size
 
     def get_total_storage_size(self):
         """
         获取当前所有存储文件的总大小。
         :return: 总大小（字节）。
         """
-        total_size = 0
-        for path in self.lru.values():
-            if os.path.exists(path):
-                total_size += os.path.getsize(path)
-        return total_size
\ No newline at end of file
+        return sum(self.index.values())
@@ -1,5 +1,6 @@
 from torchvision.transforms import Lambda
 from .model.vae import CausalVAEModel, WFVAEModel
+from .model.utils.distrib_utils import DiagonalGaussianDistribution
 from einops import rearrange
 import torch
 try:
@@ -20,6 +21,15 @@ class CausalVAEModelWrapper(nn.Module):
     def encode(self, x):
         x = self.vae.encode(x).sample().mul_(0.18215)
         return x
+
+    def encode_moments(self, x):
+        # mean and logvar of the posterior, concatenated on channels
+        return self.vae.encode(x).parameters
+
+    def sample_moments(self, moments):
+        # same as `encode` for the moments returned by `encode_moments`
+        return DiagonalGaussianDistribution(moments).sample().mul_(0.18215)
+
     def decode(self, x):
         x = self.vae.decode(x / 0.18215)
         x = rearrange(x, 'b c t h w -> b t c h w').contiguous()
@@ -38,6 +48,16 @@ class WFVAEModelWrapper(nn.Module):
     def encode(self, x):
         x = (self.vae.encode(x).sample() - self.shift.to(x.device, dtype=x.dtype)) * self.scale.to(x.device, dtype=x.dtype)
         return x
+
+    def encode_moments(self, x):
+        # mean and logvar of the posterior, concatenated on channels
+        return self.vae.encode(x).parameters
+
+    def sample_moments(self, moments):
+        # same as `encode` for the moments returned by `encode_moments`
+        x = DiagonalGaussianDistribution(moments).sample()
+        x = (x - self.shift.to(x.device, dtype=x.dtype)) * self.scale.to(x.device, dtype=x.dtype)
+        return x
     
     def decode(self, x):
         x = x / self.scale.to(x.device, dtype=x.dtype) + self.shift.to(x.device, dtype=x.dtype)
@@ -282,7 +282,8 @@ class OpenSoraAttnProcessor2_0:
             # if attention_mask is None or not torch.any(attention_mask.bool()):  # 0 mean visible
             #     attention_mask = None
             # the output of sdp = (batch, num_heads, seq_len, head_dim)
-            with torch.backends.cuda.sdp_kernel(enable_math=False, enable_flash=False, enable_mem_efficient=True):
+            # the math kernel is only allowed on CPU, where there is no fused kernel
+            with torch.backends.cuda.sdp_kernel(enable_math=query.device.type == "cpu", enable_flash=False, enable_mem_efficient=True):
                 hidden_states = F.scaled_dot_product_attention(
                     query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
                 )
@@ -49,7 +49,7 @@ import transformers
 from transformers.utils import ContextManagers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import DistributedType, ProjectConfiguration, set_seed
+from accelerate.utils import DistributedType, ProjectConfiguration, DataLoaderConfiguration, set_seed
 from accelerate.state import AcceleratorState
 from packaging import version
 from tqdm.auto import tqdm
@@ -65,9 +65,10 @@ from opensora.models.causalvideovae import ae_norm, ae_denorm
 from opensora.models import CausalVAEModelWrapper
 from opensora.models.text_encoder import get_text_warpper
 from opensora.dataset import getdataset
+from opensora.dataset.shard_dataset import ShardStream
 from opensora.models import CausalVAEModelWrapper
 from opensora.models.diffusion import Diffusion_models, Diffusion_models_class
-from opensora.utils.dataset_utils import Collate, LengthGroupedSampler
+from opensora.utils.dataset_utils import Collate, LengthGroupedSampler, TokenBudgetBatchSampler
 from opensora.utils.utils import explicit_uniform_sampling
 from opensora.sample.pipeline_opensora import OpenSoraPipeline
 from opensora.models.causalvideovae import ae_stride_config, ae_wrapper
@@ -105,6 +106,8 @@ def main(args):
         mixed_precision=args.mixed_precision,
         log_with=args.report_to,
         project_config=accelerator_project_config,
+        # batches come from pinned memory (pin_memory=True), so their H2D copy can overlap the previous step
+        dataloader_config=DataLoaderConfiguration(non_blocking=True),
     )
 
     if args.num_frames != 1:
@@ -324,7 +327,15 @@ def main(args):
                         # make sure to pop weight so that corresponding model is not saved again
                         weights.pop()
 
+                with open(os.path.join(output_dir, "sampler_state.json"), "w") as f:
+                    json.dump(sampler.state_dict(), f)
+
         def load_model_hook(models, input_dir):
+            sampler_state_path = os.path.join(input_dir, "sampler_state.json")
+            if os.path.exists(sampler_state_path) and args.trained_data_global_step is None:
+                with open(sampler_state_path, "r") as f:
+                    sampler.load_state_dict(json.load(f))
+
             if args.use_ema:
                 load_model = EMAModel.from_pretrained(os.path.join(input_dir, "model_ema"), Diffusion_models_class[args.model])
                 ema_model.load_state_dict(load_model.state_dict())
@@ -425,25 +436,68 @@ def main(args):
     if args.min_hxw is None:
         args.min_hxw = args.max_hxw // 4
     train_dataset = getdataset(args)
-    sampler = LengthGroupedSampler(
-                args.train_batch_size,
-                world_size=accelerator.num_processes, 
-                gradient_accumulation_size=args.gradient_accumulation_steps, 
-                initial_global_step=initial_global_step_for_sampler, 
-                lengths=train_dataset.lengths, 
-                group_data=args.group_data, 
-            )
-    train_dataloader = DataLoader(
-        train_dataset,
-        shuffle=False,
-        # pin_memory=True,
-        collate_fn=Collate(args),
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
-        sampler=sampler, 
-        drop_last=True, 
-        # prefetch_factor=4
-    )
+    if args.shard_dir is not None:
+        # stream the samples out of the tar shards written by `python -m opensora.dataset.shard_dataset`
+        assert args.token_budget is None and args.sp_size == 1, '--shard_dir supports neither --token_budget nor --sp_size > 1'
+        sampler = ShardStream(
+                    train_dataset, 
+                    args.shard_dir, 
+                    args.train_batch_size, 
+                    world_size=accelerator.num_processes, 
+                    rank=accelerator.process_index, 
+                    num_workers=args.dataloader_num_workers, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    shuffle_buffer=args.shard_shuffle_buffer, 
+                    num_threads=args.decode_threads, 
+                )
+        train_dataloader = DataLoader(
+            sampler,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
+    elif args.token_budget is not None:
+        # batches of one shape filled up to --token_budget tokens, so the batch size varies with the shape
+        sampler = TokenBudgetBatchSampler(
+                    args.token_budget, 
+                    world_size=accelerator.num_processes, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    lengths=train_dataset.lengths, 
+                    ae_stride_thw=(args.ae_stride_t, args.ae_stride_h, args.ae_stride_w), 
+                    patch_size_thw=(args.patch_size_t, args.patch_size_h, args.patch_size_w), 
+                    max_batch_size=args.max_batch_size, 
+                    video_batch_size=args.train_batch_size if args.sp_size != 1 else None, 
+                )
+        train_dataloader = DataLoader(
+            train_dataset,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            num_workers=args.dataloader_num_workers,
+            batch_sampler=sampler, 
+        )
+    else:
+        sampler = LengthGroupedSampler(
+                    args.train_batch_size,
+                    world_size=accelerator.num_processes, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    lengths=train_dataset.lengths, 
+                    group_data=args.group_data, 
+                )
+        train_dataloader = DataLoader(
+            train_dataset,
+            shuffle=False,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+            sampler=sampler, 
+            drop_last=True, 
+            # prefetch_factor=4
+        )
     logger.info(f'after train_dataloader')
 
     # Scheduler and math around the number of training steps.
@@ -466,9 +520,15 @@ def main(args):
     # model.patch_embed.requires_grad_(True)
 
     logger.info(f'before accelerator.prepare')
-    model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        model, optimizer, train_dataloader, lr_scheduler
-    )
+    if args.shard_dir is not None:
+        # the shard stream already splits the data over ranks, accelerate would shard its batches once more
+        model, optimizer, lr_scheduler = accelerator.prepare(
+            model, optimizer, lr_scheduler
+        )
+    else:
+        model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            model, optimizer, train_dataloader, lr_scheduler
+        )
     logger.info(f'after accelerator.prepare')
     
     if args.use_ema:
@@ -543,6 +603,11 @@ def main(args):
 
     else:
         initial_global_step = 0
+    # the decode engine looks the batches up in the sampler, whose state may come from the checkpoint
+    if args.shard_dir is None:
+        # accelerate counts its passes over the loader from 0 and hands the count to sampler.set_epoch
+        train_dataloader.set_epoch(sampler.epoch)
+        train_dataset.set_sample_order(sampler)
 
     progress_bar = tqdm(
         range(0, args.max_train_steps),
@@ -592,6 +657,7 @@ def main(args):
                             shutil.rmtree(removing_checkpoint)
 
                 save_path = os.path.join(args.output_dir, f"checkpoint-{progress_info.global_step}")
+                sampler.set_progress(progress_info.global_step - initial_global_step)
                 accelerator.save_state(save_path)
                 logger.info(f"Saved state to {save_path}")
 
@@ -602,6 +668,18 @@ def main(args):
         #     torch.cuda.empty_cache()
         #     gc.collect()
 
+    def reduce_loss(loss, mask, c):
+        """
+        Loss to backpropagate and the mean loss on unpadded elements (for logging) of the elementwise `loss`
+        (b, c*t*h*w). Under --token_budget batches hold different numbers of tokens, so the sum is normalized by the
+        budget instead of by the batch: every token then weighs the same across micro-batches and ranks.
+        """
+        loss_sum = (loss * mask).sum() if mask is not None else loss.sum()
+        loss_mean = loss_sum / mask.sum() if mask is not None else loss.mean()  # mean loss on unpad patches
+        if args.token_budget is None:
+            return loss_mean, loss_mean
+        return loss_sum / (args.token_budget * c * args.patch_size_t * args.patch_size_h * args.patch_size_w), loss_mean
+
     def run(model_input, model_kwargs, prof):
         global start_time
         start_time = time.time()
@@ -670,10 +748,7 @@ def main(args):
             # model_pred: b c t h w, attention_mask: b t h w
             loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
             loss = loss.reshape(b, -1)
-            if mask is not None:
-                loss = (loss * mask).sum() / mask.sum()  # mean loss on unpad patches
-            else:
-                loss = loss.mean()
+            loss, loss_mean = reduce_loss(loss, mask, c)
         else:
             # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
             # Since we predict the noise instead of x_0, the original formulation is slightly changed.
@@ -691,12 +766,9 @@ def main(args):
             loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
             loss = loss.reshape(b, -1)
             mse_loss_weights = mse_loss_weights.reshape(b, 1)
-            if mask is not None:
-                loss = (loss * mask * mse_loss_weights).sum() / mask.sum()  # mean loss on unpad patches
-            else:
-                loss = (loss * mse_loss_weights).mean()
+            loss, loss_mean = reduce_loss(loss * mse_loss_weights, mask, c)
         # Gather the losses across all processes for logging (if we use distributed training).
-        avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
+        avg_loss = accelerator.gather(loss_mean.repeat(args.train_batch_size)).mean()
         progress_info.train_loss += avg_loss.detach().item() / args.gradient_accumulation_steps
 
         # Backpropagate
@@ -709,7 +781,7 @@ def main(args):
         optimizer.zero_grad()
 
         if accelerator.sync_gradients:
-            sync_gradients_info(loss)
+            sync_gradients_info(loss_mean)
 
         if prof is not None:
             prof.step()
@@ -733,13 +805,13 @@ def main(args):
             if text_enc_2 is not None:
                 text_enc_2.to(accelerator.device, dtype=weight_dtype)
 
-        x = x.to(accelerator.device, dtype=ae.vae.dtype)  # B C T H W
+        x = x.to(accelerator.device, dtype=ae.vae.dtype, non_blocking=True)  # B C T H W
         # x = x.to(accelerator.device, dtype=torch.float32)  # B C T H W
-        attn_mask = attn_mask.to(accelerator.device)  # B T H W
-        input_ids_1 = input_ids_1.to(accelerator.device)  # B 1 L
-        cond_mask_1 = cond_mask_1.to(accelerator.device)  # B 1 L
-        input_ids_2 = input_ids_2.to(accelerator.device) if input_ids_2 is not None else input_ids_2 # B 1 L
-        cond_mask_2 = cond_mask_2.to(accelerator.device) if cond_mask_2 is not None else cond_mask_2 # B 1 L
+        attn_mask = attn_mask.to(accelerator.device, non_blocking=True)  # B T H W
+        input_ids_1 = input_ids_1.to(accelerator.device, non_blocking=True)  # B 1 L
+        cond_mask_1 = cond_mask_1.to(accelerator.device, non_blocking=True)  # B 1 L
+        input_ids_2 = input_ids_2.to(accelerator.device, non_blocking=True) if input_ids_2 is not None else input_ids_2 # B 1 L
+        cond_mask_2 = cond_mask_2.to(accelerator.device, non_blocking=True) if cond_mask_2 is not None else cond_mask_2 # B 1 L
 
         with torch.no_grad():
             B, N, L = input_ids_1.shape  # B 1 L
@@ -906,10 +978,28 @@ if __name__ == "__main__":
     parser.add_argument("--dataloader_num_workers", type=int, default=10, help="Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process.")
     parser.add_argument("--train_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader.")
     parser.add_argument("--group_data", action="store_true")
+    parser.add_argument("--token_budget", type=int, default=None, help="Fill every batch with samples of one shape up to this many transformer tokens per device, instead of --train_batch_size samples.")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="Upper bound of the per-device batch size with --token_budget.")
+    parser.add_argument("--shard_dir", type=str, default=None, help="Stream the data out of the tar shards written by `python -m opensora.dataset.shard_dataset`.")
+    parser.add_argument("--shard_shuffle_buffer", type=int, default=1024, help="Samples each dataloader worker shuffles over when reading --shard_dir.")
     parser.add_argument("--hw_stride", type=int, default=32)
     parser.add_argument("--force_resolution", action="store_true")
-    parser.add_argument("--trained_data_global_step", type=int, default=None)
+    parser.add_argument("--trained_data_global_step", type=int, default=None, help="Skip the data of this many steps, instead of resuming the sampler state stored in the checkpoint.")
     parser.add_argument("--use_decord", action="store_true")
+    parser.add_argument("--meta_index_dir", type=str, default=None, help="Directory of the memory-mapped meta index, built once per filtering args and shared by all ranks on a host.")
+    parser.add_argument("--token_cache_dir", type=str, default=None, help="Directory of the pre-tokenized captions built by `python -m opensora.dataset.token_cache`, misses fall back to the tokenizers.")
+    parser.add_argument("--decode_threads", type=int, default=4, help="Decoder threads per dataloader worker, a batch is decoded concurrently.")
+    parser.add_argument("--decode_prefetch_batches", type=int, default=1, help="Batches each dataloader worker decodes ahead along the sampler order.")
+    parser.add_argument("--quarantine_dir", type=str, default=None, help="Ledger of files that failed to decode, merged over ranks and runs; they are skipped and dropped from the next meta index build. Report with `python -m opensora.dataset.quarantine`.")
+    parser.add_argument("--decode_stats_dir", type=str, default=None, help="Directory for per-worker decode latency histograms, merge them with `python -m opensora.dataset.decode_engine`.")
+    parser.add_argument("--decoder_cache_size", type=int, default=32, help="Open decord readers kept per dataloader worker.")
+    parser.add_argument("--decoder_cache_mb", type=int, default=2048, help="Estimated frame-buffer budget (MB) of the cached decord readers per dataloader worker.")
+    parser.add_argument("--virtual_disk_dir", type=str, default=None, help="Local cache of the remote data files shared by all ranks on a host, the data paths are then object names of the remote store.")
+    parser.add_argument("--virtual_disk_size", type=str, default='64G', help="Size bound of --virtual_disk_dir, least recently used files are evicted.")
+    parser.add_argument("--virtual_disk_remote", type=str, default=None, help="Directory standing in for the remote store of --virtual_disk_dir, the OBS bucket through obsutil if not given.")
+    parser.add_argument("--virtual_disk_max_transfers", type=int, default=32, help="Downloads into --virtual_disk_dir running at once on a host, over all ranks and dataloader workers.")
+    parser.add_argument("--virtual_disk_read_ahead", type=int, default=8, help="Batches after the decoded ones whose files each dataloader worker fetches into --virtual_disk_dir.")
+    parser.add_argument("--nan_check_interval", type=int, default=100, help="Collate checks one of every N batches for NaN, 0 disables the check.")
 
     # text encoder & vae & diffusion model
     parser.add_argument('--vae_fp32', action='store_true')
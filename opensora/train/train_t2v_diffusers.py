@@ -12,8 +12,10 @@ import logging
 import math
 import os
 import shutil
+import json
 from pathlib import Path
 from typing import Optional
+from contextlib import nullcontext
 import gc
 import numpy as np
 from einops import rearrange
@@ -21,6 +23,7 @@ import torch.utils
 import torch.utils.data
 from tqdm import tqdm
 import time
+import random
 
 from opensora.adaptor.modules import replace_with_fp32_forwards
 try:
@@ -47,7 +50,7 @@ import transformers
 from transformers.utils import ContextManagers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import DistributedType, ProjectConfiguration, set_seed
+from accelerate.utils import DistributedType, ProjectConfiguration, DataLoaderConfiguration, set_seed
 from accelerate.state import AcceleratorState
 from packaging import version
 from tqdm.auto import tqdm
@@ -56,19 +59,22 @@ import copy
 import diffusers
 from diffusers import DDPMScheduler, PNDMScheduler, DPMSolverMultistepScheduler, CogVideoXDDIMScheduler, FlowMatchEulerDiscreteScheduler
 from diffusers.optimization import get_scheduler
-from diffusers.training_utils import EMAModel, compute_snr
 from diffusers.utils import check_min_version, is_wandb_available
-from diffusers.training_utils import compute_density_for_timestep_sampling, compute_loss_weighting_for_sd3
 
 from opensora.models.causalvideovae import ae_stride_config, ae_channel_config
 from opensora.models.causalvideovae import ae_norm, ae_denorm
 from opensora.models import CausalVAEModelWrapper
 from opensora.models.text_encoder import get_text_warpper
 from opensora.dataset import getdataset
+from opensora.dataset.shard_dataset import ShardStream
 from opensora.models import CausalVAEModelWrapper
 from opensora.models.diffusion import Diffusion_models, Diffusion_models_class
-from opensora.utils.dataset_utils import Collate, LengthGroupedSampler
-from opensora.utils.utils import explicit_uniform_sampling
+from opensora.utils.dataset_utils import Collate, LengthGroupedSampler, TokenBudgetBatchSampler
+from opensora.utils.timestep_sampler import TimestepSampler
+from opensora.utils.step_telemetry import StepTelemetry
+from opensora.utils.encode_pipeline import EncodePipeline
+from opensora.utils.ema import EMAModel
+from opensora.utils.async_checkpoint import AsyncCheckpointer, load_checkpoint, latest_checkpoint, is_complete, save_pretrained_state
 from opensora.sample.pipeline_opensora import OpenSoraPipeline
 from opensora.models.causalvideovae import ae_stride_config, ae_wrapper
 
@@ -175,6 +181,8 @@ def main(args):
         mixed_precision=args.mixed_precision,
         log_with=args.report_to,
         project_config=accelerator_project_config,
+        # batches come from pinned memory (pin_memory=True), so their H2D copy can overlap the previous step
+        dataloader_config=DataLoaderConfiguration(non_blocking=True),
     )
 
     if args.num_frames != 1:
@@ -251,11 +259,12 @@ def main(args):
             'torch_dtype': weight_dtype, 
             'low_cpu_mem_usage': False
             }
-        text_enc_1 = get_text_warpper(args.text_encoder_name_1)(args, **kwargs).eval()
-
-        text_enc_2 = None
-        if args.text_encoder_name_2 is not None:
-            text_enc_2 = get_text_warpper(args.text_encoder_name_2)(args, **kwargs).eval()
+        text_enc_1, text_enc_2 = None, None
+        # with the text embedding cache the dataloader yields encoder outputs, so the text encoders are never loaded
+        if args.text_embed_cache_dir is None:
+            text_enc_1 = get_text_warpper(args.text_encoder_name_1)(args, **kwargs).eval()
+            if args.text_encoder_name_2 is not None:
+                text_enc_2 = get_text_warpper(args.text_encoder_name_2)(args, **kwargs).eval()
 
     ae_stride_t, ae_stride_h, ae_stride_w = ae_stride_config[args.ae]
     ae.vae_scale_factor = (ae_stride_t, ae_stride_h, ae_stride_w)
@@ -319,7 +328,8 @@ def main(args):
     model.gradient_checkpointing = args.gradient_checkpointing
     # Freeze vae and text encoders.
     ae.vae.requires_grad_(False)
-    text_enc_1.requires_grad_(False)
+    if text_enc_1 is not None:
+        text_enc_1.requires_grad_(False)
     if text_enc_2 is not None:
         text_enc_2.requires_grad_(False)
     # Set model as trainable.
@@ -338,14 +348,14 @@ def main(args):
         noise_scheduler = DDPMScheduler(**kwargs)
     elif args.rf_scheduler:
         noise_scheduler = FlowMatchEulerDiscreteScheduler()
-        noise_scheduler_copy = copy.deepcopy(noise_scheduler)
     else:
         noise_scheduler = DDPMScheduler(**kwargs)
     # Move unet, vae and text_encoder to device and cast to weight_dtype
     # The VAE is in float32 to avoid NaN losses.
     if not args.extra_save_mem:
         ae.vae.to(accelerator.device, dtype=torch.float32 if args.vae_fp32 else weight_dtype)
-        text_enc_1.to(accelerator.device, dtype=weight_dtype)
+        if text_enc_1 is not None:
+            text_enc_1.to(accelerator.device, dtype=weight_dtype)
         if text_enc_2 is not None:
             text_enc_2.to(accelerator.device, dtype=weight_dtype)
 
@@ -354,7 +364,7 @@ def main(args):
         ema_model = deepcopy(model)
         ema_model = EMAModel(ema_model.parameters(), decay=args.ema_decay, update_after_step=args.ema_start_step,
                              model_cls=Diffusion_models_class[args.model], model_config=ema_model.config, 
-                             foreach=args.foreach_ema)
+                             foreach=args.foreach_ema, update_every=args.ema_update_every)
 
     # `accelerate` 0.16.0 will have better support for customized saving
     if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
@@ -370,12 +380,21 @@ def main(args):
                         # make sure to pop weight so that corresponding model is not saved again
                         weights.pop()
 
+                with open(os.path.join(output_dir, "sampler_state.json"), "w") as f:
+                    json.dump(sampler.state_dict(), f)
+
         def load_model_hook(models, input_dir):
+            sampler_state_path = os.path.join(input_dir, "sampler_state.json")
+            if os.path.exists(sampler_state_path) and args.trained_data_global_step is None:
+                with open(sampler_state_path, "r") as f:
+                    sampler.load_state_dict(json.load(f))
+
             if args.use_ema:
                 load_model = EMAModel.from_pretrained(
                     os.path.join(input_dir, "model_ema"), 
                     Diffusion_models_class[args.model], 
                     foreach=args.foreach_ema, 
+                    update_every=args.ema_update_every, 
                     )
                 ema_model.load_state_dict(load_model.state_dict())
                 if args.offload_ema:
@@ -478,25 +497,69 @@ def main(args):
     if args.max_hxw is not None and args.min_hxw is None:
         args.min_hxw = args.max_hxw // 4
     train_dataset = getdataset(args)
-    sampler = LengthGroupedSampler(
-                args.train_batch_size,
-                world_size=accelerator.num_processes, 
-                gradient_accumulation_size=args.gradient_accumulation_steps, 
-                initial_global_step=initial_global_step_for_sampler, 
-                lengths=train_dataset.lengths, 
-                group_data=args.group_data, 
-            )
-    train_dataloader = DataLoader(
-        train_dataset,
-        shuffle=False,
-        pin_memory=True,
-        collate_fn=Collate(args),
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
-        sampler=sampler, 
-        drop_last=True, 
-        # prefetch_factor=4
-    )
+    if args.shard_dir is not None:
+        # stream the samples out of the tar shards written by `python -m opensora.dataset.shard_dataset`
+        assert args.token_budget is None and args.sp_size == 1, '--shard_dir supports neither --token_budget nor --sp_size > 1'
+        assert args.windows_per_clip == 1 and not args.use_img_from_vid, '--shard_dir does not reuse frame windows'
+        sampler = ShardStream(
+                    train_dataset, 
+                    args.shard_dir, 
+                    args.train_batch_size, 
+                    world_size=accelerator.num_processes, 
+                    rank=accelerator.process_index, 
+                    num_workers=args.dataloader_num_workers, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    shuffle_buffer=args.shard_shuffle_buffer, 
+                    num_threads=args.decode_threads, 
+                )
+        train_dataloader = DataLoader(
+            sampler,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+        )
+    elif args.token_budget is not None:
+        # batches of one shape filled up to --token_budget tokens, so the batch size varies with the shape
+        sampler = TokenBudgetBatchSampler(
+                    args.token_budget, 
+                    world_size=accelerator.num_processes, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    lengths=train_dataset.lengths, 
+                    ae_stride_thw=(args.ae_stride_t, args.ae_stride_h, args.ae_stride_w), 
+                    patch_size_thw=(args.patch_size_t, args.patch_size_h, args.patch_size_w), 
+                    max_batch_size=args.max_batch_size, 
+                    video_batch_size=args.train_batch_size if args.sp_size != 1 else None, 
+                )
+        train_dataloader = DataLoader(
+            train_dataset,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            num_workers=args.dataloader_num_workers,
+            batch_sampler=sampler, 
+        )
+    else:
+        sampler = LengthGroupedSampler(
+                    args.train_batch_size,
+                    world_size=accelerator.num_processes, 
+                    gradient_accumulation_size=args.gradient_accumulation_steps, 
+                    initial_global_step=initial_global_step_for_sampler, 
+                    lengths=train_dataset.lengths, 
+                    group_data=args.group_data, 
+                )
+        train_dataloader = DataLoader(
+            train_dataset,
+            shuffle=False,
+            pin_memory=True,
+            collate_fn=Collate(args),
+            batch_size=args.train_batch_size,
+            num_workers=args.dataloader_num_workers,
+            sampler=sampler, 
+            drop_last=True, 
+            # prefetch_factor=4
+        )
     logger.info(f'after train_dataloader')
 
     # Scheduler and math around the number of training steps.
@@ -519,9 +582,15 @@ def main(args):
     # model.patch_embed.requires_grad_(True)
 
     logger.info(f'before accelerator.prepare')
-    model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        model, optimizer, train_dataloader, lr_scheduler
-    )
+    if args.shard_dir is not None:
+        # the shard stream already splits the data over ranks, accelerate would shard its batches once more
+        model, optimizer, lr_scheduler = accelerator.prepare(
+            model, optimizer, lr_scheduler
+        )
+    else:
+        model, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            model, optimizer, train_dataloader, lr_scheduler
+        )
     logger.info(f'after accelerator.prepare')
     
     if args.use_ema:
@@ -530,6 +599,83 @@ def main(args):
         else:
             ema_model.to(accelerator.device)
 
+    checkpointer = None
+    if args.async_checkpoint:
+        deepspeed_plugin = AcceleratorState().deepspeed_plugin
+        if deepspeed_plugin is not None and deepspeed_plugin.zero_stage == 3:
+            raise ValueError("--async_checkpoint snapshots the full model on every rank, which ZeRO-3 partitions")
+        model_config = json.loads(accelerator.unwrap_model(model).to_json_string())
+        param_names = [name for name, _ in accelerator.unwrap_model(model).named_parameters()]
+
+        def export_pretrained(checkpoint_dir, state):
+            # the `model` and `model_ema` folders of `save_model_hook`, which the sampling and eval scripts load
+            save_pretrained_state(state['model'], model_config, os.path.join(checkpoint_dir, "model"))
+            if args.use_ema:
+                ema_state = dict(state['model_ema'])
+                # the shadow weights follow `model.parameters()`, buffers are taken from the model as they are not averaged
+                ema_weights = dict(state['model'])
+                ema_weights.update(zip(param_names, ema_state.pop('shadow_params')))
+                save_pretrained_state(ema_weights, dict(model_config, **ema_state), os.path.join(checkpoint_dir, "model_ema"))
+
+        checkpointer = AsyncCheckpointer(
+            args.output_dir, rank=accelerator.process_index, world_size=accelerator.num_processes, 
+            total_limit=args.checkpoints_total_limit, export_fn=export_pretrained, export_keys=["model", "model_ema"],
+            )
+
+    def async_checkpoint_state():
+        # the model and EMA are the same on all ranks and split between their shards, ZeRO optimizer partitions are per rank
+        replicated = dict(
+            model=accelerator.unwrap_model(model).state_dict(), 
+            lr_scheduler=lr_scheduler.state_dict(), 
+            sampler=sampler.state_dict(),
+            )
+        if args.use_ema:
+            replicated['model_ema'] = ema_model.state_dict()
+        local = dict(
+            optimizer=optimizer.state_dict(), 
+            rng=dict(
+                random=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state(), 
+                cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                ),
+            )
+        if accelerator.distributed_type != DistributedType.DEEPSPEED:
+            # a plain torch optimizer holds the same state on every rank
+            replicated['optimizer'] = local.pop('optimizer')
+        if accelerator.scaler is not None:
+            replicated['scaler'] = accelerator.scaler.state_dict()
+        return replicated, local
+
+    def load_async_checkpoint(input_dir):
+        replicated, local = load_checkpoint(input_dir, rank=accelerator.process_index, world_size=accelerator.num_processes)
+        accelerator.unwrap_model(model).load_state_dict(replicated['model'])
+        lr_scheduler.load_state_dict(replicated['lr_scheduler'])
+        if args.trained_data_global_step is None:
+            sampler.load_state_dict(replicated['sampler'])
+        if args.use_ema:
+            ema_model.load_state_dict(replicated['model_ema'])
+            if args.offload_ema:
+                ema_model.pin_memory()
+            else:
+                ema_model.to(accelerator.device)
+        if 'scaler' in replicated and accelerator.scaler is not None:
+            accelerator.scaler.load_state_dict(replicated['scaler'])
+        if 'optimizer' in replicated:
+            optimizer.load_state_dict(replicated['optimizer'])
+        elif local is not None:
+            # ZeRO takes the partitions of all ranks but only reads its own without elastic checkpointing,
+            # then refreshes the bf16 weights from its fp32 master partition
+            state_dict_list = [None] * accelerator.num_processes
+            state_dict_list[accelerator.process_index] = local['optimizer']
+            optimizer.optimizer.load_state_dict(state_dict_list, load_from_fp32_weights=True)
+        else:
+            logger.info(f"Optimizer state of {input_dir} is sharded for another world size, restart the optimizer")
+        if local is not None:
+            random.setstate(local['rng']['random'])
+            np.random.set_state(local['rng']['numpy'])
+            torch.set_rng_state(local['rng']['torch'])
+            if local['rng']['cuda'] is not None and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(local['rng']['cuda'])
+
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
     if overrode_max_train_steps:
@@ -559,8 +705,11 @@ def main(args):
     logger.info(f"  Total training parameters = {sum(p.numel() for p in model.parameters() if p.requires_grad) / 1e9} B")
     
     logger.info(f"  AutoEncoder = {args.ae}; Dtype = {ae.vae.dtype}; Parameters = {sum(p.numel() for p in ae.parameters()) / 1e9} B")
-    logger.info(f"  Text_enc_1 = {args.text_encoder_name_1}; Dtype = {weight_dtype}; Parameters = {sum(p.numel() for p in text_enc_1.parameters()) / 1e9} B")
-    if args.text_encoder_name_2 is not None:
+    if text_enc_1 is None:
+        logger.info(f"  Text_enc_1 = {args.text_encoder_name_1}; read from text embedding cache {args.text_embed_cache_dir}")
+    else:
+        logger.info(f"  Text_enc_1 = {args.text_encoder_name_1}; Dtype = {weight_dtype}; Parameters = {sum(p.numel() for p in text_enc_1.parameters()) / 1e9} B")
+    if text_enc_2 is not None:
         logger.info(f"  Text_enc_2 = {args.text_encoder_name_2}; Dtype = {weight_dtype}; Parameters = {sum(p.numel() for p in text_enc_2.parameters()) / 1e9} B")
 
     global_step = 0
@@ -570,11 +719,8 @@ def main(args):
         if args.resume_from_checkpoint != "latest":
             path = os.path.basename(args.resume_from_checkpoint)
         else:
-            # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-            path = dirs[-1] if len(dirs) > 0 else None
+            # Get the most recent checkpoint, skipping async checkpoints that some rank never finished
+            path = latest_checkpoint(args.output_dir)
 
         if path is None:
             accelerator.print(
@@ -584,7 +730,10 @@ def main(args):
             initial_global_step = 0
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
+            if is_complete(os.path.join(args.output_dir, path)):
+                load_async_checkpoint(os.path.join(args.output_dir, path))
+            else:
+                accelerator.load_state(os.path.join(args.output_dir, path))
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
@@ -592,6 +741,11 @@ def main(args):
 
     else:
         initial_global_step = 0
+    # the decode engine looks the batches up in the sampler, whose state may come from the checkpoint
+    if args.shard_dir is None:
+        # accelerate counts its passes over the loader from 0 and hands the count to sampler.set_epoch
+        train_dataloader.set_epoch(sampler.epoch)
+        train_dataset.set_sample_order(sampler)
 
     progress_bar = tqdm(
         range(0, args.max_train_steps),
@@ -602,26 +756,24 @@ def main(args):
     )
     progress_info = ProgressInfo(global_step, train_loss=0.0)
 
-    
-    def get_sigmas(timesteps, n_dim=4, dtype=torch.float32):
-        sigmas = noise_scheduler_copy.sigmas.to(device=accelerator.device, dtype=dtype)
-        schedule_timesteps = noise_scheduler_copy.timesteps.to(accelerator.device)
-        timesteps = timesteps.to(accelerator.device)
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-        sigma = sigmas[step_indices].flatten()
-        while len(sigma.shape) < n_dim:
-            sigma = sigma.unsqueeze(-1)
-        return sigma
+    # timesteps, sigmas and loss weights are drawn from tables kept on the device, without a host sync per sample
+    timestep_sampler = TimestepSampler(
+        noise_scheduler, accelerator.device, flow_matching=args.rf_scheduler, weighting_scheme=args.weighting_scheme, 
+        logit_mean=args.logit_mean, logit_std=args.logit_std, mode_scale=args.mode_scale, 
+        rank=accelerator.process_index, world_size=accelerator.num_processes, 
+        )
+    telemetry = StepTelemetry(
+        args.telemetry_dir, accelerator.unwrap_model(model).config, args.model_max_length, accelerator.device, 
+        rank=accelerator.process_index, world_size=accelerator.num_processes, log_interval=args.log_interval, 
+        peak_tflops=args.peak_tflops, log_fn=accelerator.log, 
+        )
 
     def sync_gradients_info(loss):
         # Checks if the accelerator has performed an optimization step behind the scenes
         if args.use_ema:
-            if args.offload_ema:
-                ema_model.to(device="cuda", non_blocking=True)
-            ema_model.step(model.parameters())
-            if args.offload_ema:
-                ema_model.to(device="cpu", non_blocking=True)
+            # with --offload_ema the pinned host buckets are streamed through the device in chunks
+            with telemetry.stage('ema'):
+                ema_model.step(model.parameters())
         progress_bar.update(1)
         progress_info.global_step += 1
         end_time = time.time()
@@ -635,35 +787,61 @@ def main(args):
                                     rank=0)
             progress_info.train_loss = torch.tensor(0.0, device=loss.device)
 
-        # DeepSpeed requires saving weights on every device; saving weights only on the main process would cause issues.
-        if accelerator.distributed_type == DistributedType.DEEPSPEED or accelerator.is_main_process:
-            if progress_info.global_step % args.checkpointing_steps == 0:
-                # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                if accelerator.is_main_process and args.checkpoints_total_limit is not None:
-                    checkpoints = os.listdir(args.output_dir)
-                    checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                    checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
-
-                    # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                    if len(checkpoints) >= args.checkpoints_total_limit:
-                        num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
-                        removing_checkpoints = checkpoints[0:num_to_remove]
-
-                        logger.info(
-                            f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                        )
-                        logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
-
-                        for removing_checkpoint in removing_checkpoints:
-                            removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
-                            shutil.rmtree(removing_checkpoint)
-
+        with telemetry.stage('checkpoint', host=True):
+            if checkpointer is not None and progress_info.global_step % args.checkpointing_steps == 0:
+                # every rank writes its shards, the rotation runs on the writer thread of rank 0
                 save_path = os.path.join(args.output_dir, f"checkpoint-{progress_info.global_step}")
-                accelerator.save_state(save_path)
-                logger.info(f"Saved state to {save_path}")
+                sampler.set_progress(progress_info.global_step - initial_global_step)
+                stall_time = checkpointer.save(save_path, *async_checkpoint_state())
+                accelerator.log({"checkpoint_stall_s": stall_time}, step=progress_info.global_step)
+                logger.info(f"Snapshot state to {save_path}, training stalled {stall_time:.2f}s")
+
+            # DeepSpeed requires saving weights on every device; saving weights only on the main process would cause issues.
+            elif accelerator.distributed_type == DistributedType.DEEPSPEED or accelerator.is_main_process:
+                if progress_info.global_step % args.checkpointing_steps == 0:
+                    save_start_time = time.time()
+                    # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
+                    if accelerator.is_main_process and args.checkpoints_total_limit is not None:
+                        checkpoints = os.listdir(args.output_dir)
+                        checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
+                        checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+                        # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
+                        if len(checkpoints) >= args.checkpoints_total_limit:
+                            num_to_remove = len(checkpoints) - args.checkpoints_total_limit + 1
+                            removing_checkpoints = checkpoints[0:num_to_remove]
+
+                            logger.info(
+                                f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
+                            )
+                            logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+
+                            for removing_checkpoint in removing_checkpoints:
+                                removing_checkpoint = os.path.join(args.output_dir, removing_checkpoint)
+                                shutil.rmtree(removing_checkpoint)
+
+                    save_path = os.path.join(args.output_dir, f"checkpoint-{progress_info.global_step}")
+                    sampler.set_progress(progress_info.global_step - initial_global_step)
+                    accelerator.save_state(save_path)
+                    stall_time = time.time() - save_start_time
+                    accelerator.log({"checkpoint_stall_s": stall_time}, step=progress_info.global_step)
+                    logger.info(f"Saved state to {save_path}, training stalled {stall_time:.2f}s")
 
         logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
         progress_bar.set_postfix(**logs)
+        telemetry.end_step(progress_info.global_step)
+
+    def reduce_loss(loss, mask, c):
+        """
+        Loss to backpropagate and the mean loss on unpadded elements (for logging) of the elementwise `loss`
+        (b, c*t*h*w). Under --token_budget batches hold different numbers of tokens, so the sum is normalized by the
+        budget instead of by the batch: every token then weighs the same across micro-batches and ranks.
+        """
+        loss_sum = (loss * mask).sum() if mask is not None else loss.sum()
+        loss_mean = loss_sum / mask.sum() if mask is not None else loss.mean()  # mean loss on unpad patches
+        if args.token_budget is None:
+            return loss_mean, loss_mean
+        return loss_sum / (args.token_budget * c * args.patch_size_t * args.patch_size_h * args.patch_size_w), loss_mean
 
     def run(step_, model_input, model_kwargs, prof):
         # print("rank {} | step {} | cd run fun".format(accelerator.process_index, step_))
@@ -679,12 +857,7 @@ def main(args):
                                                         device=model_input.device)
 
             # Sample a random timestep for each image without bias.
-            timesteps = explicit_uniform_sampling(
-                T=noise_scheduler.config.num_train_timesteps, 
-                n=accelerator.num_processes, 
-                rank=accelerator.process_index, 
-                bsz=bsz, device=model_input.device, 
-                )
+            timesteps, _, _ = timestep_sampler.sample(bsz)
             if get_sequence_parallel_state():  # image do not need sp, disable when image batch
                 broadcast(timesteps)
 
@@ -695,26 +868,21 @@ def main(args):
         else:
             # Sample a random timestep for each image
             # for weighting schemes where we sample timesteps non-uniformly
-            u = compute_density_for_timestep_sampling(
-                weighting_scheme=args.weighting_scheme,
-                batch_size=bsz,
-                logit_mean=args.logit_mean,
-                logit_std=args.logit_std,
-                mode_scale=args.mode_scale,
-            )
-            indices = (u * noise_scheduler_copy.config.num_train_timesteps).long()
-            timesteps = noise_scheduler_copy.timesteps[indices].to(device=model_input.device)
+            timesteps, sigmas, weighting = timestep_sampler.sample(bsz, n_dim=model_input.ndim, dtype=model_input.dtype)
 
             # Add noise according to flow matching.
             # zt = (1 - texp) * x + texp * z1
-            sigmas = get_sigmas(timesteps, n_dim=model_input.ndim, dtype=model_input.dtype)
             noisy_model_input = (1.0 - sigmas) * model_input + sigmas * noise
 
-        model_pred = model(
-            noisy_model_input,
-            timesteps,
-            **model_kwargs
-        )[0]
+        telemetry.add_batch(
+            model_input.shape, model_kwargs.get('attention_mask', None), sp_size=args.sp_size if get_sequence_parallel_state() else 1
+            )
+        with telemetry.stage('forward'):
+            model_pred = model(
+                noisy_model_input,
+                timesteps,
+                **model_kwargs
+            )[0]
         mask = model_kwargs.get('attention_mask', None)
         if not args.rf_scheduler:
             # Get the target for loss depending on the prediction type
@@ -743,15 +911,12 @@ def main(args):
                 # model_pred: b c t h w, attention_mask: b t h w
                 loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
                 loss = loss.reshape(b, -1)
-                if mask is not None:
-                    loss = (loss * mask).sum() / mask.sum()  # mean loss on unpad patches
-                else:
-                    loss = loss.mean()
+                loss, loss_mean = reduce_loss(loss, mask, c)
             else:
                 # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
                 # Since we predict the noise instead of x_0, the original formulation is slightly changed.
                 # This is discussed in Section 4.2 of the same paper.
-                snr = compute_snr(noise_scheduler, timesteps)
+                snr = timestep_sampler.snr(timesteps)
                 mse_loss_weights = torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(
                     dim=1
                 )[0]
@@ -764,10 +929,7 @@ def main(args):
                 loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
                 loss = loss.reshape(b, -1)
                 mse_loss_weights = mse_loss_weights.reshape(b, 1)
-                if mask is not None:
-                    loss = (loss * mask * mse_loss_weights).sum() / mask.sum()  # mean loss on unpad patches
-                else:
-                    loss = (loss * mse_loss_weights).mean()
+                loss, loss_mean = reduce_loss(loss * mse_loss_weights, mask, c)
         else:
             if torch.all(mask.bool()):
                 mask = None
@@ -778,102 +940,118 @@ def main(args):
                 mask = mask.reshape(b, -1)
 
             # these weighting schemes use a uniform timestep sampling
-            # and instead post-weight the loss
-            weighting = compute_loss_weighting_for_sd3(weighting_scheme=args.weighting_scheme, sigmas=sigmas)
+            # and instead post-weight the loss; `weighting` comes with the sigmas from the timestep sampler
 
             # flow matching loss
             target = noise - model_input
 
             # Compute regular loss.
             loss_mse = (weighting.float() * (model_pred.float() - target.float()) ** 2).reshape(target.shape[0], -1)
-            if mask is not None:
-                loss = (loss_mse * mask).sum() / mask.sum()
-            else:
-                loss = loss_mse.mean()
+            loss, loss_mean = reduce_loss(loss_mse, mask, c)
 
 
 
         # Gather the losses across all processes for logging (if we use distributed training).
-        avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
+        avg_loss = accelerator.gather(loss_mean.repeat(args.train_batch_size)).mean()
         # avg_loss = accelerator.reduce(loss, reduction="mean")
         # progress_info.train_loss += avg_loss.detach().item() / args.gradient_accumulation_steps
         progress_info.train_loss += avg_loss.detach() / args.gradient_accumulation_steps
         # Backpropagate
-        accelerator.backward(loss)
-        if accelerator.sync_gradients:
-            params_to_clip = model.parameters()
-            accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
+        with telemetry.stage('backward'):
+            accelerator.backward(loss)
+            if accelerator.sync_gradients:
+                params_to_clip = model.parameters()
+                accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+        with telemetry.stage('optimizer'):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
         if accelerator.sync_gradients:
-            sync_gradients_info(loss)
+            sync_gradients_info(loss_mean)
 
         if accelerator.is_main_process:
 
             if progress_info.global_step % args.checkpointing_steps == 0:
 
-                if args.enable_tracker:
-                    log_validation(
-                        args, model, ae, [text_enc_1.text_enc, getattr(text_enc_2, 'text_enc', None)], 
-                        train_dataset.tokenizer, accelerator, weight_dtype, progress_info.global_step
-                    )
-
-                    if args.use_ema and npu_config is None:
-                        # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
-                        ema_model.store(model.parameters())
-                        ema_model.copy_to(model.parameters())
+                # the encoders may be busy with the next batches of --encode_prefetch
+                with encode_pipeline.lock if encode_pipeline is not None else nullcontext():
+                    if args.enable_tracker and text_enc_1 is not None:
                         log_validation(
                             args, model, ae, [text_enc_1.text_enc, getattr(text_enc_2, 'text_enc', None)], 
-                            train_dataset.tokenizer, accelerator, weight_dtype, progress_info.global_step, ema=True
+                            train_dataset.tokenizer, accelerator, weight_dtype, progress_info.global_step
                         )
-                        # Switch back to the original UNet parameters.
-                        ema_model.restore(model.parameters())
+
+                        if args.use_ema and npu_config is None:
+                            # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
+                            ema_model.store(model.parameters())
+                            ema_model.copy_to(model.parameters())
+                            log_validation(
+                                args, model, ae, [text_enc_1.text_enc, getattr(text_enc_2, 'text_enc', None)], 
+                                train_dataset.tokenizer, accelerator, weight_dtype, progress_info.global_step, ema=True
+                            )
+                            # Switch back to the original UNet parameters.
+                            ema_model.restore(model.parameters())
 
         if prof is not None:
             prof.step()
 
         return loss
 
-    def train_one_step(step_, data_item_, prof_=None):
-        train_loss = 0.0
-        # print("rank {} | step {} | unzip data".format(accelerator.process_index, step_))
+    def encode_batch(data_item_, timed=True):
+        # the frozen encoders of one batch; with --encode_prefetch this runs on a side stream in another thread, 
+        # where the telemetry stages can not be attributed to a step
+        stage = telemetry.stage if timed else (lambda name, host=False: nullcontext())
+        # print("rank {} | unzip data".format(accelerator.process_index))
         x, attn_mask, input_ids_1, cond_mask_1, input_ids_2, cond_mask_2 = data_item_
         # print(f'step: {step_}, rank: {accelerator.process_index}, x: {x.shape}, dtype: {x.dtype}')
         # assert not torch.any(torch.isnan(x)), 'torch.any(torch.isnan(x))'
         if args.extra_save_mem:
             torch.cuda.empty_cache()
             ae.vae.to(accelerator.device, dtype=torch.float32 if args.vae_fp32 else weight_dtype)
-            text_enc_1.to(accelerator.device, dtype=weight_dtype)
+            if text_enc_1 is not None:
+                text_enc_1.to(accelerator.device, dtype=weight_dtype)
             if text_enc_2 is not None:
                 text_enc_2.to(accelerator.device, dtype=weight_dtype)
 
-        x = x.to(accelerator.device, dtype=ae.vae.dtype)  # B C T H W
-        # x = x.to(accelerator.device, dtype=torch.float32)  # B C T H W
-        attn_mask = attn_mask.to(accelerator.device)  # B T H W
-        input_ids_1 = input_ids_1.to(accelerator.device)  # B 1 L
-        cond_mask_1 = cond_mask_1.to(accelerator.device)  # B 1 L
-        input_ids_2 = input_ids_2.to(accelerator.device) if input_ids_2 is not None else input_ids_2 # B 1 L
-        cond_mask_2 = cond_mask_2.to(accelerator.device) if cond_mask_2 is not None else cond_mask_2 # B 1 L
+        with stage('h2d'):
+            # with --latent_cache_dir x holds the cached VAE moments (B 2C T H W), which are sampled in fp32
+            x = x.to(accelerator.device, dtype=torch.float32 if args.latent_cache_dir is not None else ae.vae.dtype, non_blocking=True)  # B C T H W
+            # x = x.to(accelerator.device, dtype=torch.float32)  # B C T H W
+            attn_mask = attn_mask.to(accelerator.device, non_blocking=True)  # B T H W
+            input_ids_1 = input_ids_1.to(accelerator.device, non_blocking=True)  # B 1 L
+            cond_mask_1 = cond_mask_1.to(accelerator.device, non_blocking=True)  # B 1 L
+            input_ids_2 = input_ids_2.to(accelerator.device, non_blocking=True) if input_ids_2 is not None else input_ids_2 # B 1 L
+            cond_mask_2 = cond_mask_2.to(accelerator.device, non_blocking=True) if cond_mask_2 is not None else cond_mask_2 # B 1 L
         
         with torch.no_grad():
-            B, N, L = input_ids_1.shape  # B 1 L
-            # use batch inference
-            input_ids_1 = input_ids_1.reshape(-1, L)
-            cond_mask_1 = cond_mask_1.reshape(-1, L)
-            cond_1 = text_enc_1(input_ids_1, cond_mask_1)  # B L D
-            cond_1 = cond_1.reshape(B, N, L, -1)
-            cond_mask_1 = cond_mask_1.reshape(B, N, L)
-            if text_enc_2 is not None:
-                B_, N_, L_ = input_ids_2.shape  # B 1 L
-                input_ids_2 = input_ids_2.reshape(-1, L_)
-                cond_2 = text_enc_2(input_ids_2, cond_mask_2)  # B D
-                cond_2 = cond_2.reshape(B_, 1, -1)  # B 1 D
-            else:
-                cond_2 = None
-
-            # Map input images to latent space + normalize latents
-            x = ae.encode(x)  # B C T H W
+            with stage('text_encode'):
+                if text_enc_1 is None:
+                    # --text_embed_cache_dir: input_ids_1/input_ids_2 already hold the encoder outputs
+                    cond_1 = input_ids_1.to(weight_dtype)  # B 1 L D
+                    cond_2 = input_ids_2.to(weight_dtype) if input_ids_2 is not None else None  # B 1 D
+                else:
+                    B, N, L = input_ids_1.shape  # B 1 L
+                    # use batch inference
+                    input_ids_1 = input_ids_1.reshape(-1, L)
+                    cond_mask_1 = cond_mask_1.reshape(-1, L)
+                    cond_1 = text_enc_1(input_ids_1, cond_mask_1)  # B L D
+                    cond_1 = cond_1.reshape(B, N, L, -1)
+                    cond_mask_1 = cond_mask_1.reshape(B, N, L)
+                    if text_enc_2 is not None:
+                        B_, N_, L_ = input_ids_2.shape  # B 1 L
+                        input_ids_2 = input_ids_2.reshape(-1, L_)
+                        cond_2 = text_enc_2(input_ids_2, cond_mask_2)  # B D
+                        cond_2 = cond_2.reshape(B_, 1, -1)  # B 1 D
+                    else:
+                        cond_2 = None
+
+            with stage('vae_encode'):
+                if args.latent_cache_dir is not None:
+                    # --latent_cache_dir: only draw the latent from the cached posterior + normalize latents
+                    x = ae.sample_moments(x)  # B C T H W
+                else:
+                    # Map input images to latent space + normalize latents
+                    x = ae.encode(x)  # B C T H W
             # print(f'step: {step_}, rank: {accelerator.process_index}, after vae.encode, x: {x.shape}, dtype: {x.dtype}, mean: {x.mean()}, std: {x.std()}')
             # x = torch.rand(1, 32, 14, 80, 80).to(x.device, dtype=x.dtype)
             # def custom_to_video(x: torch.Tensor, fps: float = 2.0, output_file: str = 'output_video.mp4') -> None:
@@ -893,11 +1071,15 @@ def main(args):
         # print("rank {} | step {} | after encode".format(accelerator.process_index, step_))
         if args.extra_save_mem:
             ae.vae.to('cpu')
-            text_enc_1.to('cpu')
+            if text_enc_1 is not None:
+                text_enc_1.to('cpu')
             if text_enc_2 is not None:
                 text_enc_2.to('cpu')
             torch.cuda.empty_cache()
+        return x, attn_mask, cond_1, cond_mask_1, cond_2
 
+    def train_one_step(step_, encoded_, prof_=None):
+        x, attn_mask, cond_1, cond_mask_1, cond_2 = encoded_
         current_step_frame = x.shape[2]
         current_step_sp_state = get_sequence_parallel_state()
         if args.sp_size != 1:  # enable sp
@@ -906,9 +1088,10 @@ def main(args):
             else:
                 set_sequence_parallel_state(True)
         if get_sequence_parallel_state():
-            x, cond_1, attn_mask, cond_mask_1, cond_2 = prepare_parallel_data(
-                x, cond_1, attn_mask, cond_mask_1, cond_2
-                )        
+            with telemetry.stage('sp_all_to_all'):
+                x, cond_1, attn_mask, cond_mask_1, cond_2 = prepare_parallel_data(
+                    x, cond_1, attn_mask, cond_mask_1, cond_2
+                    )        
             # x            (b c t h w)   -gather0-> (sp*b c t h w)   -scatter2-> (sp*b c t//sp h w)
             # cond_1       (b sp l/sp d) -gather0-> (sp*b sp l/sp d) -scatter1-> (sp*b 1 l/sp d)
             # attn_mask    (b t*sp h w)  -gather0-> (sp*b t*sp h w)  -scatter1-> (sp*b t h w)
@@ -948,14 +1131,52 @@ def main(args):
 
         return False
 
+    encode_pipeline = None
+    if args.encode_prefetch > 0:
+        if args.extra_save_mem:
+            logger.warning('--extra_save_mem moves the encoders off the device around every encode, '
+                           'ignoring --encode_prefetch and encoding serially')
+        else:
+            encode_pipeline = EncodePipeline(lambda data_item: encode_batch(data_item, timed=False), accelerator.device, depth=args.encode_prefetch)
+
+    class ConsumerEnd(object):
+        # stands in for the dataloader `accelerator.accumulate` asks about the end of the epoch
+        def __init__(self):
+            self.end_of_dataloader = False
+            self.remainder = getattr(train_dataloader, 'remainder', -1)
+
+    def pipelined_batches():
+        """
+        The batches of `encode_pipeline`, with the end of the epoch as the training side sees it. The loader runs
+        --encode_prefetch batches ahead: it flags its last batch early, so the micro-batches after it would each sync
+        the gradients, and leaves the gradient state once exhausted, so the actual last one would not. The loader
+        registers itself when its first batch is drawn; registered after that, `ConsumerEnd` is the active one.
+        """
+        consumer_end = None
+        try:
+            for encoded in encode_pipeline(train_dataloader):
+                if consumer_end is None:
+                    consumer_end = ConsumerEnd()
+                    accelerator.gradient_state._add_dataloader(consumer_end)
+                consumer_end.end_of_dataloader = encode_pipeline.end_of_input
+                yield encoded
+        finally:
+            if consumer_end is not None:
+                accelerator.gradient_state._remove_dataloader(consumer_end)
+
     def train_one_epoch(prof_=None):
         # for epoch in range(first_epoch, args.num_train_epochs):
         progress_info.train_loss = 0.0
         if progress_info.global_step >= args.max_train_steps:
             return True
-        for step, data_item in enumerate(train_dataloader):
+        if encode_pipeline is not None:
+            # the next batches are encoded while this one trains, data_wait includes waiting for their encode
+            batches = telemetry.timed(pipelined_batches(), 'data_wait')
+        else:
+            batches = (encode_batch(data_item) for data_item in telemetry.timed(train_dataloader, 'data_wait'))
+        for step, encoded in enumerate(batches):
             # print("rank {} | step {} | get data".format(accelerator.process_index, step))
-            if train_one_step(step, data_item, prof_):
+            if train_one_step(step, encoded, prof_):
                 break
 
             if step >= 2 and torch_npu is not None and npu_config is not None:
@@ -992,7 +1213,10 @@ def main(args):
                     torch.profiler.ProfilerActivity.CUDA, 
                     ], 
                 schedule=torch.profiler.schedule(wait=5, warmup=1, active=1, repeat=1, skip_first=0),
-                on_trace_ready=torch.profiler.tensorboard_trace_handler('./gpu_profiling_active_1_delmask_delbkmask_andvaemask_curope_gpu'),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    os.path.join(args.telemetry_dir, 'profile') if args.telemetry_dir is not None 
+                    else './gpu_profiling_active_1_delmask_delbkmask_andvaemask_curope_gpu'
+                    ),
                 record_shapes=True,
                 profile_memory=True,
                 with_stack=True
@@ -1000,6 +1224,9 @@ def main(args):
                 train_one_epoch(prof)
         else:
             train_one_epoch()
+    if checkpointer is not None:
+        checkpointer.close()
+    telemetry.close()
     accelerator.wait_for_everyone()
     accelerator.end_training()
     if get_sequence_parallel_state():
@@ -1022,20 +1249,46 @@ if __name__ == "__main__":
     parser.add_argument("--max_hxw", type=int, default=None)
     parser.add_argument("--min_hxw", type=int, default=None)
     parser.add_argument("--ood_img_ratio", type=float, default=0.0)
-    parser.add_argument("--use_img_from_vid", action="store_true")
+    parser.add_argument("--use_img_from_vid", action="store_true", help="Cut a still frame for the image buckets out of every decoded frame window.")
+    parser.add_argument("--windows_per_clip", type=int, default=1, help="Non-overlapping frame windows decoded per read of a long clip, the extra ones are served in place of later samples of the same shape.")
+    parser.add_argument("--window_reservoir_mb", type=int, default=2048, help="Memory per dataloader worker for the extra windows and still frames of --windows_per_clip/--use_img_from_vid.")
+    parser.add_argument("--max_windows_per_batch", type=int, default=1, help="Samples of one clip allowed in a batch when serving extra windows.")
     parser.add_argument("--model_max_length", type=int, default=512)
     parser.add_argument('--cfg', type=float, default=0.1)
     parser.add_argument("--dataloader_num_workers", type=int, default=10, help="Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process.")
     parser.add_argument("--train_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader.")
     parser.add_argument("--group_data", action="store_true")
+    parser.add_argument("--token_budget", type=int, default=None, help="Fill every batch with samples of one shape up to this many transformer tokens per device, instead of --train_batch_size samples.")
+    parser.add_argument("--max_batch_size", type=int, default=None, help="Upper bound of the per-device batch size with --token_budget.")
+    parser.add_argument("--shard_dir", type=str, default=None, help="Stream the data out of the tar shards written by `python -m opensora.dataset.shard_dataset`.")
+    parser.add_argument("--shard_shuffle_buffer", type=int, default=1024, help="Samples each dataloader worker shuffles over when reading --shard_dir.")
     parser.add_argument("--hw_stride", type=int, default=32)
     parser.add_argument("--force_resolution", action="store_true")
-    parser.add_argument("--trained_data_global_step", type=int, default=None)
+    parser.add_argument("--trained_data_global_step", type=int, default=None, help="Skip the data of this many steps, instead of resuming the sampler state stored in the checkpoint.")
     parser.add_argument("--use_decord", action="store_true")
+    parser.add_argument("--meta_index_dir", type=str, default=None, help="Directory of the memory-mapped meta index, built once per filtering args and shared by all ranks on a host.")
+    parser.add_argument("--token_cache_dir", type=str, default=None, help="Directory of the pre-tokenized captions built by `python -m opensora.dataset.token_cache`, misses fall back to the tokenizers.")
+    parser.add_argument("--text_embed_cache_dir", type=str, default=None, help="Directory of the text encoder outputs built by `python -m opensora.dataset.text_embed_cache` from --token_cache_dir, the text encoders are not loaded.")
+    parser.add_argument("--latent_cache_dir", type=str, default=None, help="Directory of the VAE moments built by `python -m opensora.dataset.latent_cache` with the same data args, videos are not decoded and the VAE encoder is skipped.")
+    parser.add_argument("--decode_threads", type=int, default=4, help="Decoder threads per dataloader worker, a batch is decoded concurrently.")
+    parser.add_argument("--decode_prefetch_batches", type=int, default=1, help="Batches each dataloader worker decodes ahead along the sampler order.")
+    parser.add_argument("--quarantine_dir", type=str, default=None, help="Ledger of files that failed to decode, merged over ranks and runs; they are skipped and dropped from the next meta index build. Report with `python -m opensora.dataset.quarantine`.")
+    parser.add_argument("--decode_stats_dir", type=str, default=None, help="Directory for per-worker decode latency histograms, merge them with `python -m opensora.dataset.decode_engine`.")
+    parser.add_argument("--decoder_cache_size", type=int, default=32, help="Open decord readers kept per dataloader worker.")
+    parser.add_argument("--decoder_cache_mb", type=int, default=2048, help="Estimated frame-buffer budget (MB) of the cached decord readers per dataloader worker.")
+    parser.add_argument("--virtual_disk_dir", type=str, default=None, help="Local cache of the remote data files shared by all ranks on a host, the data paths are then object names of the remote store.")
+    parser.add_argument("--virtual_disk_size", type=str, default='64G', help="Size bound of --virtual_disk_dir, least recently used files are evicted.")
+    parser.add_argument("--virtual_disk_remote", type=str, default=None, help="Directory standing in for the remote store of --virtual_disk_dir, the OBS bucket through obsutil if not given.")
+    parser.add_argument("--virtual_disk_max_transfers", type=int, default=32, help="Downloads into --virtual_disk_dir running at once on a host, over all ranks and dataloader workers.")
+    parser.add_argument("--virtual_disk_read_ahead", type=int, default=8, help="Batches after the decoded ones whose files each dataloader worker fetches into --virtual_disk_dir.")
+    parser.add_argument("--nan_check_interval", type=int, default=100, help="Collate checks one of every N batches for NaN, 0 disables the check.")
 
     # text encoder & vae & diffusion model
     parser.add_argument('--vae_fp32', action='store_true')
     parser.add_argument('--extra_save_mem', action='store_true')
+    parser.add_argument("--encode_prefetch", type=int, default=0, 
+                        help="Batches whose text and VAE encode runs on a side stream while the current batch trains, "
+                             "0 encodes serially before every step. The encoders stay on the device, so it is ignored with --extra_save_mem.")
     parser.add_argument("--model", type=str, choices=list(Diffusion_models.keys()), default="Latte-XL/122")
     parser.add_argument('--enable_tiling', action='store_true')
     parser.add_argument('--interpolation_scale_h', type=float, default=1.0)
@@ -1064,8 +1317,12 @@ if __name__ == "__main__":
     parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA model.")
     parser.add_argument("--ema_decay", type=float, default=0.9999)
     parser.add_argument("--ema_start_step", type=int, default=0)
-    parser.add_argument("--offload_ema", action="store_true", help="Offload EMA model to CPU during training step.")
-    parser.add_argument("--foreach_ema", action="store_true", help="Use faster foreach implementation of EMAModel.")
+    parser.add_argument("--offload_ema", action="store_true", 
+                        help="Keep the EMA weights in pinned host memory, each update streams them through the device in chunks.")
+    parser.add_argument("--no_foreach_ema", action="store_false", dest="foreach_ema", 
+                        help="Update the EMA weights with a per-tensor loop instead of fused multi-tensor ops.")
+    parser.add_argument("--ema_update_every", type=int, default=1, 
+                        help="Update the EMA every N optimizer steps, with the decay of the N steps compounded.")
     parser.add_argument("--noise_offset", type=float, default=0.0, help="The scale of noise offset.")
     parser.add_argument("--prediction_type", type=str, default='epsilon', help="The prediction_type that shall be used for training. Choose between 'epsilon' or 'v_prediction' or leave `None`. If left to `None` the default prediction type of the scheduler: `noise_scheduler.config.prediciton_type` is chosen.")
     parser.add_argument('--rescale_betas_zero_snr', action='store_true')
@@ -1073,6 +1330,10 @@ if __name__ == "__main__":
     # validation & logs
     parser.add_argument("--log_interval", type=int, default=10)
     parser.add_argument("--enable_profiling", action="store_true")
+    parser.add_argument("--telemetry_dir", type=str, default=None, 
+                        help="Write per step stage times, tokens/s, MFU, peak memory per bucket and rank skew as JSONL here.")
+    parser.add_argument("--peak_tflops", type=float, default=None, 
+                        help="Peak TFLOPS of one device for the MFU of --telemetry_dir, guessed for known GPUs.")
     parser.add_argument("--num_sampling_steps", type=int, default=20)
     parser.add_argument('--guidance_scale', type=float, default=4.5)
     parser.add_argument("--enable_tracker", action="store_true")
@@ -1086,6 +1347,14 @@ if __name__ == "__main__":
                             " training using `--resume_from_checkpoint`."
                         ),
                         )
+    parser.add_argument("--async_checkpoint", action="store_true",
+                        help=(
+                            "Copy the training state to pinned host memory at each checkpoint and write it from a background"
+                            " thread, as per-rank shards with a manifest. Old checkpoints are removed in the background too."
+                            " Rank 0 also writes `model/` (and `model_ema/`) in `save_pretrained` format from the shards,"
+                            " which delays the manifest but not training."
+                        ),
+                        )
     parser.add_argument("--resume_from_checkpoint", type=str, default=None,
                         help=(
                             "Whether training should be resumed from a previous checkpoint. Use a path saved by"
@@ -0,0 +1,374 @@
+import os
+import json
+import time
+import copy
+import glob
+import heapq
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class _Leaf(object):
+    """Placeholder of a tensor in the skeleton of a flattened state."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _flatten(state, prefix, leaves):
+    """Replace the tensors of the nested dict/list/tuple `state` by `_Leaf`s, appending `(path, tensor)` to `leaves`."""
+    if isinstance(state, torch.Tensor):
+        leaves.append((prefix, state))
+        return _Leaf(len(leaves) - 1)
+    if isinstance(state, dict):
+        container = OrderedDict if isinstance(state, OrderedDict) else dict
+        return container((k, _flatten(v, f'{prefix}.{k}', leaves)) for k, v in state.items())
+    if isinstance(state, (list, tuple)) and not hasattr(state, '_fields'):
+        items = [_flatten(v, f'{prefix}.{i}', leaves) for i, v in enumerate(state)]
+        return items if isinstance(state, list) else tuple(items)
+    # small python objects (step counters, rng states, loss scalers) are copied now, as training keeps mutating them
+    return copy.deepcopy(state)
+
+
+def _unflatten(skeleton, tensors):
+    if isinstance(skeleton, _Leaf):
+        return tensors[skeleton.index]
+    if isinstance(skeleton, dict):
+        return type(skeleton)((k, _unflatten(v, tensors)) for k, v in skeleton.items())
+    if isinstance(skeleton, (list, tuple)):
+        items = [_unflatten(v, tensors) for v in skeleton]
+        return items if isinstance(skeleton, list) else tuple(items)
+    return skeleton
+
+
+def _leaf_indices(skeleton):
+    if isinstance(skeleton, _Leaf):
+        yield skeleton.index
+    elif isinstance(skeleton, dict):
+        for v in skeleton.values():
+            yield from _leaf_indices(v)
+    elif isinstance(skeleton, (list, tuple)):
+        for v in skeleton:
+            yield from _leaf_indices(v)
+
+
+def _owners(leaves, world_size):
+    """Deterministic byte-balanced assignment of the leaves to ranks, the same on every rank for the same state."""
+    sizes = [tensor.numel() * tensor.element_size() for _, tensor in leaves]
+    loads = [(0, rank) for rank in range(world_size)]
+    owners = [0] * len(leaves)
+    for i in sorted(range(len(leaves)), key=lambda i: (-sizes[i], i)):
+        load, rank = heapq.heappop(loads)
+        owners[i] = rank
+        heapq.heappush(loads, (load + sizes[i], rank))
+    return owners
+
+
+def _atomic_save(obj, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_json(obj, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_pretrained_state(state_dict, config, path):
+    """
+    Write `state_dict` with `config` (a dict, e.g. from `model.to_json_string()`) in the layout of diffusers'
+    `save_pretrained`, so `from_pretrained(path)` loads it. The folder is written aside and renamed into place.
+    """
+    from safetensors.torch import save_file
+
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+    save_file(state_dict, os.path.join(tmp_path, 'diffusion_pytorch_model.safetensors'), metadata={'format': 'pt'})
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_step(path):
+    return int(os.path.basename(os.path.normpath(path)).split("-")[1])
+
+
+def is_complete(checkpoint_dir):
+    """Written by the async checkpointer and finished on every rank."""
+    return os.path.exists(os.path.join(checkpoint_dir, 'manifest.json'))
+
+
+def is_partial(checkpoint_dir):
+    """An async checkpoint some rank never finished, e.g. the job was killed while writing it."""
+    return not is_complete(checkpoint_dir) and len(glob.glob(os.path.join(checkpoint_dir, 'shard.*'))) > 0
+
+
+def latest_checkpoint(output_dir):
+    """The newest `checkpoint-*` of `output_dir` that can be resumed from, skipping partial async checkpoints."""
+    dirs = [d for d in os.listdir(output_dir) if d.startswith("checkpoint")] if os.path.isdir(output_dir) else []
+    dirs = [d for d in dirs if not is_partial(os.path.join(output_dir, d))]
+    dirs = sorted(dirs, key=checkpoint_step)
+    return dirs[-1] if len(dirs) > 0 else None
+
+
+class AsyncCheckpointer(object):
+    """
+    Checkpoints written in the background. `save` stalls training only to copy the state into pinned host memory;
+    a writer thread then writes the shards of this rank with atomic renames, rank 0 adds `manifest.json` once all
+    ranks finished and removes the checkpoints beyond `total_limit`.
+
+    The state comes in two parts. `replicated` is identical on all ranks (model, EMA, scheduler, sampler): each of
+    its tensors is written by one rank only, balanced by bytes, so every rank copies and writes 1/world_size of it.
+    `local` is rank specific (ZeRO optimizer partitions, RNG states) and written whole by its rank.
+
+    Layout of `checkpoint-{step}`:
+        shard.replicated.rank{R:05d}.pt   tensors of `replicated` owned by rank R (+ its skeleton on rank 0)
+        shard.local.rank{R:05d}.pt        `local` of rank R
+        shard.rank{R:05d}.json            written after both files of rank R are in place
+        manifest.json                     written by rank 0 once every rank is done, marks the checkpoint complete
+
+    The shards are only read back by `load_checkpoint`. For other readers, `export_fn(checkpoint_dir, state)` runs
+    on the writer thread of rank 0 once every rank is done and before the manifest, with the entries `export_keys`
+    of `replicated` reassembled from all shards, e.g. to write the weights with `save_pretrained_state`.
+    """
+
+    def __init__(self, output_dir, rank=0, world_size=1, total_limit=None, manifest_timeout=3600.0, export_fn=None, 
+                 export_keys=None):
+        self.output_dir = output_dir
+        self.rank = rank
+        self.world_size = world_size
+        self.total_limit = total_limit
+        self.manifest_timeout = manifest_timeout
+        self.export_fn = export_fn
+        self.export_keys = export_keys
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.buffers = {}
+        self.history = []
+
+    def _pinned_copy(self, key, tensor, buffers):
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+        buf.copy_(tensor.detach(), non_blocking=True)
+        buffers[key] = buf
+        return buf
+
+    def _snapshot(self, replicated, local):
+        buffers, devices = {}, set()
+        replicated_leaves, local_leaves = [], []
+        replicated_skeleton = _flatten(replicated, 'replicated', replicated_leaves)
+        local_skeleton = _flatten(local, 'local', local_leaves)
+        owners = _owners(replicated_leaves, self.world_size)
+
+        owned = {}
+        for i, (key, tensor) in enumerate(replicated_leaves):
+            if owners[i] == self.rank:
+                owned[i] = self._pinned_copy(key, tensor, buffers)
+                devices.add(tensor.device)
+        local_tensors = []
+        for key, tensor in local_leaves:
+            local_tensors.append(self._pinned_copy(key, tensor, buffers))
+            devices.add(tensor.device)
+        # the device to host copies were queued non_blocking, wait for them before training touches the tensors again
+        for device in devices:
+            if device.type != 'cpu':
+                getattr(torch, device.type).synchronize(device)
+        # buffers of tensors that left the state are released rather than kept pinned
+        self.buffers = buffers
+
+        replicated_shard = dict(owned=owned, skeleton=replicated_skeleton if self.rank == 0 else None)
+        local_shard = dict(tensors=local_tensors, skeleton=local_skeleton)
+        return replicated_shard, local_shard
+
+    def save(self, checkpoint_dir, replicated, local=None):
+        """Snapshot the state and hand it to the writer thread. Returns the seconds training was stalled."""
+        start_time = time.time()
+        # the pinned buffers are reused, so the previous checkpoint must be on disk before they are overwritten
+        self.wait()
+        wait_time = time.time() - start_time
+        replicated_shard, local_shard = self._snapshot(replicated, local)
+        stall_time = time.time() - start_time
+        self.pending = self.executor.submit(self._write, checkpoint_dir, replicated_shard, local_shard, start_time)
+        self.history.append(dict(step=checkpoint_step(checkpoint_dir), stall=stall_time, wait=wait_time))
+        return stall_time
+
+    def wait(self):
+        """Block until the last `save` is written, re-raising its error."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            write_time = pending.result()
+            self.history[-1]['write'] = write_time
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, checkpoint_dir, replicated_shard, local_shard, start_time):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        files = [f'shard.replicated.rank{self.rank:05d}.pt', f'shard.local.rank{self.rank:05d}.pt']
+        num_bytes = 0
+        for name, shard in zip(files, [replicated_shard, local_shard]):
+            path = os.path.join(checkpoint_dir, name)
+            _atomic_save(shard, path)
+            num_bytes += os.path.getsize(path)
+        write_time = time.time() - start_time
+        _atomic_json(
+            dict(rank=self.rank, files=files, bytes=num_bytes, seconds=round(write_time, 3)),
+            os.path.join(checkpoint_dir, f'shard.rank{self.rank:05d}.json')
+            )
+        if self.rank == 0:
+            self._finish(checkpoint_dir)
+        return write_time
+
+    def _finish(self, checkpoint_dir):
+        deadline = time.time() + self.manifest_timeout
+        shard_paths = [os.path.join(checkpoint_dir, f'shard.rank{rank:05d}.json') for rank in range(self.world_size)]
+        while not all(os.path.exists(path) for path in shard_paths):
+            if time.time() > deadline:
+                missing = [path for path in shard_paths if not os.path.exists(path)]
+                raise TimeoutError(f'{len(missing)} ranks did not finish {checkpoint_dir} in {self.manifest_timeout}s')
+            time.sleep(1.0)
+        shards = []
+        for path in shard_paths:
+            with open(path, 'r') as f:
+                shards.append(json.load(f))
+        if self.export_fn is not None:
+            start_time = time.time()
+            self.export_fn(checkpoint_dir, _load_replicated(checkpoint_dir, self.world_size, self.export_keys))
+            print(f'Export {checkpoint_dir} in {time.time() - start_time:.2f}s')
+        _atomic_json(
+            dict(step=checkpoint_step(checkpoint_dir), world_size=self.world_size, shards=shards, time=time.time()),
+            os.path.join(checkpoint_dir, 'manifest.json')
+            )
+        self._rotate(checkpoint_step(checkpoint_dir))
+
+    def _rotate(self, step):
+        dirs = [d for d in os.listdir(self.output_dir) if d.startswith("checkpoint")]
+        dirs = sorted(dirs, key=checkpoint_step)
+        kept = [d for d in dirs if not is_partial(os.path.join(self.output_dir, d))]
+        removing = [d for d in dirs if checkpoint_step(d) < step and d not in kept]
+        if self.total_limit is not None and len(kept) > self.total_limit:
+            removing += kept[:len(kept) - self.total_limit]
+        for d in removing:
+            print(f'Remove checkpoint {d}')
+            shutil.rmtree(os.path.join(self.output_dir, d), ignore_errors=True)
+
+
+def _load_replicated(checkpoint_dir, world_size, keys=None):
+    """The `replicated` state reassembled from the shards of `world_size` ranks, only its entries `keys` if given."""
+    # rank 0 holds the skeleton, which tells the tensors to keep from the other shards
+    shard = torch.load(os.path.join(checkpoint_dir, 'shard.replicated.rank00000.pt'), map_location='cpu', weights_only=False)
+    skeleton = shard['skeleton']
+    if keys is not None:
+        skeleton = type(skeleton)((k, v) for k, v in skeleton.items() if k in keys)
+    needed = set(_leaf_indices(skeleton))
+    tensors = {i: t for i, t in shard['owned'].items() if i in needed}
+    for saved_rank in range(1, world_size):
+        shard = torch.load(
+            os.path.join(checkpoint_dir, f'shard.replicated.rank{saved_rank:05d}.pt'), map_location='cpu', weights_only=False
+            )
+        tensors.update((i, t) for i, t in shard['owned'].items() if i in needed)
+        del shard
+    return _unflatten(skeleton, tensors)
+
+
+def load_checkpoint(checkpoint_dir, rank=0, world_size=1):
+    """
+    Reassemble the `replicated` state of an async checkpoint from the shards of all ranks, and load the `local`
+    state of `rank`. `local` is None when the checkpoint was written by a different number of ranks.
+    """
+    with open(os.path.join(checkpoint_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    replicated = _load_replicated(checkpoint_dir, manifest['world_size'])
+    local = None
+    if manifest['world_size'] == world_size:
+        shard = torch.load(os.path.join(checkpoint_dir, f'shard.local.rank{rank:05d}.pt'), map_location='cpu', weights_only=False)
+        local = _unflatten(shard['skeleton'], shard['tensors'])
+    else:
+        print(f"{checkpoint_dir} was written by {manifest['world_size']} ranks, not {world_size}: skip the rank local state")
+    return replicated, local
+
+
+if __name__ == "__main__":
+    '''
+    Training stall per save of a synthetic state, blocking torch.save versus the async checkpointer:
+    python -m opensora.utils.async_checkpoint bench --output_dir /tmp/ckpt_bench --size_gb 4 --num_saves 3
+    Merge an async checkpoint into single raw state files (model.pt, model_ema.pt, ...), e.g. to inspect the optimizer;
+    the `model/` and `model_ema/` folders for `from_pretrained` are written by the training script already:
+    python -m opensora.utils.async_checkpoint merge --checkpoint_dir /path/to/checkpoint-1000
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("--output_dir", type=str, required=True)
+    bench_parser.add_argument("--size_gb", type=float, default=1.0)
+    bench_parser.add_argument("--num_tensors", type=int, default=512)
+    bench_parser.add_argument("--num_saves", type=int, default=3)
+    bench_parser.add_argument("--step_seconds", type=float, default=1.0, help="simulated training time between saves")
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("--checkpoint_dir", type=str, required=True)
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        replicated, _ = load_checkpoint(args.checkpoint_dir)
+        for name, state in replicated.items():
+            path = os.path.join(args.checkpoint_dir, f'{name}.pt')
+            torch.save(state, path)
+            print(f'Write {path}')
+    else:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        numel = int(args.size_gb * 1024 ** 3 / 4 / args.num_tensors)
+        model = {f'layer{i}.weight': torch.randn(numel, device=device) for i in range(args.num_tensors)}
+        optimizer = dict(state={i: dict(step=torch.tensor(1.0)) for i in range(args.num_tensors)}, param_groups=[dict(lr=1e-4)])
+
+        def train_step():
+            end_time = time.time() + args.step_seconds
+            while time.time() < end_time:
+                for tensor in list(model.values())[:8]:
+                    tensor.mul_(1.0)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        blocking = []
+        for i in range(args.num_saves):
+            train_step()
+            start_time = time.time()
+            checkpoint_dir = os.path.join(args.output_dir, f'checkpoint-{i}')
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            torch.save(dict(model=model, optimizer=optimizer), os.path.join(checkpoint_dir, 'state.pt'))
+            blocking.append(time.time() - start_time)
+            shutil.rmtree(checkpoint_dir)
+
+        checkpointer = AsyncCheckpointer(args.output_dir, total_limit=1)
+        for i in range(args.num_saves):
+            train_step()
+            checkpointer.save(os.path.join(args.output_dir, f'checkpoint-{args.num_saves + i}'), dict(model=model, optimizer=optimizer))
+        checkpointer.close()
+        replicated, _ = load_checkpoint(os.path.join(args.output_dir, f'checkpoint-{2 * args.num_saves - 1}'))
+        assert all(torch.equal(replicated['model'][k], v.cpu()) for k, v in model.items())
+
+        print(f'{args.size_gb:.1f} GB state on {device}, {args.num_saves} saves')
+        for i, seconds in enumerate(blocking):
+            print(f'  blocking save {i}: training stalled {seconds:.2f}s')
+        for i, entry in enumerate(checkpointer.history):
+            print(f"  async save {i}: training stalled {entry['stall']:.2f}s "
+                  f"(waiting on the previous write {entry['wait']:.2f}s), written in {entry['write']:.2f}s")
+        print(f'mean stall per save: blocking {sum(blocking) / len(blocking):.2f}s, '
+              f"async {sum(entry['stall'] for entry in checkpointer.history) / len(checkpointer.history):.2f}s")
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 from einops import rearrange
 import decord
 from torch.nn import functional as F
@@ -9,7 +10,7 @@ import torch.utils.data
 import torch
 from torch.utils.data import Sampler
 from typing import List
-from collections import Counter, defaultdict
+from collections import Counter
 import random
 
 
@@ -50,10 +51,23 @@ def pad_to_multiple(number, ds_stride):
         padding = ds_stride - remainder
         return number + padding
 
+def new_batch_tensor(elem, shape):
+    """
+    Uninitialized tensor of `shape` like `elem`. Inside a DataLoader worker it is allocated in shared memory, as
+    `default_collate` does, so handing the batch to the main process does not copy it again.
+    """
+    if torch.utils.data.get_worker_info() is not None:
+        storage = elem.untyped_storage()._new_shared(math.prod(shape) * elem.element_size(), device=elem.device)
+        return elem.new_empty(0).set_(storage, 0, shape)
+    return torch.empty(shape, dtype=elem.dtype, device=elem.device)
+
+
 class Collate:
     def __init__(self, args):
-        self.batch_size = args.train_batch_size
-        self.group_data = args.group_data
+        self.token_budget = getattr(args, 'token_budget', None)
+        # --token_budget batches vary in size but always hold a single shape, like --group_data ones
+        self.batch_size = args.train_batch_size if self.token_budget is None else None
+        self.group_data = args.group_data or self.token_budget is not None
         self.force_resolution = args.force_resolution
 
         self.max_height = args.max_height
@@ -61,7 +75,6 @@ class Collate:
         self.ae_stride = args.ae_stride
 
         self.ae_stride_t = args.ae_stride_t
-        self.ae_stride_thw = (self.ae_stride_t, self.ae_stride, self.ae_stride)
 
         self.patch_size = args.patch_size
         self.patch_size_t = args.patch_size_t
@@ -69,6 +82,18 @@ class Collate:
         self.num_frames = args.num_frames
         self.max_thw = (self.num_frames, self.max_height, self.max_width)
 
+        if getattr(args, 'latent_cache_dir', None) is not None:
+            # samples are cached latent moments, so padding and the attention mask are counted in latent units
+            self.max_thw = (
+                (self.num_frames - 1) // self.ae_stride_t + 1, self.max_height // self.ae_stride, self.max_width // self.ae_stride
+                )
+            self.ae_stride_t, self.ae_stride = 1, 1
+        self.ae_stride_thw = (self.ae_stride_t, self.ae_stride, self.ae_stride)
+
+        # check one of every `nan_check_interval` batches for NaN, 0 disables the check
+        self.nan_check_interval = getattr(args, 'nan_check_interval', 100)
+        self.num_batches = 0
+
     def package(self, batch):
         batch_tubes = [i['pixel_values'] for i in batch]  # b [c t h w]
         input_ids_1 = [i['input_ids_1'] for i in batch]  # b [1 l]
@@ -93,16 +118,19 @@ class Collate:
             batch_tubes, input_ids_1, cond_mask_1, input_ids_2, cond_mask_2, 
             t_ds_stride, ds_stride, self.max_thw, self.ae_stride_thw
         )
-        assert not torch.any(torch.isnan(pad_batch_tubes)), 'after pad_batch_tubes'
+        if self.nan_check_interval > 0 and self.num_batches % self.nan_check_interval == 0:
+            assert not torch.any(torch.isnan(pad_batch_tubes)), 'after pad_batch_tubes'
+        self.num_batches += 1
         return pad_batch_tubes, attention_mask, input_ids_1, cond_mask_1, input_ids_2, cond_mask_2
 
     def process(self, batch_tubes, input_ids_1, cond_mask_1, input_ids_2, cond_mask_2, t_ds_stride, ds_stride, max_thw, ae_stride_thw):
         # pad to max multiple of ds_stride
         batch_input_size = [i.shape for i in batch_tubes]  # [(c t h w), (c t h w)]
-        assert len(batch_input_size) == self.batch_size
-        if self.group_data or self.batch_size == 1:  #
+        batch_size = len(batch_input_size)
+        assert self.batch_size is None or batch_size == self.batch_size
+        if self.group_data or batch_size == 1:  #
             len_each_batch = batch_input_size
-            idx_length_dict = dict([*zip(list(range(self.batch_size)), len_each_batch)])
+            idx_length_dict = dict([*zip(list(range(batch_size)), len_each_batch)])
             count_dict = Counter(len_each_batch)
             if len(count_dict) != 1:
                 sorted_by_value = sorted(count_dict.items(), key=lambda item: item[1])
@@ -123,7 +151,7 @@ class Collate:
                 if cond_mask_2 is not None:
                     cond_mask_2 = [cond_mask_2[i] for i in pick_idx]  # b [1, l]
 
-            for i in range(1, self.batch_size):
+            for i in range(1, batch_size):
                 assert batch_input_size[0] == batch_input_size[i]
             max_t = max([i[1] for i in batch_input_size])
             max_h = max([i[2] for i in batch_input_size])
@@ -134,19 +162,11 @@ class Collate:
                                           pad_to_multiple(max_h, ds_stride), \
                                           pad_to_multiple(max_w, ds_stride)
         pad_max_t = pad_max_t + 1 - self.ae_stride_t
-        each_pad_t_h_w = [
-            [
-                pad_max_t - i.shape[1],
-                pad_max_h - i.shape[2],
-                pad_max_w - i.shape[3]
-                ] for i in batch_tubes
-                ]
-        pad_batch_tubes = [
-            F.pad(im, (0, pad_w, 0, pad_h, 0, pad_t), value=0) 
-            for (pad_t, pad_h, pad_w), im in zip(each_pad_t_h_w, batch_tubes)
-            ]
-        pad_batch_tubes = torch.stack(pad_batch_tubes, dim=0)
-
+        pad_batch_tubes = new_batch_tensor(batch_tubes[0], (len(batch_tubes), batch_input_size[0][0], pad_max_t, pad_max_h, pad_max_w))
+        if any(tuple(i[1:]) != (pad_max_t, pad_max_h, pad_max_w) for i in batch_input_size):
+            pad_batch_tubes.zero_()
+        for i, tube in enumerate(batch_tubes):
+            pad_batch_tubes[i, :, :tube.shape[1], :tube.shape[2], :tube.shape[3]] = tube  # written in place, no F.pad + stack
 
         max_tube_size = [pad_max_t, pad_max_h, pad_max_w]
         max_latent_size = [
@@ -160,13 +180,18 @@ class Collate:
                 int(math.ceil(i[2] / ae_stride_thw[1])),
                 int(math.ceil(i[3] / ae_stride_thw[2]))
                 ] for i in batch_input_size]
-        attention_mask = [
-            F.pad(torch.ones(i, dtype=pad_batch_tubes.dtype), (0, max_latent_size[2] - i[2], 
-                                                               0, max_latent_size[1] - i[1],
-                                                               0, max_latent_size[0] - i[0]), value=0) for i in valid_latent_size]
-        attention_mask = torch.stack(attention_mask)  # b t h w
-        if self.batch_size == 1 or self.group_data:
+        if all(i == max_latent_size for i in valid_latent_size):
+            attention_mask = torch.ones((len(batch_tubes), *max_latent_size), dtype=pad_batch_tubes.dtype)  # b t h w
+        else:
+            valid = torch.tensor(valid_latent_size)  # b 3
+            t, h, w = [torch.arange(i) for i in max_latent_size]
+            attention_mask = (t[None, :, None, None] < valid[:, 0, None, None, None]) \
+                & (h[None, None, :, None] < valid[:, 1, None, None, None]) \
+                & (w[None, None, None, :] < valid[:, 2, None, None, None])
+            attention_mask = attention_mask.to(pad_batch_tubes.dtype)  # b t h w
+        if batch_size == 1 or self.group_data:
             if not torch.all(attention_mask.bool()):
+                each_pad_t_h_w = [[pad_max_t - i[1], pad_max_h - i[2], pad_max_w - i[3]] for i in batch_input_size]
                 print(batch_input_size, (max_t, max_h, max_w), (pad_max_t, pad_max_h, pad_max_w), each_pad_t_h_w, max_latent_size, valid_latent_size)
             assert torch.all(attention_mask.bool())
 
@@ -178,156 +203,90 @@ class Collate:
         return pad_batch_tubes, attention_mask, input_ids_1, cond_mask_1, input_ids_2, cond_mask_2
 
 
+def length_ids(lengths):
+    """
+    Integer shape id per sample and the shape of every id, from a `sample_size` list or directly from the
+    ids of a `BucketSequence`.
+    """
+    if hasattr(lengths, 'bucket_ids'):
+        ids, names = np.asarray(lengths.bucket_ids), list(lengths.bucket_names)
+    else:
+        names, ids = np.unique(np.asarray(list(lengths)), return_inverse=True)
+        names = names.tolist()
+    # int16 keys take numpy's O(n) radix sort in the stable argsort of group_data_fun
+    return ids.astype(np.int16 if ids.size == 0 or ids.max() < 2 ** 15 else np.int32), names
+
 def group_data_fun(lengths, generator=None):
-    # counter is decrease order
-    counter = Counter(lengths)  # counter {'1x256x256': 3, ''}   lengths ['1x256x256', '1x256x256', '1x256x256', ...]
-    grouped_indices = defaultdict(list)
-    for idx, item in enumerate(lengths):  # group idx to a list
-        grouped_indices[item].append(idx)
-
-    grouped_indices = dict(grouped_indices)  # {'1x256x256': [0, 1, 2], ...}
-    sorted_indices = [grouped_indices[item] for (item, _) in sorted(counter.items(), key=lambda x: x[1], reverse=True)]
-    
-    # shuffle in each group
-    shuffle_sorted_indices = []
-    for indice in sorted_indices:
-        shuffle_idx = torch.randperm(len(indice), generator=generator).tolist()
-        shuffle_sorted_indices.extend([indice[idx] for idx in shuffle_idx])
-    return shuffle_sorted_indices
-
-def last_group_data_fun(shuffled_megabatches, lengths):
-    # lengths ['1x256x256', '1x256x256', '1x256x256' ...]
-    re_shuffled_megabatches = []
-    # print('shuffled_megabatches', len(shuffled_megabatches))
-    for i_megabatch, megabatch in enumerate(shuffled_megabatches):
-        re_megabatch = []
-        for i_batch, batch in enumerate(megabatch):
-            assert len(batch) != 0
-                
-            len_each_batch = [lengths[i] for i in batch]  # ['1x256x256', '1x256x256']
-            idx_length_dict = dict([*zip(batch, len_each_batch)])  # {0: '1x256x256', 100: '1x256x256'}
-            count_dict = Counter(len_each_batch)  # {'1x256x256': 2} or {'1x256x256': 1, '1x768x256': 1}
-            if len(count_dict) != 1:
-                sorted_by_value = sorted(count_dict.items(), key=lambda item: item[1])  # {'1x256x256': 1, '1x768x256': 1}
-                # import ipdb;ipdb.set_trace()
-                # print(batch, idx_length_dict, count_dict, sorted_by_value)
-                pick_length = sorted_by_value[-1][0]  # the highest frequency
-                candidate_batch = [idx for idx, length in idx_length_dict.items() if length == pick_length]
-                random_select_batch = [random.choice(candidate_batch) for i in range(len(len_each_batch) - len(candidate_batch))]
-                # print(batch, idx_length_dict, count_dict, sorted_by_value, pick_length, candidate_batch, random_select_batch)
-                batch = candidate_batch + random_select_batch
-                # print(batch)
-
-            for i in range(1, len(batch)-1):
-                # if not lengths[batch[0]] == lengths[batch[i]]:
-                #     print(batch, [lengths[i] for i in batch])
-                #     import ipdb;ipdb.set_trace()
-                assert lengths[batch[0]] == lengths[batch[i]]
-            re_megabatch.append(batch)
-        re_shuffled_megabatches.append(re_megabatch)
-    
-    
-    # for megabatch, re_megabatch in zip(shuffled_megabatches, re_shuffled_megabatches):
-    #     for batch, re_batch in zip(megabatch, re_megabatch):
-    #         for i, re_i in zip(batch, re_batch):
-    #             if i != re_i:
-    #                 print(i, re_i)
-    return re_shuffled_megabatches
-                
-def split_to_even_chunks(megabatch, lengths, world_size, batch_size):
     """
-    Split a list of indices into `chunks` chunks of roughly equal lengths.
+    Indices grouped by shape, the most frequent shape first (ties in order of first occurrence), shuffled
+    within each group. Returns an int32 array.
+    """
+    ids, _ = length_ids(lengths)
+    counts = np.bincount(ids)
+    by_group = np.argsort(ids, kind='stable').astype(np.int32)  # indices of shape 0, then shape 1, ...
+    starts = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    present = np.flatnonzero(counts)
+    first = by_group[starts[present]]
+    group_order = present[np.lexsort((first, -counts[present]))]
+
+    indices = np.empty(len(ids), dtype=np.int32)
+    pos = 0
+    for group in group_order:
+        members = by_group[starts[group]: starts[group + 1]]
+        shuffle_idx = torch.randperm(len(members), generator=generator).numpy()
+        indices[pos: pos + len(members)] = members[shuffle_idx]
+        pos += len(members)
+    return indices
+
+def last_group_data_fun(batches, ids, rng):
+    """
+    Make every batch (a row of the `batches` array) single-shape: keep the samples of its most frequent shape
+    and refill the batch with random picks among them.
+    """
+    batch_ids = ids[batches]
+    mixed = np.flatnonzero((batch_ids != batch_ids[:, :1]).any(axis=1))
+    for i in mixed:
+        values, first, counts = np.unique(batch_ids[i], return_index=True, return_counts=True)
+        top = np.flatnonzero(counts == counts.max())
+        pick_length = values[top[np.argmax(first[top])]]  # the highest frequency, the later one on ties
+        candidate_batch = batches[i][batch_ids[i] == pick_length]
+        batches[i] = np.concatenate([candidate_batch, rng.choice(candidate_batch, len(batches[i]) - len(candidate_batch))])
+    return batches
+
+def split_to_even_chunks(megabatch, world_size, batch_size, rng):
+    """
+    Split a megabatch of indices into `world_size` strided chunks of `batch_size`, padding short chunks with
+    random picks from themselves (or a copy of a random earlier chunk if empty). Returns a (world_size, batch_size) array.
     """
     # batch_size=2, world_size=2
-    # [1, 2, 3, 4] -> [[1, 2], [3, 4]]
-    # [1, 2, 3] -> [[1, 2], [3]]
-    # [1, 2] -> [[1], [2]]
-    # [1] -> [[1], []]
-    chunks = [megabatch[i::world_size] for i in range(world_size)]
-
-    pad_chunks = []
-    for idx, chunk in enumerate(chunks):
-        if batch_size != len(chunk):  
-            assert batch_size > len(chunk)
-            if len(chunk) != 0:  # [[1, 2], [3]] -> [[1, 2], [3, 3]]
-                chunk = chunk + [random.choice(chunk) for _ in range(batch_size - len(chunk))]
-            else:
-                chunk = random.choice(pad_chunks)  # [[1], []] -> [[1], [1]]
-                print(chunks[idx], '->', chunk)
-        pad_chunks.append(chunk)
-    return pad_chunks
-
-def get_length_grouped_indices(lengths, batch_size, world_size, gradient_accumulation_size, initial_global_step, generator=None, group_data=False, seed=42):
-    # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    if generator is None:
-        generator = torch.Generator().manual_seed(seed)  # every rank will generate a fixed order but random index
-    # print('lengths', lengths)
-    
-    if group_data:
-        indices = group_data_fun(lengths, generator)
-    else:
-        indices = torch.randperm(len(lengths), generator=generator).tolist()
-    # print('indices', len(indices))
-
-    # print('sort indices', len(indices))
-    # print('sort indices', indices)
-    # print('sort lengths', [lengths[i] for i in indices])
-    
-    megabatch_size = world_size * batch_size
-    megabatches = [indices[i: i + megabatch_size] for i in range(0, len(lengths), megabatch_size)]
-    # import ipdb;ipdb.set_trace()
-    # print('megabatches', len(megabatches))
-    # print('\nmegabatches', megabatches)
-    # megabatches = [sorted(megabatch, key=lambda i: lengths[i], reverse=True) for megabatch in megabatches]
-    # import ipdb;ipdb.set_trace()
-    # print('sort megabatches', len(megabatches))
-    megabatches_len = [[lengths[i] for i in megabatch] for megabatch in megabatches]
-    # print(f'\nrank {accelerator.process_index} sorted megabatches_len', megabatches_len[0], megabatches_len[1], megabatches_len[-2], megabatches_len[-1])
-    # import ipdb;ipdb.set_trace()
-    megabatches = [split_to_even_chunks(megabatch, lengths, world_size, batch_size) for megabatch in megabatches]
-    # import ipdb;ipdb.set_trace()
-    # print('nsplit_to_even_chunks megabatches', len(megabatches))
-    # print('\nsplit_to_even_chunks megabatches', megabatches)
-    split_to_even_chunks_len = [[[lengths[i] for i in batch] for batch in megabatch] for megabatch in megabatches]
-    # print(f'\nrank {accelerator.process_index} split_to_even_chunks_len', split_to_even_chunks_len[0], split_to_even_chunks_len[1], split_to_even_chunks_len[-2], split_to_even_chunks_len[-1])
-    # print('\nsplit_to_even_chunks len', split_to_even_chunks_len)
-    # return [i for megabatch in megabatches for batch in megabatch for i in batch]
-
-    indices_mega = torch.randperm(len(megabatches), generator=generator).tolist()
-    # print(f'rank {accelerator.process_index} seed {seed}, len(megabatches) {len(megabatches)}, indices_mega, {indices_mega[:50]}')
-    shuffled_megabatches = [megabatches[i] for i in indices_mega]
-    shuffled_megabatches_len = [[[lengths[i] for i in batch] for batch in megabatch] for megabatch in shuffled_megabatches]
-    # print(f'\nrank {accelerator.process_index} sorted shuffled_megabatches_len', shuffled_megabatches_len[0], shuffled_megabatches_len[1], shuffled_megabatches_len[-2], shuffled_megabatches_len[-1])
-
-    # import ipdb;ipdb.set_trace()
-    # print('shuffled_megabatches', len(shuffled_megabatches))
-    if group_data:
-        shuffled_megabatches = last_group_data_fun(shuffled_megabatches, lengths)
-        group_shuffled_megabatches_len = [[[lengths[i] for i in batch] for batch in megabatch] for megabatch in shuffled_megabatches]
-        # print(f'\nrank {accelerator.process_index} group_shuffled_megabatches_len', group_shuffled_megabatches_len[0], group_shuffled_megabatches_len[1], group_shuffled_megabatches_len[-2], group_shuffled_megabatches_len[-1])
-    
-    # import ipdb;ipdb.set_trace()
-    initial_global_step = initial_global_step * gradient_accumulation_size
-    # print('shuffled_megabatches', len(shuffled_megabatches))
-    # print('have been trained idx:', len(shuffled_megabatches[:initial_global_step]))
-    # print('shuffled_megabatches[:10]', shuffled_megabatches[:10])
-    # print('have been trained idx:', shuffled_megabatches[:initial_global_step])
-    shuffled_megabatches = shuffled_megabatches[initial_global_step:]
-    print(f'Skip the data of {initial_global_step} step!')
-    # print('after shuffled_megabatches', len(shuffled_megabatches))
-    # print('after shuffled_megabatches[:10]', shuffled_megabatches[:10])
-
-    # print('\nshuffled_megabatches', shuffled_megabatches)
-    # import ipdb;ipdb.set_trace()
-    # print('\nshuffled_megabatches len', [[i, lengths[i]] for megabatch in shuffled_megabatches for batch in megabatch for i in batch])
-
-    return [i for megabatch in shuffled_megabatches for batch in megabatch for i in batch]
+    # [1, 2, 3, 4] -> [[1, 3], [2, 4]]
+    # [1, 2, 3] -> [[1, 3], [2, 2]]
+    # [1] -> [[1, 1], [1, 1]]
+    if len(megabatch) == world_size * batch_size:
+        return megabatch.reshape(batch_size, world_size).T.copy()
+    chunks = np.empty((world_size, batch_size), dtype=megabatch.dtype)
+    for i in range(world_size):
+        chunk = megabatch[i::world_size]
+        if len(chunk) != 0:
+            chunks[i, :len(chunk)] = chunk
+            chunks[i, len(chunk):] = rng.choice(chunk, batch_size - len(chunk))
+        else:
+            chunks[i] = chunks[rng.integers(i)]
+    return chunks
 
 
 class LengthGroupedSampler(Sampler):
     r"""
     Sampler that samples indices in a way that groups together features of the dataset of roughly the same length while
     keeping a bit of randomness.
+
+    The epoch order is a permutation of all samples (grouped by shape with `group_data`), cut into megabatches of
+    `world_size * batch_size` that are visited in a random order; each megabatch is split into one batch per rank.
+    Only the permutation is materialized (an int32 array); megabatches are split, padded and repaired lazily, with
+    randomness derived from (seed, epoch, megabatch), so any position of an epoch can be regenerated exactly. The
+    state is (seed, epoch, cursor), the cursor counting megabatches already trained on, and resuming from it skips
+    nothing but the cursor.
     """
 
     def __init__(
@@ -339,27 +298,178 @@ class LengthGroupedSampler(Sampler):
         lengths: Optional[List[int]] = None, 
         group_data=False, 
         generator=None,
+        seed=42,
     ):
         if lengths is None:
             raise ValueError("Lengths must be provided.")
 
         self.batch_size = batch_size
         self.world_size = world_size
-        self.initial_global_step = initial_global_step
         self.gradient_accumulation_size = gradient_accumulation_size
         self.lengths = lengths
         self.group_data = group_data
-        self.generator = generator
-        # print('self.lengths, self.initial_global_step, self.batch_size, self.world_size, self.gradient_accumulation_size', 
-        #       len(self.lengths), self.initial_global_step, self.batch_size, self.world_size, self.gradient_accumulation_size)
+        # not `self.generator`: accelerate.prepare plants a randomly seeded generator on a sampler that has one, and
+        # the order would no longer follow (seed, epoch), which resuming relies on
+        self._generator = generator
+        self.seed = seed
+        self.epoch = 0
+        self.cursor = initial_global_step * gradient_accumulation_size
+        self.num_steps = 0
+        self._ids = None
+        self._epoch_order = None
+        print(f'Skip the data of {initial_global_step} step!')
+
+    def __len__(self):
+        return max(len(self.lengths) - self.cursor * self.batch_size * self.world_size, 0)
+
+    def set_epoch(self, epoch):
+        # accelerate's DataLoaderShard calls set_epoch(pass) at the start of every pass, which must not wipe the
+        # cursor restored by `load_state_dict`
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.cursor = 0
+            self.num_steps = 0
+
+    def set_progress(self, num_steps):
+        """Optimizer steps trained since the sampler was (re)started, so that `state_dict` points past them."""
+        self.num_steps = num_steps
+
+    def state_dict(self):
+        return dict(seed=self.seed, epoch=self.epoch, cursor=self.cursor + self.num_steps * self.gradient_accumulation_size)
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.cursor = state['seed'], state['epoch'], state['cursor']
+        self.num_steps = 0
+        print(f"Resume the sampler at megabatch {self.cursor} of epoch {self.epoch} (seed {self.seed})")
+
+    def epoch_order(self):
+        """The shuffled sample permutation and the megabatch visiting order of the current epoch."""
+        if self._epoch_order is None or self._epoch_order[0] != (self.seed, self.epoch):
+            # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
+            generator = self._generator
+            if generator is None:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)  # every rank will generate a fixed order but random index
+            if self.group_data:
+                if self._ids is None:
+                    self._ids, _ = length_ids(self.lengths)
+                indices = group_data_fun(self.lengths, generator)
+            else:
+                indices = torch.randperm(len(self.lengths), generator=generator).numpy().astype(np.int32)
+            megabatch_size = self.world_size * self.batch_size
+            indices_mega = torch.randperm((len(indices) + megabatch_size - 1) // megabatch_size, generator=generator).numpy()
+            self._epoch_order = ((self.seed, self.epoch), indices, indices_mega)
+        return self._epoch_order[1:]
+
+    def megabatch(self, k):
+        """The k-th megabatch of the epoch as a (world_size, batch_size) int32 array, one row per rank."""
+        indices, indices_mega = self.epoch_order()
+        megabatch_size = self.world_size * self.batch_size
+        mega = int(indices_mega[k])
+        rng = np.random.default_rng([self.seed, self.epoch, mega])
+        batches = split_to_even_chunks(indices[mega * megabatch_size: (mega + 1) * megabatch_size], self.world_size, self.batch_size, rng)
+        if self.group_data:
+            batches = last_group_data_fun(batches, self._ids, rng)
+        return batches
+
+    def num_batches(self):
+        """DataLoader batches (one per rank and megabatch) the next `__iter__` yields."""
+        megabatch_size = self.world_size * self.batch_size
+        return max((len(self.lengths) + megabatch_size - 1) // megabatch_size - self.cursor, 0) * self.world_size
+
+    def __iter__(self):
+        _, indices_mega = self.epoch_order()
+        for k in range(self.cursor, len(indices_mega)):
+            yield from self.megabatch(k).reshape(-1).tolist()
+
+
+def bucket_num_tokens(shape, ae_stride_thw, patch_size_thw):
+    """Transformer tokens of one sample of the bucket `shape` ('TxHxW' in pixels) after the VAE and the patch embedding."""
+    t, h, w = [int(i) for i in shape.split('x')]
+    latent_thw = ((t - 1) // ae_stride_thw[0] + 1, h // ae_stride_thw[1], w // ae_stride_thw[2])
+    return int(np.prod([math.ceil(i / p) for i, p in zip(latent_thw, patch_size_thw)]))
+
+
+class TokenBudgetBatchSampler(LengthGroupedSampler):
+    r"""
+    Batch sampler that fills every batch with samples of one shape up to `token_budget` transformer tokens per
+    device, so an image bucket gets many more samples per batch than a long video bucket. The samples of each shape
+    are shuffled and cut into megabatches of `world_size` batches, which are visited in a random order; every rank
+    gets one batch of each megabatch, so all ranks run the same shape and the same number of batches. Short
+    megabatches are padded within their shape. Shapes with more than one frame keep `video_batch_size` if it is given
+    (sequence parallel regroups their samples over ranks). State and resume work as in `LengthGroupedSampler`.
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        world_size: int,
+        gradient_accumulation_size: int, 
+        initial_global_step: int, 
+        lengths, 
+        ae_stride_thw, 
+        patch_size_thw, 
+        max_batch_size=None, 
+        video_batch_size=None, 
+        seed=42,
+    ):
+        super().__init__(
+            1, world_size, gradient_accumulation_size, initial_global_step, lengths=lengths, group_data=True, seed=seed
+            )
+        # the batch size varies with the shape; accelerate's BatchSamplerShard keeps only batches of `batch_size`
+        # samples unless it is None
+        self.batch_size = None
+        self.token_budget = token_budget
+        self._ids, names = length_ids(lengths)
+        num_tokens = np.array([bucket_num_tokens(name, ae_stride_thw, patch_size_thw) for name in names], dtype=np.int64)
+        self.bucket_batch_size = np.maximum(token_budget // num_tokens, 1)
+        if max_batch_size is not None:
+            self.bucket_batch_size = np.minimum(self.bucket_batch_size, max_batch_size)
+        if video_batch_size is not None:
+            is_video = np.array([int(name.split('x')[0]) > 1 for name in names])
+            self.bucket_batch_size[is_video] = video_batch_size
+        counts = np.bincount(self._ids, minlength=len(names))
+        self.num_megabatches = int(np.sum(-(-counts // (world_size * self.bucket_batch_size))))
+        for name, tokens, batch_size, count in zip(names, num_tokens, self.bucket_batch_size, counts):
+            if count > 0:
+                print(f'{name}: {count} samples, {tokens} tokens per sample, batch size {batch_size}')
 
     def __len__(self):
-        return len(self.lengths) - self.initial_global_step * self.batch_size * self.world_size * self.gradient_accumulation_size
+        return max(self.num_megabatches - self.cursor, 0) * self.world_size
+
+    def epoch_order(self):
+        """The shuffled sample permutation, its megabatches as (start, end, shape id) and their visiting order."""
+        if self._epoch_order is None or self._epoch_order[0] != (self.seed, self.epoch):
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = group_data_fun(self.lengths, generator)
+            sorted_ids = self._ids[indices]
+            run_starts = np.concatenate([[0], np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1]) if len(indices) > 0 \
+                else np.zeros(0, dtype=np.int64)
+            run_ends = np.append(run_starts[1:], len(indices))
+            starts, ends, shapes = [], [], []
+            for run_start, run_end in zip(run_starts, run_ends):
+                shape = sorted_ids[run_start]
+                megabatch_size = self.world_size * self.bucket_batch_size[shape]
+                starts.append(np.arange(run_start, run_end, megabatch_size))
+                ends.append(np.minimum(starts[-1] + megabatch_size, run_end))
+                shapes.append(np.full(len(starts[-1]), shape))
+            megabatches = np.stack([np.concatenate(starts), np.concatenate(ends), np.concatenate(shapes)], axis=1) \
+                if len(starts) > 0 else np.zeros((0, 3), dtype=np.int64)
+            indices_mega = torch.randperm(len(megabatches), generator=generator).numpy()
+            self._epoch_order = ((self.seed, self.epoch), indices, megabatches, indices_mega)
+        return self._epoch_order[1:]
+
+    def megabatch(self, k):
+        """The k-th megabatch of the epoch as a (world_size, batch size of its shape) int32 array, one row per rank."""
+        indices, megabatches, indices_mega = self.epoch_order()
+        mega = int(indices_mega[k])
+        start, end, shape = megabatches[mega]
+        rng = np.random.default_rng([self.seed, self.epoch, mega])
+        return split_to_even_chunks(indices[start: end], self.world_size, int(self.bucket_batch_size[shape]), rng)
+
+    def num_batches(self):
+        return len(self)
 
     def __iter__(self):
-        indices = get_length_grouped_indices(self.lengths, self.batch_size, self.world_size, 
-                                             self.gradient_accumulation_size, self.initial_global_step, 
-                                             group_data=self.group_data, generator=self.generator)
-        # print(len(indices), indices[23640:23690])
-        # import sys;sys.exit()
-        return iter(indices)
+        _, _, indices_mega = self.epoch_order()
+        for k in range(self.cursor, len(indices_mega)):
+            yield from self.megabatch(k).tolist()
@@ -11,6 +11,7 @@ from diffusers.utils import (
 
 if is_transformers_available():
     import transformers
+    from transformers.integrations import is_deepspeed_zero3_enabled
 
 if is_torchvision_available():
     from torchvision import transforms
@@ -36,6 +37,9 @@ class EMAModel:
         power: Union[float, int] = 2 / 3,
         model_cls: Optional[Any] = None,
         model_config: Dict[str, Any] = None,
+        foreach: bool = True,
+        update_every: int = 1,
+        bucket_mb: int = 256,
         **kwargs,
     ):
         """
@@ -48,6 +52,10 @@ class EMAModel:
             inv_gamma (float):
                 Inverse multiplicative factor of EMA warmup. Default: 1. Only used if `use_ema_warmup` is True.
             power (float): Exponential factor of EMA warmup. Default: 2/3. Only used if `use_ema_warmup` is True.
+            foreach (bool): Update each bucket with one fused `torch._foreach_lerp_` instead of a loop of `lerp_`.
+            update_every (int): Update the shadow weights every N steps only, with the product of the N decays.
+            bucket_mb (int): Size of the contiguous fp32 buckets holding the shadow weights. With the shadow weights
+                on CPU and the model on an accelerator, `step` streams the buckets through two device buffers.
             device (Optional[Union[str, torch.device]]): The device to store the EMA weights on. If None, the EMA
                         weights will be stored on CPU.
 
@@ -85,7 +93,12 @@ class EMAModel:
             min_decay = kwargs["min_value"]
 
         parameters = list(parameters)
-        self.shadow_params = [p.clone().detach() for p in parameters]
+        self.foreach = foreach
+        self.update_every = update_every
+        self._build_buckets(parameters, bucket_mb)
+        self.pending_decay = 1.0
+        self._staging = None
+        self._written = None
 
         if kwargs.get("device", None) is not None:
             deprecation_message = "The `device` argument is deprecated. Please use `to` instead."
@@ -120,18 +133,19 @@ class EMAModel:
             "use_ema_warmup",
             "inv_gamma",
             "power",
+            "pending_decay",
         ]:
             if kwargs.get(key, None) is not None:
                 ema_kwargs[key] = kwargs.pop(key)
         return ema_kwargs
 
     @classmethod
-    def from_pretrained(cls, path, model_cls) -> "EMAModel":
+    def from_pretrained(cls, path, model_cls, **kwargs) -> "EMAModel":
         config = model_cls.load_config(path)
         ema_kwargs = cls.extract_ema_kwargs(config)
         model = model_cls.from_pretrained(path)
 
-        ema_model = cls(model.parameters(), model_cls=model_cls, model_config=config)
+        ema_model = cls(model.parameters(), model_cls=model_cls, model_config=config, **kwargs)
 
         ema_model.load_state_dict(ema_kwargs)
         return ema_model
@@ -151,6 +165,114 @@ class EMAModel:
         self.copy_to(model.parameters())
         model.save_pretrained(path)
 
+    def _build_buckets(self, parameters, bucket_mb):
+        """
+        Copy the floating point parameters into contiguous fp32 buckets of about `bucket_mb`; `shadow_params` are
+        views into them. Other parameters are kept as plain clones.
+        """
+        self.buckets = []
+        self.shadow_params = [None] * len(parameters)
+        indices, numel = [], 0
+        for i, param in enumerate(parameters):
+            if not param.is_floating_point():
+                self.shadow_params[i] = param.detach().clone()
+                continue
+            indices.append(i)
+            numel += param.numel()
+            if numel * 4 >= bucket_mb * 1024 ** 2:
+                self._add_bucket([parameters[j] for j in indices], indices, numel)
+                indices, numel = [], 0
+        if len(indices) > 0:
+            self._add_bucket([parameters[j] for j in indices], indices, numel)
+        self._set_views()
+
+    def _add_bucket(self, parameters, indices, numel):
+        flat = torch.empty(numel, dtype=torch.float32, device=parameters[0].device)
+        bucket = dict(flat=flat, indices=indices, shapes=[p.shape for p in parameters])
+        self.buckets.append(bucket)
+        for view, param in zip(self._views(bucket, flat), parameters):
+            view.copy_(param.detach())
+
+    @staticmethod
+    def _views(bucket, flat):
+        views, offset = [], 0
+        for shape in bucket['shapes']:
+            numel = shape.numel()
+            views.append(flat[offset:offset + numel].view(shape))
+            offset += numel
+        return views
+
+    def _set_views(self):
+        for bucket in self.buckets:
+            for i, view in zip(bucket['indices'], self._views(bucket, bucket['flat'])):
+                self.shadow_params[i] = view
+
+    def _wait(self):
+        """Wait for the write back of a streamed `step` before the host shadow weights are read or changed."""
+        if self._written is not None:
+            self._written.synchronize()
+            self._written = None
+
+    def _lerp(self, shadows, parameters, weight):
+        trainable = [(s, p if p.dtype == s.dtype else p.to(s.dtype)) for s, p in zip(shadows, parameters) if p.requires_grad]
+        frozen = [(s, p) for s, p in zip(shadows, parameters) if not p.requires_grad]
+        if len(trainable) > 0:
+            # s - (1 - decay) * (s - p) == lerp(s, p, 1 - decay), without a temporary per tensor
+            if self.foreach:
+                torch._foreach_lerp_([s for s, _ in trainable], [p for _, p in trainable], weight)
+            else:
+                for s_param, param in trainable:
+                    s_param.lerp_(param, weight)
+        for s_param, param in frozen:
+            s_param.copy_(param)
+
+    def _update_streamed(self, parameters, weight, device):
+        """
+        Update host buckets from device parameters: bucket i+1 is copied in on one stream while bucket i is updated,
+        and written back on another, so only two bucket-sized device buffers are needed and the copies overlap compute.
+        """
+        backend = getattr(torch, device.type)
+        max_numel = max(bucket['flat'].numel() for bucket in self.buckets)
+        if self._staging is None or self._staging['buffers'][0].device != device or self._staging['buffers'][0].numel() < max_numel:
+            self._staging = dict(
+                buffers=[torch.empty(max_numel, dtype=torch.float32, device=device) for _ in range(2)],
+                streams=[backend.Stream(device), backend.Stream(device)],
+                views={},
+                )
+        buffers, (h2d, d2h) = self._staging['buffers'], self._staging['streams']
+        compute = backend.current_stream(device)
+        free, loaded = [None, None], []
+
+        def load(i):
+            flat = self.buckets[i]['flat']
+            with backend.stream(h2d):
+                if free[i % 2] is not None:
+                    h2d.wait_event(free[i % 2])
+                buffers[i % 2][:flat.numel()].copy_(flat, non_blocking=True)
+                event = backend.Event()
+                event.record(h2d)
+            loaded.append(event)
+
+        if self._written is not None:
+            h2d.wait_event(self._written)
+        load(0)
+        for i, bucket in enumerate(self.buckets):
+            if i + 1 < len(self.buckets):
+                load(i + 1)
+            compute.wait_event(loaded[i])
+            if (i, i % 2) not in self._staging['views']:
+                self._staging['views'][(i, i % 2)] = self._views(bucket, buffers[i % 2])
+            self._lerp(self._staging['views'][(i, i % 2)], [parameters[j] for j in bucket['indices']], weight)
+            computed = backend.Event()
+            computed.record(compute)
+            with backend.stream(d2h):
+                d2h.wait_event(computed)
+                bucket['flat'].copy_(buffers[i % 2][:bucket['flat'].numel()], non_blocking=True)
+                free[i % 2] = backend.Event()
+                free[i % 2].record(d2h)
+        self._written = backend.Event()
+        self._written.record(d2h)
+
     def get_decay(self, optimization_step: int) -> float:
         """
         Compute the decay factor for the exponential moving average.
@@ -192,21 +314,36 @@ class EMAModel:
         # Compute the decay factor for the exponential moving average.
         decay = self.get_decay(self.optimization_step)
         self.cur_decay_value = decay
-        one_minus_decay = 1 - decay
-
-        context_manager = contextlib.nullcontext
-        if is_transformers_available() and transformers.deepspeed.is_deepspeed_zero3_enabled():
+        # with --ema_update_every N the skipped steps are folded into one update by the product of their decays
+        self.pending_decay *= decay
+        if self.optimization_step % self.update_every != 0:
+            return
+        one_minus_decay = 1 - self.pending_decay
+        self.pending_decay = 1.0
+
+        if is_transformers_available() and is_deepspeed_zero3_enabled():
             import deepspeed
 
-        for s_param, param in zip(self.shadow_params, parameters):
-            if is_transformers_available() and transformers.deepspeed.is_deepspeed_zero3_enabled():
-                context_manager = deepspeed.zero.GatheredParameters(param, modifier_rank=None)
+            self._wait()
+            for s_param, param in zip(self.shadow_params, parameters):
+                with deepspeed.zero.GatheredParameters(param, modifier_rank=None):
+                    if param.requires_grad:
+                        s_param.lerp_(param.to(device=s_param.device, dtype=s_param.dtype), one_minus_decay)
+                    else:
+                        s_param.copy_(param)
+            return
 
-            with context_manager():
-                if param.requires_grad:
-                    s_param.sub_(one_minus_decay * (s_param - param))
-                else:
-                    s_param.copy_(param)
+        for s_param, param in zip(self.shadow_params, parameters):
+            if not s_param.is_floating_point():
+                s_param.copy_(param)
+        device = parameters[self.buckets[0]['indices'][0]].device if len(self.buckets) > 0 else None
+        if device is not None and device.type != 'cpu' and self.buckets[0]['flat'].device.type == 'cpu':
+            self._update_streamed(parameters, one_minus_decay, device)
+        else:
+            for bucket in self.buckets:
+                self._lerp(
+                    [self.shadow_params[i] for i in bucket['indices']], [parameters[i] for i in bucket['indices']], one_minus_decay
+                    )
 
     def copy_to(self, parameters: Iterable[torch.nn.Parameter]) -> None:
         """
@@ -217,28 +354,41 @@ class EMAModel:
                 updated with the stored moving averages. If `None`, the parameters with which this
                 `ExponentialMovingAverage` was initialized will be used.
         """
+        self._wait()
         parameters = list(parameters)
         for s_param, param in zip(self.shadow_params, parameters):
             param.data.copy_(s_param.to(param.device).data)
 
 
-    def to(self, device=None, dtype=None) -> None:
+    def to(self, device=None, dtype=None, non_blocking=False) -> None:
         r"""Move internal buffers of the ExponentialMovingAverage to `device`.
 
         Args:
             device: like `device` argument to `torch.Tensor.to`
         """
+        self._wait()
         # .to() on the tensors handles None correctly
-        self.shadow_params = [
-            p.to(device=device, dtype=dtype) if p.is_floating_point() else p.to(device=device)
-            for p in self.shadow_params
-        ]
+        for bucket in self.buckets:
+            bucket['flat'] = bucket['flat'].to(device=device, dtype=dtype, non_blocking=non_blocking)
+        for i, p in enumerate(self.shadow_params):
+            if not p.is_floating_point():
+                self.shadow_params[i] = p.to(device=device, non_blocking=non_blocking)
+        self._set_views()
+
+    def pin_memory(self) -> None:
+        r"""Move the buckets to pinned host memory, where `step` streams them to the device of the parameters."""
+        self._wait()
+        for bucket in self.buckets:
+            bucket['flat'] = bucket['flat'].cpu().pin_memory() if torch.cuda.is_available() else bucket['flat'].cpu()
+        self.shadow_params = [p.cpu() if not p.is_floating_point() else p for p in self.shadow_params]
+        self._set_views()
 
     def state_dict(self) -> dict:
         r"""
         Returns the state of the ExponentialMovingAverage as a dict. This method is used by accelerate during
         checkpointing to save the ema state dict.
         """
+        self._wait()
         # Following PyTorch conventions, references to tensors are returned:
         # "returns a reference to the state and not its copy!" -
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html#what-is-a-state-dict
@@ -250,6 +400,8 @@ class EMAModel:
             "use_ema_warmup": self.use_ema_warmup,
             "inv_gamma": self.inv_gamma,
             "power": self.power,
+            # the decays of the steps since the last update with --ema_update_every N, applied at the next one
+            "pending_decay": self.pending_decay,
             "shadow_params": self.shadow_params,
         }
 
@@ -260,6 +412,7 @@ class EMAModel:
             parameters: Iterable of `torch.nn.Parameter`; the parameters to be
                 temporarily stored.
         """
+        self._wait()
         self.temp_stored_params = [param.detach().cpu().clone() for param in parameters]
 
     def restore(self, parameters: Iterable[torch.nn.Parameter]) -> None:
@@ -319,10 +472,103 @@ class EMAModel:
         if not isinstance(self.power, (float, int)):
             raise ValueError("Invalid power")
 
+        self.pending_decay = state_dict.get("pending_decay", self.pending_decay)
+        if not isinstance(self.pending_decay, (float, int)) or self.pending_decay < 0.0 or self.pending_decay > 1.0:
+            raise ValueError("Invalid pending_decay")
+
         shadow_params = state_dict.get("shadow_params", None)
         if shadow_params is not None:
-            self.shadow_params = shadow_params
-            if not isinstance(self.shadow_params, list):
+            if not isinstance(shadow_params, list):
                 raise ValueError("shadow_params must be a list")
-            if not all(isinstance(p, torch.Tensor) for p in self.shadow_params):
+            if not all(isinstance(p, torch.Tensor) for p in shadow_params):
                 raise ValueError("shadow_params must all be Tensors")
+            if len(shadow_params) != len(self.shadow_params):
+                raise ValueError(f"Got {len(shadow_params)} shadow_params for {len(self.shadow_params)} parameters")
+            # copied into the buckets, so they keep their device, pinning and contiguity
+            self._wait()
+            for s_param, param in zip(self.shadow_params, shadow_params):
+                s_param.copy_(param)
+
+
+if __name__ == "__main__":
+    '''
+    Train step time of a stack of linear layers without EMA and with each EMA update path:
+    python -m opensora.utils.ema --num_params_m 500 --num_steps 20
+    '''
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_params_m", type=float, default=100)
+    parser.add_argument("--hidden_size", type=int, default=2048)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_steps", type=int, default=20)
+    parser.add_argument("--update_every", type=int, default=4)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    num_layers = max(int(args.num_params_m * 1e6 / (args.hidden_size ** 2 + args.hidden_size)), 1)
+    model = torch.nn.Sequential(*[torch.nn.Linear(args.hidden_size, args.hidden_size) for _ in range(num_layers)]).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    x = torch.randn(args.batch_size, args.hidden_size, device=device)
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def loop_ema():
+        # the per-parameter update this module used to do, one temporary per tensor
+        shadow_params = [p.detach().clone() for p in model.parameters()]
+
+        @torch.no_grad()
+        def step():
+            for s_param, param in zip(shadow_params, model.parameters()):
+                s_param.sub_((1 - 0.9999) * (s_param - param))
+        return step
+
+    def moved_ema():
+        # the previous --offload_ema: the whole EMA to the device and back around every update
+        ema = EMAModel(model.parameters(), foreach=True)
+        ema.pin_memory()
+
+        def step():
+            ema.to(device=device, non_blocking=True)
+            ema.step(model.parameters())
+            ema.to(device='cpu', non_blocking=True)
+        return step
+
+    def bucket_ema(offload=False, **kwargs):
+        ema = EMAModel(model.parameters(), **kwargs)
+        if offload:
+            ema.pin_memory()
+        return lambda: ema.step(model.parameters())
+
+    modes = [
+        ('no ema', None), 
+        ('per-tensor loop', loop_ema), 
+        ('fused buckets', lambda: bucket_ema(foreach=True)), 
+        (f'fused buckets, every {args.update_every} steps', lambda: bucket_ema(foreach=True, update_every=args.update_every)),
+        ]
+    if device.type == 'cuda':
+        modes += [('offload, whole model moved', moved_ema), ('offload, streamed buckets', lambda: bucket_ema(offload=True))]
+
+    print(f'{sum(p.numel() for p in model.parameters()) / 1e6:.0f}M parameters on {device}')
+    baseline = None
+    for name, make_step in modes:
+        ema_step = make_step() if make_step is not None else None
+        times = []
+        for i in range(args.num_steps + 2):
+            synchronize()
+            start_time = time.time()
+            model(x).float().pow(2).mean().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            if ema_step is not None:
+                ema_step()
+            synchronize()
+            if i >= 2:
+                times.append(time.time() - start_time)
+        step_time = sorted(times)[len(times) // 2] * 1000
+        baseline = step_time if baseline is None else baseline
+        print(f'  {name:<36} {step_time:>9.1f} ms/step  overhead {step_time - baseline:>8.1f} ms ({(step_time / baseline - 1) * 100:>5.1f}%)')
+        del ema_step
@@ -0,0 +1,192 @@
+import queue
+import threading
+from contextlib import nullcontext
+
+import torch
+
+_STOP = object()
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            yield from _tensors(o)
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            yield from _tensors(o)
+
+
+class EncodePipeline(object):
+    """
+    Runs the frozen encoders (text encoders, VAE) of the next `depth` batches while the current batch trains.
+
+    `pipeline(iterable)` yields `encode_fn(item)` for every item of `iterable`. The items are still drawn from
+    `iterable` on the calling thread, but they are encoded by a worker thread on a side stream of `device`, and at
+    most `depth` batches are encoded ahead of the one being consumed, so both queues stay bounded. A yielded batch is
+    made visible to the current stream with an event wait (no host sync) and its tensors are recorded on that stream
+    for the caching allocator. An exception raised by `encode_fn` is raised again by the iteration. Items already on
+    the device (e.g. copied non_blocking by a prepared dataloader) are handed over the same way in the other direction:
+    the side stream waits for the current stream as of when the item was drawn, and records the item's tensors.
+
+    `iterable` runs `depth` items ahead of the consumer, so its own end-of-input (e.g. accelerate's
+    `end_of_dataloader`) is reached early; `end_of_input` is True while the consumer holds the last item instead.
+
+    The encoders are shared with the training thread: `lock` is held while a batch is encoded, hold it to use them
+    elsewhere (e.g. validation). The encoded batches ahead stay on the device, and the encoder activations now
+    overlap the DiT step, so the peak memory grows. `depth=0` encodes serially on the calling thread.
+    """
+
+    def __init__(self, encode_fn, device, depth=1):
+        self.encode_fn = encode_fn
+        self.device = torch.device(device)
+        self.depth = depth
+        self.backend = getattr(torch, self.device.type) if self.device.type != 'cpu' else None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.stalls = 0  # batches that were not encoded yet when the consumer asked for them
+        self.end_of_input = False
+
+    def __call__(self, iterable):
+        self.end_of_input = False
+        if self.depth <= 0:
+            for item in iterable:
+                self.batches += 1
+                yield self.encode_fn(item)
+            return
+
+        inputs, outputs = queue.Queue(maxsize=self.depth + 1), queue.Queue(maxsize=self.depth)
+        worker = threading.Thread(target=self._work, args=(inputs, outputs), daemon=True)
+        worker.start()
+        iterator = iter(iterable)
+        pending, exhausted = 0, False
+        try:
+            while True:
+                # keep `depth` batches in flight, the queues can never fill up
+                while not exhausted and pending < self.depth:
+                    try:
+                        item = next(iterator)
+                        inputs.put((item, self._record()))
+                        pending += 1
+                    except StopIteration:
+                        exhausted = True
+                if pending == 0:
+                    return
+                self.stalls += outputs.empty()
+                output, event, error = outputs.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                self._wait(output, event, self.backend.current_stream(self.device) if event is not None else None)
+                self.batches += 1
+                # the iterator was asked for the next item before this one was taken, so the end is known here
+                self.end_of_input = exhausted and pending == 0
+                yield output
+        finally:
+            inputs.put(_STOP)
+            worker.join()
+
+    def _work(self, inputs, outputs):
+        stream = None
+        if self.backend is not None:
+            self.backend.set_device(self.device)
+            stream = self.backend.Stream(self.device)
+        while True:
+            item = inputs.get()
+            if item is _STOP:
+                return
+            item, ready = item
+            try:
+                with self.lock, self.backend.stream(stream) if stream is not None else nullcontext():
+                    self._wait(item, ready, stream)
+                    output = self.encode_fn(item)
+                    event = None
+                    if stream is not None:
+                        event = self.backend.Event()
+                        event.record(stream)
+            except Exception as e:
+                outputs.put((None, None, e))
+                return
+            outputs.put((output, event, None))
+
+    def _record(self):
+        """An event on the current stream, which queued the copies of an item drawn now onto the device."""
+        if self.backend is None:
+            return None
+        event = self.backend.Event()
+        event.record(self.backend.current_stream(self.device))
+        return event
+
+    def _wait(self, obj, event, stream):
+        """Make `stream` wait for `event` before using the tensors of `obj`, and tell the allocator it uses them."""
+        if event is None:
+            return
+        stream.wait_event(event)
+        for tensor in _tensors(obj):
+            if tensor.device.type == self.device.type:
+                tensor.record_stream(stream)
+
+
+if __name__ == "__main__":
+    '''
+    Step time of a VAE-like encode followed by a DiT-like step, serial and with the encode pipelined:
+    python -m opensora.utils.encode_pipeline --depth 1 --num_steps 50
+    '''
+    import time
+    import argparse
+    from torch import nn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=17)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    vae = nn.Sequential(
+        nn.Conv3d(3, 64, 3, stride=(1, 2, 2), padding=1), nn.SiLU(),
+        nn.Conv3d(64, 64, 3, stride=(2, 2, 2), padding=1), nn.SiLU(),
+        nn.Conv3d(64, 8, 3, stride=(2, 2, 2), padding=1),
+        ).to(device, dtype).requires_grad_(False)
+    latent_tokens = ((args.frames - 1) // 4 + 1) * (args.size // 8) ** 2
+    dit = nn.Sequential(*[
+        nn.Sequential(nn.Linear(args.hidden_size, 4 * args.hidden_size), nn.GELU(), nn.Linear(4 * args.hidden_size, args.hidden_size))
+        for _ in range(8)
+        ]).to(device, dtype)
+    proj_in = nn.Linear(8, args.hidden_size).to(device, dtype)
+    optimizer = torch.optim.SGD(list(dit.parameters()) + list(proj_in.parameters()), lr=1e-4)
+    pin = device.type == 'cuda'
+    videos = [torch.randn(args.batch_size, 3, args.frames, args.size, args.size, pin_memory=pin) for _ in range(4)]
+
+    def encode(video):
+        with torch.no_grad():
+            return vae(video.to(device, dtype, non_blocking=True))
+
+    def train(latents):
+        x = proj_in(latents.flatten(2).transpose(1, 2)[:, :latent_tokens])
+        loss = dit(x).float().pow(2).mean()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    print(f'{args.batch_size}x{args.frames}x{args.size}x{args.size} videos on {device}')
+    for depth in (0, args.depth):
+        pipeline = EncodePipeline(encode, device, depth=depth)
+        for latents in pipeline(videos[i % len(videos)] for i in range(3)):
+            train(latents)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        pipeline.batches = pipeline.stalls = 0
+        start_time = time.time()
+        for latents in pipeline(videos[i % len(videos)] for i in range(args.num_steps)):
+            train(latents)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        step_time = (time.time() - start_time) / args.num_steps * 1e3
+        name = 'serial' if depth == 0 else f'pipelined, depth {depth}'
+        print(f'  {name:<20} {step_time:.2f} ms/step  stalls {pipeline.stalls}/{pipeline.batches}')
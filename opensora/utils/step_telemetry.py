@@ -0,0 +1,273 @@
+import os
+import json
+import math
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+
+# dense bf16 peak of the accelerators the MFU is usually reported against, override with --peak_tflops
+PEAK_TFLOPS = {'H100': 989.0, 'H800': 989.0, 'H20': 148.0, 'A100': 312.0, 'A800': 312.0}
+
+STAGES = ['data_wait', 'h2d', 'text_encode', 'vae_encode', 'sp_all_to_all', 'forward', 'backward', 'optimizer', 'ema', 'checkpoint']
+
+
+def dit_flops_per_sample(config, latent_thw, text_len):
+    """
+    Forward FLOPs of the OpenSora DiT `config` on one sample of latent size (t, h, w) with `text_len` caption
+    tokens: the matmuls of self attention, cross attention on the projected caption and the 4x feed forward of every
+    block, the attention itself (1/sparse_n of the sequence in the sparse1d blocks), the patch embedding, output
+    projection and caption projection. Norms, modulation and activations are left out.
+    """
+    d = config.num_attention_heads * config.attention_head_dim
+    patch_t, patch = getattr(config, 'patch_size_t', 1) or 1, config.patch_size
+    t, h, w = latent_thw
+    n = math.ceil(t / patch_t) * (h // patch) * (w // patch)
+    m = text_len
+    flops = 0
+    for i in range(config.num_layers):
+        # as in OpenSoraT2V_v1_3, blocks 2..29 attend within sparse_n groups when sparse1d is on
+        sparse_n = config.sparse_n if getattr(config, 'sparse1d', False) and 1 < i < 30 else 1
+        flops += 2 * n * (4 * d * d + 2 * d * d + 2 * d * 4 * d)  # self attn qkvo, cross attn q/o, feed forward
+        flops += 2 * m * 2 * d * d  # cross attn k/v
+        flops += 4 * n * (n / sparse_n) * d + 4 * n * m * d  # scores and weighted values
+    in_channels = config.in_channels
+    out_channels = getattr(config, 'out_channels', None) or in_channels
+    flops += 2 * n * patch_t * patch * patch * (in_channels + out_channels) * d
+    flops += 2 * m * (config.caption_channels * d + d * d)
+    return flops
+
+
+def peak_tflops_of(device):
+    if device.type != 'cuda':
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, tflops in PEAK_TFLOPS.items():
+        if key in name:
+            return tflops
+    return None
+
+
+class StepTelemetry(object):
+    """
+    Per optimizer step metrics of DiT training, one JSON line per step in `{output_dir}/rank{R:05d}.jsonl`.
+
+    Each step is split into the `STAGES` with `stage(name)`: on an accelerator the stages are timed with device
+    events, resolved only every `log_interval` steps so the timing adds no sync, and `host=True` stages (data wait,
+    checkpoint) with the host clock; on CPU everything uses the host clock. `other_s` is the rest of the step. Each
+    record also holds the tokens and tokens/s of the step, its TFLOPS and MFU from the DiT config (`add_batch`), and
+    the peak device memory, tracked per latent bucket shape.
+
+    Every `log_interval` steps the mean step and data wait times of all ranks are gathered (a collective, so every
+    rank has to end the same steps), rank skew above `skew_threshold` is reported, and the interval means go to
+    `log_fn` (accelerator.log, i.e. tensorboard). Without `output_dir` all methods are no-ops.
+    """
+
+    def __init__(self, output_dir, model_config, text_len, device, rank=0, world_size=1, log_interval=10,
+                 peak_tflops=None, log_fn=None, skew_threshold=1.2):
+        self.enabled = output_dir is not None
+        self.model_config = model_config
+        self.text_len = text_len
+        self.device = torch.device(device)
+        self.rank = rank
+        self.world_size = world_size
+        self.log_interval = log_interval
+        self.peak_tflops = peak_tflops if peak_tflops is not None else peak_tflops_of(self.device)
+        self.log_fn = log_fn
+        self.skew_threshold = skew_threshold
+        self.backend = getattr(torch, self.device.type) if self.device.type != 'cpu' else None
+        patch_t = getattr(model_config, 'patch_size_t', 1) or 1
+        self.patch_volume = patch_t * model_config.patch_size * model_config.patch_size
+        self.peak_memory = {}
+        self.pending = []
+        if self.enabled:
+            os.makedirs(output_dir, exist_ok=True)
+            self.file = open(os.path.join(output_dir, f'rank{rank:05d}.jsonl'), 'a')
+        self._reset()
+        self.step_start = time.perf_counter()
+
+    def _reset(self):
+        self.host_times = defaultdict(float)
+        self.events = []
+        self.tokens = []
+        self.flops = 0.0
+        self.samples = 0
+        self.bucket = None
+
+    @contextmanager
+    def stage(self, name, host=False):
+        if not self.enabled:
+            yield
+            return
+        if host or self.backend is None:
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.host_times[name] += time.perf_counter() - start_time
+        else:
+            start = self.backend.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end = self.backend.Event(enable_timing=True)
+                end.record()
+                self.events.append((name, start, end))
+
+    def timed(self, iterable, name='data_wait'):
+        """Iterate `iterable`, timing each `next` as the host stage `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, host=True):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_batch(self, latent_shape, attention_mask=None, sp_size=1):
+        """
+        Count a micro batch of latent shape (b, c, t, h, w), with its latent `attention_mask` (b, t, h, w) for the
+        tokens. Under sequence parallel `t` is the frames of this rank and the FLOPs are 1/sp_size of the full sample.
+        """
+        if not self.enabled:
+            return
+        b, _, t, h, w = latent_shape
+        self.samples += b
+        self.flops += 3 * b * dit_flops_per_sample(self.model_config, (t * sp_size, h, w), self.text_len) / sp_size
+        # summed on the device and read at the next flush, so counting adds no sync
+        self.tokens.append(attention_mask.detach().sum() if attention_mask is not None else b * t * h * w)
+        self.bucket = f'{t * sp_size}x{h}x{w}'
+
+    def end_step(self, step):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        record = dict(
+            step=step, wall=now - self.step_start, host_times=dict(self.host_times), events=self.events,
+            tokens=self.tokens, flops=self.flops, samples=self.samples, bucket=self.bucket, peak_memory_mb=None,
+            )
+        if self.backend is not None:
+            record['peak_memory_mb'] = self.backend.max_memory_allocated(self.device) / 2 ** 20
+            self.backend.reset_peak_memory_stats(self.device)
+            self.peak_memory[self.bucket] = max(self.peak_memory.get(self.bucket, 0.0), record['peak_memory_mb'])
+        self.pending.append(record)
+        self._reset()
+        self.step_start = now
+        if step % self.log_interval == 0:
+            self.flush(step)
+
+    def _row(self, record):
+        stages = {name: 0.0 for name in STAGES}
+        for name, seconds in record['host_times'].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+        for name, start, end in record['events']:
+            stages[name] = stages.get(name, 0.0) + start.elapsed_time(end) / 1000
+        tokens = sum(float(t) for t in record['tokens']) / self.patch_volume
+        wall = record['wall']
+        row = dict(step=record['step'], rank=self.rank, bucket=record['bucket'], samples=record['samples'], wall_s=wall)
+        row.update({f'{name}_s': seconds for name, seconds in stages.items()})
+        row['other_s'] = wall - sum(stages.values())
+        row['tokens'] = tokens
+        row['tokens_per_s'] = tokens / wall
+        row['tflops'] = record['flops'] / wall / 1e12
+        row['mfu'] = row['tflops'] / self.peak_tflops if self.peak_tflops else None
+        row['peak_memory_mb'] = record['peak_memory_mb']
+        return row
+
+    def flush(self, step):
+        if not self.enabled or len(self.pending) == 0:
+            return
+        if self.backend is not None:
+            self.backend.synchronize(self.device)
+        rows = [self._row(record) for record in self.pending]
+        self.pending = []
+        for row in rows:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+        keys = ['wall_s', 'other_s', 'tokens_per_s', 'tflops'] + [f'{name}_s' for name in STAGES]
+        summary = {key: sum(row[key] for row in rows) / len(rows) for key in keys}
+        if self.peak_tflops:
+            summary['mfu'] = summary['tflops'] / self.peak_tflops
+        if self.backend is not None:
+            summary['peak_memory_mb'] = max(row['peak_memory_mb'] for row in rows)
+
+        local = torch.tensor([summary['wall_s'], summary['data_wait_s']], dtype=torch.float64, device=self.device)
+        if dist.is_available() and dist.is_initialized() and self.world_size > 1:
+            gathered = [torch.zeros_like(local) for _ in range(self.world_size)]
+            dist.all_gather(gathered, local)
+            per_rank = torch.stack(gathered).cpu()
+        else:
+            per_rank = local.unsqueeze(0).cpu()
+        walls = per_rank[:, 0]
+        median = walls.median().item()
+        summary['rank_skew'] = walls.max().item() / median if median > 0 else 1.0
+        summary['slowest_rank'] = int(walls.argmax().item())
+        if self.rank == 0:
+            if summary['rank_skew'] > self.skew_threshold:
+                slowest = summary['slowest_rank']
+                print(f"Step {step}: rank {slowest} is {summary['rank_skew']:.2f}x slower than the median rank "
+                      f"({walls[slowest].item():.3f}s/step, {per_rank[slowest, 1].item():.3f}s of it waiting for data)")
+            self.file.write(json.dumps(dict(step=step, kind='interval', **summary, buckets_peak_memory_mb=self.peak_memory)) + '\n')
+            self.file.flush()
+        if self.log_fn is not None:
+            self.log_fn({f'telemetry/{key}': value for key, value in summary.items() if value is not None}, step=step)
+
+    def close(self):
+        if self.enabled:
+            self.file.close()
+
+
+if __name__ == "__main__":
+    '''
+    Train a tiny OpenSora DiT on random latents on CPU (or the GPU) and print its telemetry:
+    python -m opensora.utils.step_telemetry --output_dir /tmp/telemetry --num_steps 12
+    '''
+    import argparse
+    from opensora.models.diffusion.opensora_v1_3.modeling_opensora import OpenSoraT2V_v1_3
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_steps", type=int, default=12)
+    parser.add_argument("--log_interval", type=int, default=4)
+    parser.add_argument("--peak_tflops", type=float, default=None)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    text_len, caption_channels = 16, 32
+    model = OpenSoraT2V_v1_3(
+        num_layers=4, attention_head_dim=24, num_attention_heads=4, patch_size_t=1, patch_size=2, in_channels=8,
+        out_channels=8, caption_channels=caption_channels, cross_attention_dim=96, activation_fn="gelu-approximate",
+        sample_size_h=16, sample_size_w=16, sample_size_t=5, sparse1d=True, sparse_n=4,
+        ).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    telemetry = StepTelemetry(
+        args.output_dir, model.config, text_len, device, log_interval=args.log_interval, peak_tflops=args.peak_tflops,
+        log_fn=lambda values, step: print(f'step {step}: ' + ', '.join(f'{k.split("/")[-1]}={v:.4g}' for k, v in values.items() if isinstance(v, float)))
+        )
+    buckets = [(2, 5, 16, 16), (4, 1, 16, 16), (1, 5, 24, 16)]
+    batches = [buckets[i % len(buckets)] for i in range(args.num_steps)]
+    for step, (b, t, h, w) in enumerate(telemetry.timed(batches), start=1):
+        with telemetry.stage('h2d'):
+            x = torch.randn(b, 8, t, h, w).to(device)
+            mask = torch.ones(b, t, h, w).to(device)
+            cond = torch.randn(b, 1, text_len, caption_channels).to(device)
+            cond_mask = torch.ones(b, 1, text_len).to(device)
+        telemetry.add_batch(x.shape, mask)
+        with telemetry.stage('forward'):
+            out = model(x, torch.randint(0, 1000, (b,), device=device), encoder_hidden_states=cond,
+                        attention_mask=mask, encoder_attention_mask=cond_mask)[0]
+            loss = (out.float() - x).pow(2).mean()
+        with telemetry.stage('backward'):
+            loss.backward()
+        with telemetry.stage('optimizer'):
+            optimizer.step()
+            optimizer.zero_grad()
+        telemetry.end_step(step)
+    telemetry.flush(args.num_steps)
+    telemetry.close()
+    print(f'per step records in {os.path.join(args.output_dir, "rank00000.jsonl")}')
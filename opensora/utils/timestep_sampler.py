@@ -0,0 +1,158 @@
+import math
+
+import torch
+from diffusers.training_utils import compute_loss_weighting_for_sd3
+
+from opensora.utils.utils import explicit_uniform_sampling
+
+
+class TimestepSampler(object):
+    """
+    Training timesteps drawn on the device. The scheduler tables (timesteps and sigmas for flow matching, the SNR
+    for DDPM schedulers) are copied to the device once, and every batch is sampled and gathered there, so a draw
+    never waits on the device or copies a table from the host.
+
+    For flow matching (`flow_matching=True`) the timestep index follows `weighting_scheme` as in SD3, and `sample`
+    also returns the sigmas and loss weights of the batch. Otherwise each rank draws uniformly from its own slice
+    of the timesteps (`explicit_uniform_sampling`).
+    """
+
+    def __init__(self, noise_scheduler, device, flow_matching=False, weighting_scheme="logit_normal",
+                 logit_mean=0.0, logit_std=1.0, mode_scale=1.29, rank=0, world_size=1, generator=None):
+        self.device = device
+        self.flow_matching = flow_matching
+        self.weighting_scheme = weighting_scheme
+        self.logit_mean = logit_mean
+        self.logit_std = logit_std
+        self.mode_scale = mode_scale
+        self.rank = rank
+        self.world_size = world_size
+        self.generator = generator
+        self.num_train_timesteps = noise_scheduler.config.num_train_timesteps
+        if flow_matching:
+            self.timesteps = noise_scheduler.timesteps.to(device)
+            self.sigmas = noise_scheduler.sigmas[:len(noise_scheduler.timesteps)].to(device=device, dtype=torch.float32)
+            self.tables = {}
+        else:
+            alphas_cumprod = noise_scheduler.alphas_cumprod.to(device=device, dtype=torch.float32)
+            # same as diffusers' compute_snr, (sqrt(a) / sqrt(1 - a)) ** 2
+            self.snr_table = (alphas_cumprod ** 0.5 / (1.0 - alphas_cumprod) ** 0.5) ** 2
+
+    def _tables(self, dtype):
+        """Sigmas and loss weights in `dtype`, the weights computed from the cast sigmas as the training loop did."""
+        if dtype not in self.tables:
+            sigmas = self.sigmas.to(dtype)
+            self.tables[dtype] = (sigmas, compute_loss_weighting_for_sd3(weighting_scheme=self.weighting_scheme, sigmas=sigmas))
+        return self.tables[dtype]
+
+    def density(self, bsz):
+        """
+        Diffusers' `compute_density_for_timestep_sampling` drawn on the device (the pinned diffusers draws on the CPU
+        and takes no generator).
+        """
+        if self.weighting_scheme == "logit_normal":
+            u = torch.normal(mean=self.logit_mean, std=self.logit_std, size=(bsz,), device=self.device, generator=self.generator)
+            return torch.sigmoid(u)
+        u = torch.rand(size=(bsz,), device=self.device, generator=self.generator)
+        if self.weighting_scheme == "mode":
+            u = 1 - u - self.mode_scale * (torch.cos(math.pi * u / 2) ** 2 - 1 + u)
+        return u
+
+    def sample(self, bsz, n_dim=4, dtype=torch.float32):
+        """
+        Returns `(timesteps, sigmas, weighting)` for a batch of `bsz`. The sigmas and weights are shaped to broadcast
+        against an `n_dim` input; both are None unless flow matching.
+        """
+        if not self.flow_matching:
+            timesteps = explicit_uniform_sampling(
+                T=self.num_train_timesteps, n=self.world_size, rank=self.rank, bsz=bsz, device=self.device, generator=self.generator
+                )
+            return timesteps, None, None
+
+        u = self.density(bsz)
+        # a logit normal draw can round to u == 1.0 in fp32, which would index past the table
+        indices = (u * self.num_train_timesteps).long().clamp_(0, len(self.timesteps) - 1)
+        sigmas, weighting = self._tables(dtype)
+        shape = (bsz,) + (1,) * (n_dim - 1)
+        return self.timesteps[indices], sigmas[indices].reshape(shape), weighting[indices].reshape(shape)
+
+    def snr(self, timesteps):
+        """Signal to noise ratio of DDPM `timesteps`, as diffusers' `compute_snr`."""
+        return self.snr_table[timesteps].float()
+
+
+if __name__ == "__main__":
+    '''
+    Host syncs per training step of the previous timestep/sigma lookup and of TimestepSampler:
+    python -m opensora.utils.timestep_sampler --batch_size 8 --num_steps 100
+    '''
+    import time
+    import argparse
+    import warnings
+    from torch.profiler import profile, ProfilerActivity
+    from diffusers import FlowMatchEulerDiscreteScheduler, DDPMScheduler
+    from diffusers.training_utils import compute_density_for_timestep_sampling
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_steps", type=int, default=100)
+    parser.add_argument("--weighting_scheme", type=str, default="logit_normal", choices=["sigma_sqrt", "logit_normal", "mode", "cosmap"])
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rf_scheduler, ddpm_scheduler = FlowMatchEulerDiscreteScheduler(), DDPMScheduler()
+    rf_sampler = TimestepSampler(rf_scheduler, device, flow_matching=True, weighting_scheme=args.weighting_scheme)
+    ddpm_sampler = TimestepSampler(ddpm_scheduler, device)
+
+    def previous_rf_step():
+        # the lookup train_t2v_diffusers.py used to do: host draw, then one nonzero().item() per sample
+        u = compute_density_for_timestep_sampling(
+            weighting_scheme=args.weighting_scheme, batch_size=args.batch_size, logit_mean=0.0, logit_std=1.0, mode_scale=1.29
+            )
+        indices = (u * rf_scheduler.config.num_train_timesteps).long()
+        timesteps = rf_scheduler.timesteps[indices].to(device=device)
+        sigmas = rf_scheduler.sigmas.to(device=device)
+        schedule_timesteps = rf_scheduler.timesteps.to(device)
+        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        sigma = sigmas[step_indices].flatten().reshape(-1, 1, 1, 1, 1)
+        return timesteps, sigma, compute_loss_weighting_for_sd3(weighting_scheme=args.weighting_scheme, sigmas=sigma)
+
+    def previous_ddpm_step():
+        import random
+        lower_bound, upper_bound = -0.5, ddpm_scheduler.config.num_train_timesteps - 0.5
+        timesteps = torch.tensor([round(random.uniform(lower_bound, upper_bound)) for _ in range(args.batch_size)], device=device).long()
+        alphas_cumprod = ddpm_scheduler.alphas_cumprod.to(device=device)[timesteps].float()
+        return timesteps, alphas_cumprod / (1 - alphas_cumprod)
+
+    modes = [
+        ('flow matching, previous lookup', previous_rf_step),
+        ('flow matching, TimestepSampler', lambda: rf_sampler.sample(args.batch_size, n_dim=5)),
+        ('ddpm, previous sampling', previous_ddpm_step),
+        ('ddpm, TimestepSampler', lambda: ddpm_sampler.snr(ddpm_sampler.sample(args.batch_size)[0])),
+        ]
+    # ops that copy a device value to the host; on CUDA the sync debug mode also counts every implicit sync
+    sync_ops = ('aten::_local_scalar_dense', 'aten::nonzero', 'aten::item')
+    print(f'{args.batch_size} timesteps per step on {device}')
+    for name, step in modes:
+        for _ in range(3):
+            step()
+        with profile(activities=[ProfilerActivity.CPU]) as prof:
+            for _ in range(args.num_steps):
+                step()
+        host_reads = sum(event.count for event in prof.key_averages() if event.key in sync_ops)
+        num_syncs = 'n/a'
+        if device.type == 'cuda':
+            torch.cuda.set_sync_debug_mode("warn")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                for _ in range(args.num_steps):
+                    step()
+            torch.cuda.set_sync_debug_mode("default")
+            num_syncs = f'{len(caught) / args.num_steps:.1f}'
+        start_time = time.time()
+        for _ in range(args.num_steps):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        step_time = (time.time() - start_time) / args.num_steps * 1e3
+        print(f'  {name:<34} device->host reads/step {host_reads / args.num_steps:>5.1f}  syncs/step {num_syncs:>5}  {step_time:.3f} ms/step')
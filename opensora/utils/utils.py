@@ -44,7 +44,7 @@ def to_2tuple(x):
 
 
 
-def explicit_uniform_sampling(T, n, rank, bsz, device):
+def explicit_uniform_sampling(T, n, rank, bsz, device, generator=None):
     """
     Explicit Uniform Sampling with integer timesteps and PyTorch.
 
@@ -61,11 +61,10 @@ def explicit_uniform_sampling(T, n, rank, bsz, device):
     interval_size = T / n  # Integer division to ensure boundaries are integers
     lower_bound = interval_size * rank - 0.5
     upper_bound = interval_size * (rank + 1) - 0.5
-    sampled_timesteps = [round(random.uniform(lower_bound, upper_bound)) for _ in range(bsz)]
 
-    # Uniformly sample within the rank's interval, returning integers
-    sampled_timesteps = torch.tensor([round(random.uniform(lower_bound, upper_bound)) for _ in range(bsz)], device=device)
-    sampled_timesteps = sampled_timesteps.long()
+    # Uniformly sample within the rank's interval, returning integers; drawn on `device`, so no host to device copy
+    sampled_timesteps = torch.rand(bsz, device=device, generator=generator) * (upper_bound - lower_bound) + lower_bound
+    sampled_timesteps = torch.round(sampled_timesteps).clamp_(0, T - 1).long()
     return sampled_timesteps
 
 